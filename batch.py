@@ -0,0 +1,149 @@
+from main import *
+import argparse
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Function to find all networks (pairs of .cnt and .mes files) in a list of paths
+# returns a list of (name, CNTFile, MESFile) tuples
+# paths: list of directories (searched recursively), or (CNTFile, MESFile) pairs
+# In each directory a .cnt file is paired with the .mes file of the same name. If a directory has exactly 1 .cnt
+# and 1 .mes file they are paired even if their names are different
+def findNetworks(paths):
+    networks = []
+    names = set()
+    for path in paths:
+        # explicit pair of files
+        if not isinstance(path, str):
+            CNTFile, MESFile = path
+            networks.append((uniqueName(os.path.splitext(os.path.basename(CNTFile))[0], names), CNTFile, MESFile))
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            cnt = sorted([f for f in files if f.split('.')[-1] == 'cnt'])
+            mes = sorted([f for f in files if f.split('.')[-1] == 'mes'])
+            if len(cnt) == 1 and len(mes) == 1:
+                pairs = [(cnt[0], mes[0])]
+            else:
+                pairs = [(f, f[:-3] + 'mes') for f in cnt if f[:-3] + 'mes' in mes]
+            for CNTFile, MESFile in pairs:
+                # name the network by its directory (relative to path), and by its file name if the directory
+                # holds more than 1 network
+                name = os.path.relpath(os.path.join(root, CNTFile[:-4]), path)
+                if len(pairs) == 1 and root != path:
+                    name = os.path.relpath(root, path)
+                networks.append((uniqueName(name, names), os.path.join(root, CNTFile), os.path.join(root, MESFile)))
+    return networks
+
+
+# Function to make a network name unique by adding a number to it
+# returns the unique name
+# name: name of the network
+# names: set of names already used (the new name is added to it)
+def uniqueName(name, names):
+    unique = name
+    count = 1
+    while unique in names:
+        count = count + 1
+        unique = name + '_' + str(count)
+    names.add(unique)
+    return unique
+
+
+# Function to adjust one network (runs in a worker process)
+# returns a dictionary with the summary of the adjustment, or the error if it failed
+# network: (name, CNTFile, MESFile) tuple from findNetworks
+# outdir: directory to write output.out (and Figures.pdf) of this network to
+# kwargs: passed on to main
+def runJob(network, outdir, kwargs):
+    name, CNTFile, MESFile = network
+    row = {'name': name, 'cnt': CNTFile, 'mes': MESFile, 'outdir': outdir}
+    time0 = time.perf_counter()
+    try:
+        results = main(CNTFile=CNTFile, MESFile=MESFile, outdir=outdir, suppress_print=True, show=False, **kwargs)
+        row.update(results)
+        row['status'] = 'ok'
+    except Exception as e:
+        row['status'] = 'failed'
+        row['error'] = str(e).split('\n')[0]
+        # keep the full traceback next to the outputs of the network
+        os.makedirs(outdir, exist_ok=True)
+        f = open(os.path.join(outdir, 'error.txt'), 'w')
+        f.write(traceback.format_exc())
+        f.close()
+    row['walltime'] = time.perf_counter() - time0
+    return row
+
+
+# Function to adjust many networks in parallel on a process pool
+# returns a list of job summaries (see runJob), in the same order as networks
+# networks: list of (name, CNTFile, MESFile) tuples from findNetworks
+# outroot: each network writes its outputs to outroot/name
+# workers (optional): number of worker processes (number of CPUs by default)
+# suppress_print (optional): set to True to suppress the progress output
+# kwargs: passed on to main (e.g. sigma0, maxit, sparse, cache). Plotting is off unless plot=True is given
+def batch(networks, outroot='batch_output', workers=None, suppress_print=False, **kwargs):
+    kwargs.setdefault('plot', False)
+    time0 = time.perf_counter()
+    rows = [None]*len(networks)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for network in networks:
+            outdir = os.path.join(outroot, network[0])
+            futures.append(pool.submit(runJob, network, outdir, kwargs))
+        for i in range(0, len(futures)):
+            try:
+                rows[i] = futures[i].result()
+            except Exception as e:  # the worker process itself died
+                name, CNTFile, MESFile = networks[i]
+                rows[i] = {'name': name, 'cnt': CNTFile, 'mes': MESFile, 'status': 'failed',
+                           'error': 'worker failed: ' + str(e), 'walltime': float('nan')}
+            if not suppress_print:
+                print(rows[i]['name'] + ': ' + rows[i]['status'])
+    total = time.perf_counter() - time0
+
+    # write summary table
+    os.makedirs(outroot, exist_ok=True)
+    out = open(os.path.join(outroot, 'summary.txt'), 'w')
+    writeSummary(rows, total, out)
+    out.close()
+    if not suppress_print:
+        writeSummary(rows, total, sys.stdout)
+    return rows
+
+
+# Function to write the summary table of a batch run
+# returns nothing
+# rows: list of job summaries from batch
+# total: total wall time of the batch in seconds
+# file: file object to output to
+def writeSummary(rows, total, file):
+    name_len = max([len(row['name']) for row in rows] + [7]) + 4
+    header = '{:' + str(name_len) + '}{:>8}{:>12}{:>12}{:>12}{:>12}{:>14}  {}\n'
+    fmt = '{:' + str(name_len) + '}{:>8}{:>12.4f}{:>12}{:>12}{:>12}{:>14}  {}\n'
+    file.write(header.format('Network', 'Status', 'Time [s]', 'Iterations', 'Converged', 'Failed Obs',
+                             'Unit Var', 'Error'))
+    for row in rows:
+        if row['status'] == 'ok':
+            file.write(fmt.format(row['name'], row['status'], row['walltime'], row['iterations'],
+                                  str(row['converged']), len(row['failed']), '{:.6g}'.format(row['unitvar']), ''))
+        else:
+            file.write(fmt.format(row['name'], row['status'], row['walltime'], '-', '-', '-', '-', row['error']))
+    ok = sum([row['status'] == 'ok' for row in rows])
+    converged = sum([row.get('converged', False) is True for row in rows])
+    file.write('\n' + str(len(rows)) + ' networks, ' + str(ok) + ' ok, ' + str(len(rows) - ok) + ' failed, '
+               + str(converged) + ' converged\nTotal Time: ' + str(total) + ' seconds\n')
+
+
+# run batch with `python batch.py dir1 dir2 ... [-o outroot] [-j workers]`
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Adjust all networks (.cnt/.mes pairs) found in the given directories')
+    parser.add_argument('paths', nargs='+', help='directories to search for networks')
+    parser.add_argument('-o', '--outroot', default='batch_output', help='directory for the outputs')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--sigma0', type=float, default=1, help='a-priori variance factor')
+    parser.add_argument('--maxit', type=int, default=100, help='maximum iterations')
+    args = parser.parse_args()
+    batch(findNetworks(args.paths), args.outroot, args.workers, sigma0=args.sigma0, maxit=args.maxit)
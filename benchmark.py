@@ -1,16 +1,264 @@
 import timeit
 import functools
 from main import *
+from synthetic import generateNetwork, GEOMETRIES
+import argparse
+import json
+import platform
+import scipy
+import subprocess
 import sys
+import time
+import tracemalloc
 
+# sizes (number of unknowns) of the default sweep
+SWEEP_SIZES = (10, 100, 1000, 10000, 100000)
+# largest number of to-scale error ellipse pages saved in the plot stage
+PLOT_PAGES = 100
+# modules whose cold-start (import) time is measured, and the number of runs the fastest time is taken from
+COLD_START_MODULES = ('main', 'plotting')
+COLD_START_RUNS = 5
 
-def benchmark(n=10000):
-    total = timeit.timeit(functools.partial(main, suppress_print=True, plot=False), setup='gc.enable()', number=n)
+
+# n: number of runs
+# cache: passed to main. Set to True to load the parsed input files from the binary cache instead of parsing them every run
+def benchmark(n=10000, cache=False):
+    total = timeit.timeit(functools.partial(main, suppress_print=True, plot=False, cache=cache), setup='gc.enable()', number=n)
     print("Total Time: " + str(total) + " seconds\nAverage Time: " + str(total/n) + " seconds")
 
 
+# Stage class
+# context manager that measures the time, or the peak memory allocated, during a stage of the adjustment
+# usage:
+#     with Stage(stages, 'solve', trace):
+#         ...
+# the time is added to stages['solve']['time'] in seconds, or the peak memory to stages['solve']['peak'] in bytes
+# if trace is True. Tracing the memory slows numpy down a lot, so the time and the memory are measured in
+# separate runs
+class Stage:
+    def __init__(self, stages, name, trace=False):
+        self.stages = stages
+        self.name = name
+        self.trace = trace
+
+    def __enter__(self):
+        if self.trace:
+            # restarting tracemalloc resets the peak, so each stage only counts its own allocations
+            tracemalloc.start()
+        self.time0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.time0
+        result = self.stages.setdefault(self.name, {})
+        if self.trace:
+            result['peak'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            result['time'] = elapsed
+
+
+# Function to run the stages of an adjustment one after the other and measure each of them
+# the stages are: parse (read the files), build (index the points and build P, A and w once), solve (the iterations),
+# statistics (variance covariance matrices, error ellipses and the observations test), report (output.out and
+# results.npz) and plot (Figures.pdf)
+# returns a dictionary with the size of the network, the results of the adjustment and the time and peak memory of
+# each stage
+# CNTFile: Filename of coordinates file
+# MESFile: Filename of measurements file
+# outdir: directory to write the outputs to
+# truthFile (optional): _truth.npz file from generateNetwork. If given, the largest error of the adjusted
+#                       coordinates is added to the results
+# plot (optional): Set to False to skip the plot stage
+# plot_pages (optional): largest number of to-scale error ellipse pages to save
+# memory (optional): Set to False to only measure the time (the stages are run a second time to measure the memory)
+def benchmarkStages(CNTFile, MESFile, outdir, truthFile='', plot=True, plot_pages=PLOT_PAGES, memory=True):
+    stages = {}
+    os.makedirs(outdir, exist_ok=True)
+    for trace in [False, True][:1 + memory]:
+        with Stage(stages, 'parse', trace):
+            CNT = readfile(CNTFile, 1)
+            MES = readfile(MESFile, 1)
+        with Stage(stages, 'build', trace):
+            points = PointRegistry(CNT)
+            x = buildx(CNT)
+            sparse = useSparse(len(MES), len(x))
+            P = buildP(MES, 1, sparse)
+            obs = ObsIndex(CNT, MES, points)
+            buildAw(CNT, MES, x, obs, sparse)
+        with Stage(stages, 'solve', trace):
+            x, A, w, delta, Nfactor, count, converged = iterate(CNT, MES, x, P, obs, sparse,
+                                                                convergenceTolerance(MES, obs, x), 100)
+        with Stage(stages, 'statistics', trace):
+            rhat = A @ delta + w
+            sigma0hat = (rhat.transpose() @ P @ rhat)[0][0]/(len(MES) - len(x))
+            cov = Covariance(Nfactor, A, P.diagonal(), sigma0hat)
+            if sparse:
+                Cxhat = cov.diagCxhat()
+                Clhat = cov.diagClhat()
+                Crhat = cov.sigma0hat / cov.p - Clhat
+            else:
+                Cxhat = cov.fullCxhat()
+                Clhat = cov.fullClhat(Cxhat)
+                Crhat = cov.fullCrhat(Clhat)
+            blocks = cov.pointBlocks()
+            semi_major, semi_minor, theta = errorEllipses(blocks)
+            testresults = sTest(rhat, Crhat)
+        with Stage(stages, 'report', trace):
+            names = CNT.name[points.unknown_rows]
+            xy = np.reshape(x, (-1, 2))
+            out = open(os.path.join(outdir, 'output.out'), 'w')
+            writeTable(out, names, [xy[:, 0], xy[:, 1]], ['%.4f']*2, np.char.str_len(CNT.name).max() + 4)
+            writeArray(out, rhat, '%+1.6E')
+            writeArray(out, MES.value[:, None] + rhat, '%12.6f')
+            writeMatrix(out, 'Cxhat', Cxhat, '%+1.4E')
+            writeMatrix(out, 'Clhat', Clhat, '%+1.4E')
+            writeMatrix(out, 'Crhat', Crhat, '%+1.4E')
+            writeTable(out, names, [semi_major, semi_minor, theta], ['%.8E', '%.8E', '%.8f'], 10)
+            writeResults(testresults, MES, out)
+            out.close()
+            writeArchive(os.path.join(outdir, 'results.npz'), {'x': x, 'rhat': rhat, 'point_blocks': blocks})
+        if plot:
+            with Stage(stages, 'plot', trace):
+                from plotting import Figure, plotCNT, drawEllipses, saveZoomPages
+                fig = Figure()
+                ax = plotCNT(CNT, x, points, ax=fig.add_subplot())
+                # the ellipses are drawn at the adjusted coordinates of the points
+                ex = xy[:, 0]
+                ey = xy[:, 1]
+                drawEllipses(ax, ex, ey, semi_major, semi_minor, theta, scale=10000)
+                k = min(plot_pages, len(names))
+                saveZoomPages(os.path.join(outdir, 'Figures.pdf'), names[:k], ex[:k], ey[:k], semi_major[:k],
+                              semi_minor[:k], theta[:k], figs=[fig])
+    results = {
+        'cnt': CNTFile, 'mes': MESFile, 'measurements': len(MES), 'unknowns': len(x), 'sparse': bool(sparse),
+        'iterations': count - 1, 'converged': converged, 'unitvar': float(sigma0hat), 'stages': stages,
+        'total': sum([s['time'] for s in stages.values()]),
+    }
+    if plot:
+        results['plot_pages'] = min(plot_pages, len(names))
+    # largest distance between the adjusted and the true coordinates
+    if truthFile != '':
+        truth = np.load(truthFile)
+        index = dict(zip(truth['names'].tolist(), range(0, len(truth['names']))))
+        rows = [index[name] for name in names.tolist()]
+        results['max_error'] = float(np.max(np.hypot(xy[:, 0] - truth['x'][rows], xy[:, 1] - truth['y'][rows])))
+    return results
+
+
+# Function to benchmark the stages of the adjustment on synthetic networks of increasing size
+# returns a dictionary with the versions, the commit and the results of benchmarkStages for each size
+# sizes (optional): list of the numbers of unknowns of the networks
+# workdir (optional): directory for the generated networks and the outputs
+# plot, plot_pages, memory (optional): see benchmarkStages
+# suppress_print (optional): set to True to suppress the progress output
+# kwargs: passed on to generateNetwork (geometry, control, angles, ...)
+def sweep(sizes=SWEEP_SIZES, workdir='benchmark_output', plot=True, plot_pages=PLOT_PAGES, memory=True,
+          suppress_print=False, **kwargs):
+    runs = []
+    for size in sizes:
+        name = os.path.join(workdir, 'network' + str(size))
+        CNTFile, MESFile, truthFile = generateNetwork(name, size, **kwargs)
+        run = benchmarkStages(CNTFile, MESFile, name, truthFile, plot, plot_pages, memory)
+        run['network'] = dict(kwargs, unknowns=size)
+        runs.append(run)
+        if not suppress_print:
+            print(str(size) + ' unknowns: ' + '  '.join([stage + ' ' + '{:.3f}'.format(s['time']) + 's'
+                                                       for stage, s in run['stages'].items()]))
+    return {
+        'date': datetime.now().isoformat(),
+        'commit': gitCommit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'cold_start': coldStart(),
+        'runs': runs,
+    }
+
+
+# Function to measure the cold-start time of the program: the time a new Python process takes to import a module
+# (e.g. every worker process of batch.py imports main). The time of a process that imports nothing is subtracted
+# returns a dictionary with the import time of each module in seconds (the fastest of runs), and the time of the
+# bare interpreter under 'interpreter'
+# modules (optional): list of module names
+# runs (optional): number of times each import is timed
+def coldStart(modules=COLD_START_MODULES, runs=COLD_START_RUNS):
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    times = {}
+    for module in ('',) + tuple(modules):
+        code = 'import ' + module if module != '' else 'pass'
+        best = float('inf')
+        for i in range(0, runs):
+            time0 = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], cwd=cwd, check=True)
+            best = min(best, time.perf_counter() - time0)
+        times[module or 'interpreter'] = best
+    for module in modules:
+        times[module] = max(times[module] - times['interpreter'], 0.0)
+    return times
+
+
+# Function to get the git commit of the program, so that benchmark results can be compared between commits
+# returns the commit hash, or '' if it is not a git repository
+def gitCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+# Function to compare the stage times of 2 benchmark result files
+# returns nothing
+# old, new: filenames of the json files written by sweep
+# file (optional): file object to output to
+def compare(old, new, file=sys.stdout):
+    old = json.load(open(old))
+    new = json.load(open(new))
+    file.write('Commits: ' + old['commit'] + ' -> ' + new['commit'] + '\n')
+    # cold-start times (sweeps from before they were measured do not have them)
+    for module, t in new.get('cold_start', {}).items():
+        if module in old.get('cold_start', {}):
+            file.write('Cold start {:<12}{:>10.4f}  {:>10.4f}\n'.format(module, old['cold_start'][module], t))
+    file.write('Unknowns  Stage          Old [s]     New [s]   Speed-up\n')
+    old_runs = {run['unknowns']: run for run in old['runs']}
+    for run in new['runs']:
+        if run['unknowns'] not in old_runs:
+            continue
+        for stage, s in run['stages'].items():
+            if stage in old_runs[run['unknowns']]['stages']:
+                t = old_runs[run['unknowns']]['stages'][stage]['time']
+                file.write('{:<10}{:<12}{:>10.4f}  {:>10.4f}  {:>8.2f}x\n'.format(run['unknowns'], stage, t, s['time'],
+                                                                             t/max(s['time'], 1e-12)))
+
+
+# run the sample network n times with `python benchmark.py n`, the size sweep with
+# `python benchmark.py --sweep [sizes] [-o results.json]`, compare 2 sweeps with `python benchmark.py --compare a b`,
+# or measure the cold-start time with `python benchmark.py --cold-start`
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        benchmark()
+    parser = argparse.ArgumentParser(description='Benchmark the adjustment')
+    parser.add_argument('n', nargs='?', type=int, default=10000, help='number of runs of the sample network')
+    parser.add_argument('--sweep', nargs='*', type=int, default=None, help='numbers of unknowns of the sweep')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='json file for the sweep results')
+    parser.add_argument('--workdir', default='benchmark_output', help='directory for the networks of the sweep')
+    parser.add_argument('--geometry', choices=GEOMETRIES, default='grid', help='geometry of the networks')
+    parser.add_argument('--control', type=float, default=0.1, help='fraction of control points')
+    parser.add_argument('--angles', type=float, default=0.5, help='fraction of angle measurements')
+    parser.add_argument('--no-plot', action='store_true', help='skip the plot stage')
+    parser.add_argument('--no-memory', action='store_true', help='only measure the time of the stages')
+    parser.add_argument('--compare', nargs=2, default=None, help='compare 2 json files of sweep results')
+    parser.add_argument('--cold-start', action='store_true', help='measure the import time of the modules')
+    args = parser.parse_args()
+    if args.cold_start:
+        for module, t in coldStart().items():
+            print('{:<12}{:>8.4f} s'.format(module, t))
+    elif args.compare is not None:
+        compare(*args.compare)
+    elif args.sweep is not None:
+        results = sweep(args.sweep or SWEEP_SIZES, args.workdir, not args.no_plot, memory=not args.no_memory,
+                        geometry=args.geometry, control=args.control, angles=args.angles)
+        f = open(args.output, 'w')
+        json.dump(results, f, indent=1)
+        f.close()
     else:
-        benchmark(int(sys.argv[1]))
+        benchmark(args.n)
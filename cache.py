@@ -0,0 +1,124 @@
+from functions import *
+import hashlib
+import shutil
+import tempfile
+
+# name of the cache directory that is made next to the input files when no directory is given
+CACHE_DIR = '.lscache'
+# the cache directory is kept below this many bytes by removing the least recently used tables
+CACHE_SIZE = 1 << 30
+
+
+# Function to read a .cnt or .mes file through a binary cache of the parsed table
+# the table is stored as one .npy file per column, keyed by the hash of the file contents, header_lines and
+# PARSER_VERSION, and loaded with memory mapping. A changed file has a different hash, so it is parsed again
+# returns a CNTTable or MESTable (like readfile)
+# Filesname: name of file including extension
+# header_lines: number of lines that the header takes up (will be skipped)
+# cache_dir (optional): directory to keep the cache in. By default CACHE_DIR next to the file is used
+# max_bytes (optional): maximum size of the cache directory in bytes
+def cachedReadfile(filename, header_lines, cache_dir='', max_bytes=CACHE_SIZE):
+    filetype = fileType(filename)
+    if filetype == 'txt':  # nothing to cache
+        return readfile(filename, header_lines)
+    if filetype == 'cnt':
+        table = CNTTable
+    else:
+        table = MESTable
+    if cache_dir == '':
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(filename)), CACHE_DIR)
+    entry = os.path.join(cache_dir, fileKey(filename, header_lines))
+
+    # load from cache
+    if os.path.isdir(entry):
+        try:
+            columns = [np.load(os.path.join(entry, name + '.npy'), mmap_mode='r') for name in table.COLUMNS]
+            os.utime(entry)  # mark as recently used
+            return table(*columns)
+        except (OSError, ValueError):  # incomplete or damaged entry, parse the file again
+            shutil.rmtree(entry, ignore_errors=True)
+
+    # parse file and save the columns
+    output = readfile(filename, header_lines)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp')
+    try:
+        for name in table.COLUMNS:
+            np.save(os.path.join(tmp, name + '.npy'), getattr(output, name))
+        os.rename(tmp, entry)  # only complete entries become visible
+    except OSError:  # e.g. another process saved the same file at the same time
+        shutil.rmtree(tmp, ignore_errors=True)
+    evictCache(cache_dir, max_bytes)
+    return output
+
+
+# Function to get the cache key of a .cnt or .mes file
+# returns the key as a hex string
+# Filesname: name of file including extension
+# header_lines: number of lines that the header takes up
+def fileKey(filename, header_lines):
+    h = hashlib.sha256()
+    h.update(('v' + str(PARSER_VERSION) + ' h' + str(header_lines) + ' ' + fileType(filename) + '\n').encode())
+    f = open(filename, 'rb')
+    chunk = f.read(CHUNK_SIZE)
+    while chunk:
+        h.update(chunk)
+        chunk = f.read(CHUNK_SIZE)
+    f.close()
+    return h.hexdigest()
+
+
+# Function to remove the least recently used tables until the cache directory is small enough
+# returns nothing
+# cache_dir: cache directory
+# max_bytes: maximum size of the cache directory in bytes
+def evictCache(cache_dir, max_bytes=CACHE_SIZE):
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if name.startswith('.') or not os.path.isdir(entry):
+            continue
+        size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+        entries.append((os.path.getmtime(entry), size, entry))
+        total = total + size
+    # oldest first
+    entries.sort()
+    for mtime, size, entry in entries:
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total = total - size
+
+
+# Function to get the fill-reducing order of the unknowns through the cache (see unknownOrdering in functions.py)
+# the order is stored by the topology of the network, so it is reused by every run of a network whose points are
+# measured together in the same way, even if the measured values or coordinates changed
+# returns a numpy array with the unknowns in the order they are eliminated
+# obs: ObsIndex of CNT and MES
+# u: number of unknowns
+# cache_dir: cache directory
+# max_bytes (optional): maximum size of the cache directory in bytes
+def cachedOrdering(obs, u, cache_dir, max_bytes=CACHE_SIZE):
+    edges = obs.unknownEdges()
+    key = topologyKey(edges, u)
+    if key in ORDERINGS:
+        return ORDERINGS[key]
+    entry = os.path.join(cache_dir, 'order-' + key)
+    if os.path.isdir(entry):
+        try:
+            ORDERINGS[key] = np.load(os.path.join(entry, 'perm.npy'))
+            os.utime(entry)  # mark as recently used
+            return ORDERINGS[key]
+        except (OSError, ValueError):  # damaged entry, find the order again
+            shutil.rmtree(entry, ignore_errors=True)
+    perm = unknownOrdering(obs, u)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp')
+    try:
+        np.save(os.path.join(tmp, 'perm.npy'), perm)
+        os.rename(tmp, entry)  # only complete entries become visible
+    except OSError:  # e.g. another process saved the same order at the same time
+        shutil.rmtree(tmp, ignore_errors=True)
+    evictCache(cache_dir, max_bytes)
+    return perm
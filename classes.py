@@ -1,6 +1,14 @@
+import numpy as np
+# measurement types, their type codes used in MESTable.type and the codes of angles and distances (see obstypes.py)
+from obstypes import OBSERVATION_TYPES, ANGLE, DIST, typeCode
+
+
 # Point class
 # stores all info about a point from a row of CNT
+# Points are small records that are only built when needed (e.g. by CNTTable[i])
 class Point:
+    __slots__ = ('name', 'type', 'x', 'y')
+
     # constructor: pass list of [name, type, x, y]
     def __init__(self, list):
         try:
@@ -11,6 +19,13 @@ class Point:
         except:
             raise Exception()
 
+    # allows P[0] ... P[3] like the rows of CNT used to be
+    def __getitem__(self, i):
+        return (self.name, self.type, self.x, self.y)[i]
+
+    def __len__(self):
+        return 4
+
     # Function to check if this point in an unknown
     def isUnknown(self):
         if self.type == 'U' or self.type == 'u':
@@ -19,16 +34,18 @@ class Point:
             return False
 
     # Function to check which unknown this is
+    # CNT: CNTTable of the coordinates.cnt file, or a PointRegistry of it (O(1) lookup)
     def unknownNum(self, CNT):
         # if self is not an unknown
         if not self.isUnknown():
             # give error
             exception_text = "Point '" + self.name + "' is not an unknown"
             raise Exception(exception_text)
+        if isinstance(CNT, PointRegistry):
+            return CNT.col(self.name) // 2
         # loop through CNT and count unknowns until self is reached
         count = 0
-        for point in CNT:  # for all points in CNT
-            P = Point(point)
+        for P in CNT:  # for all points in CNT
             if P.name == self.name:  # if point is reached in CNT
                 return count # return the count of unknowns
             elif P.isUnknown(): # if point in CNT is an unknown
@@ -37,4 +54,286 @@ class Point:
         # if all points in CNT were looped through and self was not found
         # error
         exception_text = "Point '" + self.name + "' can not be found in CNT"
-        raise Exception(exception_text)
\ No newline at end of file
+        raise Exception(exception_text)
+
+
+# CNTTable class
+# stores the coordinates from a .cnt file as typed numpy columns (one element per point)
+class CNTTable:
+    # names of the columns that are read from the file, in the order the constructor takes them
+    COLUMNS = ('name', 'type', 'x', 'y')
+
+    # constructor: pass the columns of the .cnt file as lists or numpy arrays
+    # name: point names
+    # type: point types ('C' for control points, 'U' for unknowns)
+    # x, y: initial coordinates in meters
+    def __init__(self, name, type, x, y):
+        self.name = np.asarray(name, dtype=str)
+        self.type = np.asarray(type, dtype=str)
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        # True for unknown points
+        self.unknown = (self.type == 'U') | (self.type == 'u')
+
+    def __len__(self):
+        return len(self.name)
+
+    # CNT[i] gives row i as a Point
+    def __getitem__(self, i):
+        return Point((str(self.name[i]), str(self.type[i]), float(self.x[i]), float(self.y[i])))
+
+    def __iter__(self):
+        for i in range(0, len(self)):
+            yield self[i]
+
+    # Function to join tables (e.g. the batches from readbatches) into one table
+    # returns a CNTTable
+    # tables: list of CNTTables
+    @staticmethod
+    def concat(tables):
+        if not tables:
+            return CNTTable([], [], [], [])
+        return CNTTable(np.concatenate([t.name for t in tables]), np.concatenate([t.type for t in tables]),
+                        np.concatenate([t.x for t in tables]), np.concatenate([t.y for t in tables]))
+
+
+# MESTable class
+# stores the measurements from a .mes file as typed numpy columns (one element per measurement)
+class MESTable:
+    # names of the columns that are read from the file, in the order the constructor takes them
+    COLUMNS = ('id', 'info', 'type', 'value', 'std')
+
+    # constructor: pass the columns of the .mes file as lists or numpy arrays
+    # id: measurement IDs
+    # info: measurement info (A_P1_B for angles, P1_A for distances)
+    # type: measurement type codes (see obstypes.py, -1 for an unknown type)
+    # value: measurements in radians and meters
+    # std: standard deviations in radians and meters
+    def __init__(self, id, info, type, value, std):
+        self.id = np.asarray(id, dtype=str)
+        self.info = np.asarray(info, dtype=str)
+        self.type = np.asarray(type, dtype=np.int8)
+        self.value = np.asarray(value, dtype=float)
+        self.std = np.asarray(std, dtype=float)
+        # rows in CNT of the points referenced by each measurement (-1 if unused), set by link()
+        self.pts = None
+        self.points = None  # PointRegistry used by link()
+
+    def __len__(self):
+        return len(self.id)
+
+    # MES[i] gives row i as a tuple of (ID, Info, Type, Value, Std)
+    def __getitem__(self, i):
+        return (str(self.id[i]), str(self.info[i]), self.typeName(i), float(self.value[i]), float(self.std[i]))
+
+    # Function to join tables (e.g. the batches from readbatches) into one table
+    # returns a MESTable
+    # tables: list of MESTables
+    @staticmethod
+    def concat(tables):
+        if not tables:
+            return MESTable([], [], [], [], [])
+        return MESTable(np.concatenate([t.id for t in tables]), np.concatenate([t.info for t in tables]),
+                        np.concatenate([t.type for t in tables]), np.concatenate([t.value for t in tables]),
+                        np.concatenate([t.std for t in tables]))
+
+    # Function to get some of the measurements as a new table (e.g. without the measurements removed by data snooping)
+    # returns a MESTable
+    # rows: numpy array of row numbers or a boolean mask
+    def take(self, rows):
+        return MESTable(self.id[rows], self.info[rows], self.type[rows], self.value[rows], self.std[rows])
+
+    # Function to get the type code of a measurement type name as used in .mes files
+    # returns the type code, or -1 if the name is not a valid measurement type
+    @staticmethod
+    def typeCode(name):
+        return typeCode(name)
+
+    # Function to get the name of the type of measurement i
+    def typeName(self, i):
+        code = self.type[i]
+        if code < 0:
+            return 'Invalid'
+        return OBSERVATION_TYPES[code].name
+
+    # Function to parse the point references of every measurement into the pts column
+    # points: PointRegistry of CNT
+    def link(self, points):
+        n = len(self)
+        pts = -np.ones([n, max([t.points for t in OBSERVATION_TYPES])], dtype=int)
+        info = np.asarray(self.info, dtype=str)
+        invalid = self.type < 0
+        # number of point names in Info (separated by '_') of every measurement
+        expected = np.array([t.points for t in OBSERVATION_TYPES] + [0])[self.type]
+        counts = np.array([name.count('_') + 1 for name in info.tolist()], dtype=int)
+        wrong = ~invalid & (counts != expected)
+        # the names of all measurements of a type at once, each different name is only looked up once
+        for code in np.unique(self.type[~invalid]):
+            k = OBSERVATION_TYPES[code].points
+            group = np.flatnonzero((self.type == code) & ~wrong)
+            names, inverse = np.unique(np.array('_'.join(info[group].tolist()).split('_')), return_inverse=True)
+            found = np.array([points.rows.get(name, -1) for name in names.tolist()], dtype=int)
+            pts[group, 0:k] = found[inverse].reshape(-1, k)
+        missing = ~invalid & ~wrong & np.any((pts < 0) & (np.arange(pts.shape[1]) < expected[:, None]), axis=1)
+        # the first measurement with an error (in the order of the file) gives the error
+        bad = np.flatnonzero(invalid | wrong | missing)
+        if len(bad) > 0:
+            i = bad[0]
+            if invalid[i]:
+                exception_text = "Invalid measurement type for ID = " + str(self.id[i])
+                raise Exception(exception_text)
+            if wrong[i]:
+                exception_text = "Could not parse measurement info for ID = " + str(self.id[i])
+                raise Exception(exception_text)
+            for name in info[i].split('_'):
+                points.row(name)  # gives the error for a missing point
+        self.pts = pts
+        self.points = points
+
+
+# PointRegistry class
+# index of all points in CNT, built once after reading the .cnt file
+# gives the row in CNT, the control/unknown status and the column in x of a point by name in O(1)
+class PointRegistry:
+    # constructor: pass CNT (CNTTable from readfile)
+    # gives an error if a point name is used more than once
+    def __init__(self, CNT):
+        self.CNT = CNT
+        self.rows = {}  # point name -> row in CNT
+        names = CNT.name.tolist()
+        for r in range(0, len(names)):
+            name = names[r]
+            if name in self.rows:
+                exception_text = ("Point '" + name + "' is defined more than once in CNT (rows "
+                                  + str(self.rows[name] + 1) + " and " + str(r + 1) + ")")
+                raise Exception(exception_text)
+            self.rows[name] = r
+        # rows of the unknown points in CNT, in the order they appear in x
+        self.unknown_rows = np.flatnonzero(CNT.unknown)
+        # column of each CNT row in x and A (-1 for control points)
+        self.cols = -np.ones(len(CNT), dtype=int)
+        self.cols[self.unknown_rows] = 2*np.arange(len(self.unknown_rows))
+        # initial (x,y) of every point in CNT
+        self.xy = np.column_stack([CNT.x, CNT.y])
+
+    def __len__(self):
+        return len(self.CNT)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    # Function to get the row of a point in CNT
+    # name: name of point in Point column of CNT
+    def row(self, name):
+        try:
+            return self.rows[name]
+        except KeyError:  # if point could not be found
+            exception_text = "Could not find point '" + name + "' in CNT"
+            raise Exception(exception_text)
+
+    # Function to check if a point is an unknown
+    # name: name of point in Point column of CNT
+    def isUnknown(self, name):
+        return self.cols[self.row(name)] >= 0
+
+    # Function to get the index of the x coordinate of an unknown point in x (the y coordinate follows it)
+    # name: name of point in Point column of CNT
+    def col(self, name):
+        col = self.cols[self.row(name)]
+        if col < 0:
+            exception_text = "Point '" + name + "' is not an unknown"
+            raise Exception(exception_text)
+        return int(col)
+
+    # Function to get a Point object
+    # name: name of point in Point column of CNT
+    # x (optional): numpy array with current values of unknowns. If given, the (x,y) of an unknown
+    #               point are taken from x instead of CNT
+    def point(self, name, x=None):
+        r = self.row(name)
+        P = self.CNT[r]
+        if x is not None and self.cols[r] >= 0:
+            P.x = x[self.cols[r]]
+            P.y = x[self.cols[r] + 1]
+        return P
+
+    # Function to get the current (x,y) of every point in CNT
+    # returns a (number of points)x2 numpy array
+    # x: numpy array containing current values of unknowns
+    def coordinates(self, x):
+        xy = self.xy.copy()
+        xy[self.unknown_rows] = np.reshape(x, (-1, 2))
+        return xy
+
+
+# ObsIndex class
+# stores the point references of every measurement in MES as integer index arrays, grouped by measurement type, so
+# that buildAw can compute all rows of a type at once
+class ObsIndex:
+    # constructor: pass CNT and MES (CNTTable and MESTable from readfile)
+    # points (optional): PointRegistry of CNT. It is built from CNT if not given
+    def __init__(self, CNT, MES, points=None):
+        if points is None:
+            points = PointRegistry(CNT)
+        self.points = points
+        self.cols = points.cols
+        # parse the point references of each measurement once
+        if MES.points is not points:
+            MES.link(points)
+        self.n = len(MES)
+        self.values = MES.value
+        self.std = MES.std
+        # (type code, rows in A, CNT rows of the points of each row in the order of Info) of each type in MES
+        self.groups = []
+        for code in range(0, len(OBSERVATION_TYPES)):
+            rows = np.flatnonzero(MES.type == code)
+            if len(rows) > 0:
+                self.groups.append((code, rows, MES.pts[rows, 0:OBSERVATION_TYPES[code].points]))
+        # direction set of every measurement of an oriented type (-1 for the others), 1 set per type and first point.
+        # The orientation of each set is eliminated from the adjustment (see buildAw)
+        self.orientation = -np.ones(self.n, dtype=int)
+        for code, rows, pts in self.groups:
+            if OBSERVATION_TYPES[code].oriented:
+                self.orientation[rows] = code*len(points) + pts[:, 0]
+        oriented = self.orientation >= 0
+        keys, self.orientation[oriented] = np.unique(self.orientation[oriented], return_inverse=True)
+        # number of eliminated orientation unknowns
+        self.orientations = len(keys)
+
+    # Function to get the current (x,y) of every point in CNT
+    # returns a (number of points)x2 numpy array
+    # x: numpy array containing current values of unknowns
+    def coordinates(self, x):
+        return self.points.coordinates(x)
+
+    # Function to get the rows of the measurements of a type
+    # returns a numpy int array of rows in A
+    # code: type code (see obstypes.py)
+    def rows(self, code):
+        for c, rows, pts in self.groups:
+            if c == code:
+                return rows
+        return np.zeros(0, dtype=int)
+
+    # Function to get the pairs of unknown points that are measured together (the connections of the network)
+    # returns a kx2 numpy int array of unknown point numbers (the column of the point in x divided by 2)
+    def unknownEdges(self):
+        pairs = [np.zeros((0, 2), dtype=int)]
+        for code, rows, pts in self.groups:
+            for a in range(0, pts.shape[1]):
+                for b in range(a + 1, pts.shape[1]):
+                    pairs.append(np.column_stack([pts[:, a], pts[:, b]]))
+            # all directions of a set share their orientation, so the points they are measured to are connected too
+            if OBSERVATION_TYPES[code].oriented:
+                order = np.argsort(self.orientation[rows], kind='stable')
+                sets = self.orientation[rows][order]
+                targets = pts[order, 1]
+                last = np.searchsorted(sets, sets, side='right')
+                for step in range(1, int(np.max(last - np.arange(len(sets))))):
+                    other = np.arange(len(sets)) + step
+                    ok = other < last
+                    pairs.append(np.column_stack([targets[ok], targets[other[ok]]]))
+        cols = self.cols[np.concatenate(pairs)]
+        # only pairs of 2 different unknown points
+        keep = (cols[:, 0] >= 0) & (cols[:, 1] >= 0) & (cols[:, 0] != cols[:, 1])
+        return np.unique(np.sort(cols[keep] // 2, axis=1), axis=0)
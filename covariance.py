@@ -0,0 +1,140 @@
+import numpy as np
+import scipy.sparse as sp
+
+
+# Covariance class
+# gives the parts of the variance covariance matrices of the adjustment that are needed, when they are needed:
+#     Cxhat = sigma0hat * inv(N)
+#     Clhat = A @ Cxhat @ At
+#     Crhat = sigma0hat * inv(P) - Clhat
+# When direction sets are in the adjustment, A has the orientations eliminated (see orientationCentring in
+# functions.py) and Clhat also gets the variance of the orientation of each set, sigma0hat / (sum of its weights)
+# The diagonals and the 2x2 blocks of the points come from the selected inverse of N (see Factor.selectedInverse
+# in solver.py), so the full uxu and nxn matrices are only formed when they are asked for with full*()
+class Covariance:
+    # constructor
+    # Nfactor: Factor of the normal matrix N (see solver.py)
+    # A: nxu design matrix (numpy or scipy.sparse)
+    # p: numpy array with the n weights (diagonal of P)
+    # sigma0hat: posteriori variance factor
+    # sets (optional): numpy int array of the direction set of each measurement (-1 if it is not in a set, see
+    #                  ObsIndex.orientation)
+    def __init__(self, Nfactor, A, p, sigma0hat, sets=None):
+        self.Nfactor = Nfactor
+        self.A = A
+        self.p = np.ravel(p)
+        self.sigma0hat = sigma0hat
+        self.sets = sets
+        self.Z = None  # selected inverse of N, made by the first function that needs it
+
+    # Function to get elements of inv(N)
+    # returns a numpy array with inv(N)[rows[i], cols[i]] for each i
+    # rows, cols: numpy arrays of row and column numbers. Each pair must be 2 unknowns that share a measurement
+    #             (or the same point), otherwise 0 is returned for sparse factors
+    def entries(self, rows, cols):
+        if self.Z is None:
+            self.Z = self.Nfactor.selectedInverse()
+        if sp.issparse(self.Z):
+            return np.asarray(self.Z[rows, cols]).ravel()
+        return self.Z[rows, cols]
+
+    # Function to get the diagonal of Cxhat (variances of the unknowns)
+    # returns a numpy array of length u
+    def diagCxhat(self):
+        u = self.Nfactor.u
+        return self.sigma0hat * self.entries(np.arange(u), np.arange(u))
+
+    # Function to get the 2x2 blocks of Cxhat of all unknown points (used for the error ellipses)
+    # returns a (u/2)x2x2 numpy array, block k belongs to unknowns 2k and 2k+1
+    def pointBlocks(self):
+        k = np.arange(0, self.Nfactor.u, 2)
+        rows = np.stack([k, k, k + 1, k + 1], axis=1).ravel()
+        cols = np.stack([k, k + 1, k, k + 1], axis=1).ravel()
+        return (self.sigma0hat * self.entries(rows, cols)).reshape(-1, 2, 2)
+
+    # Function to get the diagonal of Clhat (variances of the corrected measurements)
+    # Clhat[i][i] only needs the elements of inv(N) between the unknowns of measurement i
+    # returns a numpy array of length n
+    # chunk (optional): number of measurements handled at once
+    def diagClhat(self, chunk=100000):
+        A = sp.csr_matrix(self.A)
+        n = A.shape[0]
+        d = np.zeros(n)
+        for start in range(0, n, chunk):
+            Ablk = A[start:start + chunk]
+            # the non-zero elements of each row of A, padded with zeros to the longest row
+            counts = np.diff(Ablk.indptr)
+            width = max(counts.max(), 1) if len(counts) > 0 else 1
+            slot = np.arange(Ablk.nnz) - np.repeat(Ablk.indptr[:-1], counts)
+            row = np.repeat(np.arange(len(counts)), counts)
+            cols = np.zeros((len(counts), width), dtype=int)
+            vals = np.zeros((len(counts), width))
+            cols[row, slot] = Ablk.indices
+            vals[row, slot] = Ablk.data
+            # sum of A[i, a]*A[i, b]*inv(N)[a, b] over all pairs of non-zero elements a, b of row i
+            Nab = self.entries(np.repeat(cols, width, axis=1).ravel(), np.tile(cols, (1, width)).ravel())
+            prod = (vals[:, :, None] * vals[:, None, :]).reshape(len(counts), -1)
+            d[start:start + chunk] = np.sum(prod * Nab.reshape(len(counts), -1), axis=1)
+        rows, sets, s = self.orientationWeights()
+        d[rows] = d[rows] + 1/s[sets]
+        return self.sigma0hat * d
+
+    # Function to get the Covariance of other measurements of the same adjustment (e.g. the next batch of a streamed
+    # .mes file, see streaming.py). The selected inverse of N is shared, so it is only found once
+    # returns a Covariance
+    # A: design matrix of the measurements
+    # p: numpy array with their weights
+    # sets (optional): their direction sets (see __init__)
+    def measurements(self, A, p, sets=None):
+        if self.Z is None:
+            self.Z = self.Nfactor.selectedInverse()
+        cov = Covariance(self.Nfactor, A, p, self.sigma0hat, sets)
+        cov.Z = self.Z
+        return cov
+
+    # Function to get the measurements in direction sets and the sum of the weights of each set
+    # returns rows, sets, s: the rows of the measurements in sets, the set of each of them (numbered from 0) and the
+    #         sum of the weights of each set
+    def orientationWeights(self):
+        if self.sets is None:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+        rows = np.flatnonzero(self.sets >= 0)
+        _, sets = np.unique(self.sets[rows], return_inverse=True)
+        return rows, sets, np.bincount(sets, weights=self.p[rows])
+
+    # Function to get the diagonal of Crhat (variances of the residuals)
+    # returns a numpy array of length n
+    def diagCrhat(self):
+        return self.sigma0hat / self.p - self.diagClhat()
+
+    # Function to get a chosen sub-block of Cxhat
+    # returns a kxk numpy array
+    # cols: list of k unknown numbers (e.g. [2*i, 2*i+1, 2*j, 2*j+1] for the covariance of points i and j)
+    def subCxhat(self, cols):
+        cols = np.asarray(cols, dtype=int)
+        E = np.zeros((self.Nfactor.u, len(cols)))
+        E[cols, np.arange(len(cols))] = 1
+        return self.sigma0hat * self.Nfactor.solve(E)[cols]
+
+    # Function to get the full uxu Cxhat
+    def fullCxhat(self):
+        return self.sigma0hat * self.Nfactor.inverse()
+
+    # Function to get the full nxn Clhat
+    # Cxhat (optional): full Cxhat if it was already made
+    def fullClhat(self, Cxhat=None):
+        if Cxhat is None:
+            Cxhat = self.fullCxhat()
+        Clhat = np.asarray(self.A @ Cxhat @ self.A.transpose())
+        # variances of the orientations, for every pair of measurements of the same set
+        rows, sets, s = self.orientationWeights()
+        same = sets[:, None] == sets[None, :]
+        Clhat[np.ix_(rows, rows)] = Clhat[np.ix_(rows, rows)] + self.sigma0hat*same/s[sets][:, None]
+        return Clhat
+
+    # Function to get the full nxn Crhat
+    # Clhat (optional): full Clhat if it was already made
+    def fullCrhat(self, Clhat=None):
+        if Clhat is None:
+            Clhat = self.fullClhat()
+        return self.sigma0hat * np.diag(1 / self.p) - Clhat
@@ -1,17 +1,76 @@
 from classes import *
 import numpy as np
+import scipy.sparse as sp
 import math
-import matplotlib.pyplot as plt
-import matplotlib.patches as pat
-from matplotlib.backends.backend_pdf import PdfPages
-from matplotlib.lines import Line2D
+from solver import Factor, fillReducingOrder
+from instrument import NULL_INSTRUMENT
 import os
+import hashlib
+
+# dense A and P are used up to this many elements in total (about 32 MB), sparse matrices above it
+SPARSE_THRESHOLD = 4000000
+
+# .cnt and .mes files are read in blocks of this many characters
+CHUNK_SIZE = 1048576
+# version of the .cnt/.mes parser. Increase it whenever readfile gives different tables for the same
+# text, so that cached tables (see cache.py) are not used anymore
+PARSER_VERSION = 2
+# the iterations converge when no coordinate changes by more than this fraction of the smallest position change
+# a measurement can detect (see convergenceTolerance)
+CONVERGENCE_FRACTION = 0.1
+# the iterations also converge when the weighted sum of squared misclosures changes by less than this fraction
+OMEGA_TOLERANCE = 1e-10
+# largest number of times a step is halved by the line search of iterate
+MAX_STEP_HALVINGS = 10
+# fill-reducing orders of the unknowns found in this process, keyed by the topology of the network
+# (see unknownOrdering), and the largest number kept
+ORDERINGS = {}
+MAX_ORDERINGS = 16
 
 # Function to read in text files for this project
-# returns either a string (for .txt files) or a 2D list (for .cnt or .mes files)
+# returns either a string (for .txt files), a CNTTable (for .cnt files) or a MESTable (for .mes files)
 # Filesname: name of file including extension
 # header_lines: number of lines that the header takes up (will be skipped)
 def readfile(filename, header_lines):
+    filetype = fileType(filename)
+
+    # if file is a regular txt file, just pass the raw text as a string
+    if filetype == 'txt':
+        f = open(filename, "r")
+        output = f.read()
+        f.close()
+    # if file is of one of the other types, parse it batch by batch and join the batches
+    else:
+        batches = list(readbatches(filename, header_lines))
+        if filetype == 'cnt':
+            output = CNTTable.concat(batches)
+        else:
+            output = MESTable.concat(batches)
+
+    return output
+
+
+# Function to read a .cnt or .mes file that is given as text instead of a file name (e.g. sent to server.py)
+# returns a CNTTable or MESTable
+# text: contents of the file
+# header_lines: number of lines that the header takes up (will be skipped)
+# filetype: 'cnt' or 'mes'
+# filename (optional): name used in error messages
+def readtext(text, header_lines, filetype, filename='<text>'):
+    if filetype not in ('cnt', 'mes'):
+        raise Exception("Only .cnt and .mes files can be read from text")
+    lines = text.split('\n', header_lines)
+    if len(lines) <= header_lines:
+        text = ''
+    else:
+        text = lines[header_lines]
+    return parseLines(text.rstrip('\n'), header_lines, filename, filetype)
+
+
+# Function to check the extension of a file
+# returns the extension ('txt', 'mes' or 'cnt')
+# Filesname: name of file including extension
+def fileType(filename):
     # acceptable file extensions
     ext = ['txt', 'mes', 'cnt']
     # get file extension
@@ -23,232 +82,466 @@ def readfile(filename, header_lines):
         for i in ext:
             exception_text = exception_text + "\n." + i
         raise Exception(exception_text)
-    # save file extension
-    filetype = tmp[-1]
+    return tmp[-1]
 
-    # read in file
+
+# Function to read a .cnt or .mes file in fixed-size chunks
+# yields (linenum, text) where text is a block of complete lines (without the last newline) and
+# linenum is the line number of the line before the first line in text (header lines are skipped)
+# Filesname: name of file including extension
+# header_lines: number of lines that the header takes up
+# chunk_size (optional): number of characters read at once
+def readchunks(filename, header_lines, chunk_size=CHUNK_SIZE):
+    linenum = 0  # keep track of which line we're on
+    rest = ''  # incomplete last line of the previous chunk
     f = open(filename, "r")
-    text = f.read()
+    while True:
+        chunk = f.read(chunk_size)
+        text = rest + chunk
+        if chunk:
+            # the last line may continue in the next chunk
+            end = text.rfind('\n')
+            if end < 0:
+                rest = text
+                continue
+            rest = text[end + 1:]
+            text = text[:end]
+        # skip header lines
+        if linenum < header_lines:
+            nlines = text.count('\n') + 1
+            skip = min(header_lines - linenum, nlines)
+            linenum = linenum + skip
+            if skip < nlines:
+                text = text.split('\n', skip)[skip]
+            else:
+                text = None
+        if text is not None:
+            yield linenum, text
+            linenum = linenum + text.count('\n') + 1
+        if not chunk:  # end of file
+            break
     f.close()
-    # object that will be returned
-    output = []
 
-    # if file is a regular txt file, just pass the raw text as a string
+
+# Function to read a .cnt or .mes file as a stream of tables
+# yields a CNTTable or MESTable for each chunk of the file (see readchunks), so large files can be
+# processed in bounded memory
+# Filesname: name of file including extension
+# header_lines: number of lines that the header takes up (will be skipped)
+# chunk_size (optional): number of characters read at once
+def readbatches(filename, header_lines, chunk_size=CHUNK_SIZE):
+    filetype = fileType(filename)
     if filetype == 'txt':
-        output = text
-    # if file is of one of the other types
-    else:
-        # split by line
-        lines = text.split('\n')
-        # loop through each line, ignoring headers
-        linenum = header_lines  # keep track of which line we're on
-        for line in lines[header_lines:]:
+        raise Exception("Only .cnt and .mes files can be read in batches")
+    for linenum, text in readchunks(filename, header_lines, chunk_size):
+        yield parseLines(text, linenum, filename, filetype)
+
+
+# Function to convert one row of a .cnt or .mes file to the proper types
+# returns the row as a list
+# elements: list of the tab separated elements of the row
+# filetype: 'cnt' or 'mes'
+def parseRow(elements, filetype):
+    # for cnt files
+    if filetype == 'cnt':
+        # cnt files should have 4 elements per row
+        if len(elements) != 4:
+            raise Exception()
+        return [elements[0], elements[1], float(elements[2]), float(elements[3])]
+    # for mes files
+    # mes files should have 5 elements per row
+    if len(elements) != 5:
+        raise Exception()
+    value = elements[3]
+    std = float(elements[4])
+    code = MESTable.typeCode(elements[2])
+    # convert the value and standard deviation as the type asks (e.g. DMS to radians for angles)
+    if code >= 0:
+        value, std = OBSERVATION_TYPES[code].parse([value], np.array([std]))
+        return [elements[0], elements[1], code, float(value[0]), float(std[0])]
+    return [elements[0], elements[1], code, float(value), std]
+
+
+# Function to split lines of text into columns when every line has the same number of fields
+# returns a list of ncols columns (lists of strings), or None if any line has a different number of fields
+# text: lines separated by newlines
+# ncols: number of fields per line
+# sep (optional): field separator (a single character)
+def splitFields(text, ncols, sep='\t'):
+    nlines = text.count('\n') + 1
+    fields = text.replace('\n', sep).split(sep)
+    if len(fields) != nlines*ncols:
+        return None
+    # the total is right, now check that every line has ncols-1 separators
+    if nlines > 1:
+        data = np.frombuffer(text.encode(), dtype=np.uint8)
+        newlines = np.flatnonzero(data == ord('\n'))
+        line = np.searchsorted(newlines, np.flatnonzero(data == ord(sep)))
+        if np.any(np.bincount(line, minlength=nlines) != ncols - 1):
+            return None
+    return [fields[k::ncols] for k in range(0, ncols)]
+
+
+# Function to convert a batch of lines of a .cnt or .mes file to a table
+# returns a CNTTable or MESTable
+# text: lines separated by newlines (empty lines are skipped)
+# linenum: line number of the line before the first line in text (used in error messages)
+# Filesname: name of file (used in error messages)
+# filetype: 'cnt' or 'mes'
+def parseLines(text, linenum, filename, filetype):
+    ncols = 4
+    if filetype == 'mes':
+        ncols = 5
+    try:
+        columns = None
+        if text and '\n\n' not in text:
+            # fast path: split the whole batch at once
+            columns = splitFields(text.strip('\n'), ncols)
+        if columns is None:
+            # split line by line, skipping empty lines
+            rows = [line.split('\t') for line in text.split('\n') if line]
+            # every row should have ncols elements
+            if any(len(row) != ncols for row in rows):
+                raise ValueError()
+            columns = [list(col) for col in zip(*rows)]
+            if not columns:
+                columns = [[] for i in range(0, ncols)]
+
+        if filetype == 'cnt':
+            return CNTTable(columns[0], columns[1], np.array(columns[2], dtype=float),
+                            np.array(columns[3], dtype=float))
+
+        types = np.array(columns[2])
+        type = np.full(len(types), -1, dtype=np.int8)
+        std = np.array(columns[4], dtype=float)
+        value = np.zeros(len(types))
+        values = columns[3]
+        # convert the values of each type as the type asks (all rows of the type at once, e.g. DMS to radians)
+        for code in range(0, len(OBSERVATION_TYPES)):
+            rows = np.flatnonzero(types == OBSERVATION_TYPES[code].name)
+            if len(rows) > 0:
+                type[rows] = code
+                value[rows], std[rows] = OBSERVATION_TYPES[code].parse([values[i] for i in rows], std[rows])
+        # measurements of unknown types (they are rejected when they are linked to the points)
+        other = np.flatnonzero(type < 0)
+        value[other] = np.array([values[i] for i in other], dtype=float)
+        return MESTable(columns[0], columns[1], type, value, std)
+    except ValueError:
+        # find the first line that can not be parsed
+        for line in text.split('\n'):
             linenum = linenum + 1
             # skip line if empty
             if not line:
                 continue
-            # split line by tab
-            elements = line.split('\t')
-            # parse/convert elements according to file extension
-            exception_text = 'Error on line ' + str(linenum) + ' in file ' + filename  # used in Exception() if there's an error
-
-            # for cnt files
-            if filetype == 'cnt':
-                # cnt files should have 4 elements per row
-                if len(elements) != 4:
-                    raise Exception(exception_text)
-                # try to convert elements in row to proper type
-                try:
-                    row = [elements[0], elements[1], float(elements[2]), float(elements[3])]
-                except:
-                    raise Exception(exception_text)
-                # save row in output
-                output.append(row)
-
-            # for mes files
-            elif filetype == 'mes':
-                # cnt files should have 4 elements per row
-                if len(elements) != 5:
-                    raise Exception(exception_text)
-                # try to convert elements in row to proper type
-                try:
-                    # convert DMS to radians for angle measurements
-                    if elements[2] == "Angle":
-                        DMS = elements[3].split(' ')
-                        elements[3] = (float(DMS[0]) + float(DMS[1]) / 60 + float(DMS[2]) / 3600) * math.pi/180
-                        # also convert standard deviation from arcseconds to rads
-                        elements[4] = float(elements[4])/3600 * math.pi/180
-
-                    row = [elements[0], elements[1], elements[2], float(elements[3]), float(elements[4])]
-                except:
-                    raise Exception(exception_text)
-                # save row in output
-                output.append(row)
-
-    return output
+            try:
+                parseRow(line.split('\t'), filetype)
+            except:
+                raise Exception('Error on line ' + str(linenum) + ' in file ' + filename)
+        raise
 
 
 # Function to build the unknowns vector x
 # returns x as a numpy array
-# CNT: 2D list containing data from the coordinates.cnt file
+# CNT: CNTTable containing data from the coordinates.cnt file
 def buildx(CNT):
-    # loop through CNT and find points of type U (unknowns)
-    x = np.array([])
-    for row in CNT:
-        type = row[1]
-        if type == 'U' or type == 'u':
-            x = np.append(x, [row[2], row[3]])
-
-    return x
+    # take (x,y) of the points of type U (unknowns)
+    return np.column_stack([CNT.x, CNT.y])[CNT.unknown].ravel()
 
 
 # Function to build the weight matrix P
 # returns P as a numpy matrix
-# MES: 2D list containing data from measurements.mes file
-def buildP(MES, sigma0):
-    n = len(MES)
-    P = np.zeros([n, n])
-    for i in range(0, n):
-        P[i][i] = sigma0 / pow(MES[i][4], 2)
+# MES: MESTable containing data from measurements.mes file
+# sparse (optional): set to True to return P as a scipy.sparse diagonal matrix (only the diagonal is stored)
+def buildP(MES, sigma0, sparse=False):
+    if sparse:
+        return sp.diags(buildp(MES, sigma0), format='csr')
+    return np.diag(buildp(MES, sigma0))
+
+
+# Function to build the weights of all measurements as a vector (the diagonal of P)
+# returns p as a numpy array
+# MES: MESTable containing data from measurements.mes file
+def buildp(MES, sigma0):
+    return sigma0 / MES.std**2
+
 
-    return P
+# Function to decide if the adjustment should be done with sparse matrices
+# returns True if dense A and P would hold more than threshold elements
+# n: number of measurements
+# u: number of unknowns
+# threshold (optional): maximum number of elements in dense A and P
+def useSparse(n, u, threshold=SPARSE_THRESHOLD):
+    return n*(n + u) > threshold
 
 
 # Function to find coordinates in CNT by Point name
-# Returns x, y as a tuple of floats
-# CNT: 2D list containing data from the coordinates.cnt file
+# Returns the point as a Point object
+# CNT: CNTTable containing data from the coordinates.cnt file, or a PointRegistry of it (O(1) lookup)
 # name: name of point in Point column of CNT
 def findPoint(CNT, name):
-    P = None
-    for point in CNT: # for all points
-        if point[0] == name: # if point found
-            P = Point(point)
-    if not P: # if point could not be found
-        exception_text = "Could not find point '" + name + "' in CNT"
-        raise Exception(exception_text)
-    return P
+    if isinstance(CNT, PointRegistry):
+        return CNT.point(name)
+    rows = np.flatnonzero(CNT.name == name)
+    if len(rows) > 0: # if point found
+        return CNT[rows[0]]
+    # if point could not be found
+    exception_text = "Could not find point '" + name + "' in CNT"
+    raise Exception(exception_text)
 
 
 # Function to make the angles from atan2 between 0 and 2pi
-# returns angle + npi in radians
-# angle: input angle in radians
+# returns the angle in [0, 2pi) in radians
+# angle: input angle in radians (a number or a numpy array)
 def npi(angle):
-    while angle < 0:
-        angle = angle + math.pi
-    while angle > 2 * math.pi:
-        estimated = angle - math.pi
-    return angle
+    return np.mod(angle, 2*math.pi)
+
+# Function to get the entries of A for the partial derivatives of one point in many rows at once
+# rows whose point is a control point (col = -1) are skipped
+# returns rows, cols, values of the entries as a tuple of numpy arrays
+# rows: numpy int array of rows in A
+# cols: numpy int array of the x column of the point in each row (-1 for control points)
+# dfdx, dfdy: numpy arrays of partial derivatives for (x,y) of the point
+def partials(rows, cols, dfdx, dfdy):
+    unknown = cols >= 0
+    rows = rows[unknown]
+    cols = cols[unknown]
+    return (np.concatenate([rows, rows]), np.concatenate([cols, cols + 1]),
+            np.concatenate([dfdx[unknown], dfdy[unknown]]))
+
+
+# Function to get the matrix that subtracts from every measurement the weighted mean (weights 1/std^2) of its
+# direction set
+# every direction of a set is an azimuth minus the orientation of the set. Eliminating the orientation from the
+# normal equations is the same as multiplying the rows of A and w with this matrix, so the orientations are not in x
+# (see Covariance for their effect on the statistics)
+# returns a kxk scipy.sparse CSR matrix (rows that are not in a set are kept as they are)
+# sets: numpy int array of the direction set of each measurement (-1 if it is not in a set, see ObsIndex)
+# std: numpy array of the k standard deviations
+def orientationCentring(sets, std):
+    k = len(sets)
+    rows = np.flatnonzero(sets >= 0)
+    _, sets = np.unique(sets[rows], return_inverse=True)
+    p = 1/std[rows]**2
+    # M: kx(number of sets), 1 where a measurement is in a set. W: the weight of each member in the mean of its set
+    M = sp.csr_matrix((np.ones(len(rows)), (rows, sets)), shape=(k, len(p) and sets.max() + 1))
+    W = sp.csr_matrix((p/np.bincount(sets, weights=p)[sets], (sets, rows)), shape=(M.shape[1], k))
+    return (sp.identity(k, format='csr') - M @ W).tocsr()
+
+
+# Function to eliminate the orientation unknowns of direction sets from their rows of A and w (see
+# orientationCentring)
+# returns entries, w: the (rows, cols, values) of the centred rows of A as a list, and the centred misclosures
+# rows: numpy int array of the k rows in A
+# sets: numpy int array of the direction set of each row
+# entries: list of (rows, cols, values) of the rows from partials
+# w: numpy array of the k misclosures (estimated - measured)
+# std: numpy array of the k standard deviations
+# u: number of unknowns
+def eliminateOrientation(rows, sets, entries, w, std, u):
+    k = len(rows)
+    _, first, sets = np.unique(sets, return_index=True, return_inverse=True)
+    # the misclosures are taken between -pi and pi of the first one of their set, so that an orientation close to
+    # 0 or 2pi keeps the set together
+    w = np.mod(w - w[first][sets] + math.pi, 2*math.pi) - math.pi + w[first][sets]
+    local = np.searchsorted(rows, np.concatenate([e[0] for e in entries]))
+    A = sp.csr_matrix((np.concatenate([e[2] for e in entries]), (local, np.concatenate([e[1] for e in entries]))),
+                      shape=(k, u))
+    C = orientationCentring(sets, std)
+    A = (C @ A).tocoo()
+    return [(rows[A.row], A.col, A.data)], C @ w
+
 
 # Function to build the design and misclosure matrices
 # returns A, w as a tuple of numpy matrices
-# CNT: 2D list containing data from the coordinates.cnt file
-# MES: 2D list containing data from measurements.mes file
+# CNT: CNTTable containing data from the coordinates.cnt file
+# MES: MESTable containing data from measurements.mes file
 # x: numpy array containing initial values of unknowns
-# P: numpy weight matrix
-def buildAw(CNT, MES, x):
-    n = len(MES)  # n = number of measurements
+# obs (optional): ObsIndex of CNT and MES. Pass it in when calling buildAw repeatedly so the
+#                 measurement info is only parsed once
+# sparse (optional): set to True to return A as a scipy.sparse CSR matrix
+def buildAw(CNT, MES, x, obs=None, sparse=False):
+    if obs is None:
+        obs = ObsIndex(CNT, MES)
+    n = obs.n  # n = number of measurements
     u = len(x)  # u = number of unknowns
-    # initialize A and w to the proper size's
-    A = np.zeros([n, u])
+    # initialize w to the proper size
     w = np.zeros([n, 1])
+    entries = []  # (rows, cols, values) of the non-zero entries of A
+    # current (x,y) of every point, with unknowns replaced by their values from x
+    XY = obs.coordinates(x)
+
+    # measurements of each type at once
+    for code, rows, pts in obs.groups:
+        obstype = OBSERVATION_TYPES[code]
+        estimated, derivatives = obstype.kernel(XY, pts)
+        # partial derivatives
+        block = [partials(rows, obs.cols[pts[:, slot]], dfdx, dfdy) for slot, dfdx, dfdy in derivatives]
+        # w = estimated - measured
+        misclosure = estimated - obs.values[rows]
+        if obstype.oriented:
+            block, misclosure = eliminateOrientation(rows, obs.orientation[rows], block, misclosure,
+                                                     obs.std[rows], u)
+        elif obstype.angular:
+            # the misclosure is taken between -pi and pi, so angles close to 0 and 2pi are compared the right way
+            misclosure = np.mod(misclosure + math.pi, 2*math.pi) - math.pi
+        entries.extend(block)
+        w[rows, 0] = misclosure
+
+    # assemble A from its non-zero entries
+    rows, cols, values = [np.concatenate(i) for i in zip(*entries)]
+    if sparse:
+        A = sp.csr_matrix((values, (rows, cols)), shape=(n, u))
+    else:
+        A = np.zeros([n, u])
+        # entries of the same element are added up, as in the sparse matrix (a point in more than 1 slot)
+        np.add.at(A, (rows, cols), values)
 
-    # loop through all measurements (all rows of A and w)
-    for i in range(0,n):
-        # get measurement variables
-        mesID, mesInfo, mesType, mesValue = MES[i][0:4]
+    return A, w
 
-        # if angle measurement
-        if mesType == 'Angle':
-            # parse mesInfo
-            try:
-                Pto, Pat, Pfrom = mesInfo.split('_')
-            except:
-                exception_text = "Could not parse measurement info for ID = " + mesID
-                raise Exception(exception_text)
-            # get point coordinates
-            Pj = findPoint(CNT, Pto)
-            Pi = findPoint(CNT, Pat)
-            Pk = findPoint(CNT, Pfrom)
-
-            # for each point which in an unknown, replace (x,y) coordinates with updated values from unknowns vector x
-            for P in [Pj, Pi, Pk]:
-                if P.isUnknown():
-                    x_index = 2*P.unknownNum(CNT)
-                    P.x = x[x_index]
-                    P.y = x[x_index + 1]
-
-            # calculate row of A~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-            # partial derivatives:
-            # if Pi is an unknown
-            if Pi.isUnknown():
-                # find which columns of the A matrix it should be in using the order of unknowns in CNT
-                col = 2*(Pi.unknownNum(CNT))
-                # calculate partial derivative for (x,y) of Pi
-                A[i][col] = (Pk.y - Pi.y)/(pow(Pk.x-Pi.x, 2) + pow(Pk.y-Pi.y, 2)) - (Pj.y - Pi.y)/(pow(Pj.x-Pi.x, 2) + pow(Pj.y-Pi.y, 2))  # f/dxi
-                A[i][col+1] = -(Pk.x - Pi.x)/(pow(Pk.x-Pi.x, 2) + pow(Pk.y-Pi.y, 2)) + (Pj.x - Pi.x)/(pow(Pj.x-Pi.x, 2) + pow(Pj.y-Pi.y, 2))  # f/dyi
-            # if Pj is an unknown
-            if Pj.isUnknown():
-                col = 2*(Pj.unknownNum(CNT))
-                # calculate partial derivative for (x,y) of Pj
-                A[i][col] = (Pj.y - Pi.y)/(pow(Pj.x - Pi.x, 2) + pow(Pj.y - Pi.y, 2))  # f/dxj
-                A[i][col+1] = -(Pj.x - Pi.x)/(pow(Pj.x - Pi.x, 2) + pow(Pj.y - Pi.y, 2))  # f/dyj
-            # if Pk is an unknown
-            if Pk.isUnknown():
-                col = 2 * (Pk.unknownNum(CNT))
-                # calculate partial derivative for (x,y) of Pk
-                A[i][col] = -(Pk.y - Pi.y) / (pow(Pk.x - Pi.x, 2) + pow(Pk.y - Pi.y, 2))  # f/dxk
-                A[i][col + 1] = (Pk.x - Pi.x) / (pow(Pk.x - Pi.x, 2) + pow(Pk.y - Pi.y, 2))  # f/dyk
-
-            # calculate row of w~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-            # w = estimated - measured
-            estimated = (math.atan2(Pk.y - Pi.y, Pk.x - Pi.x) - math.atan2(Pj.y - Pi.y, Pj.x - Pi.x))  # estimated angle in radians
-            # make sure estimated angle is between 0 and 2pi
-            estimated = npi(estimated)
-            w[i] = estimated - mesValue
-
-        # if distance measurement
-        elif mesType == 'Dist':
-            # parse mesInfo
-            try:
-                Pstart, Pend = mesInfo.split('_')
-            except:
-                exception_text = "Could not parse measurement info for ID = " + mesID
-                raise Exception(exception_text)
-            # get point coordinates
-            Pi = findPoint(CNT, Pstart)
-            Pj = findPoint(CNT, Pend)
-
-            # for each point which in an unknown, replace (x,y) coordinates with updated values from unknowns vector x
-            for P in [Pj, Pi]:
-                if P.isUnknown():
-                    x_index = 2*P.unknownNum(CNT)
-                    P.x = x[x_index]
-                    P.y = x[x_index + 1]
-
-            # calculate row of A~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-            # partial derivatives:
-            # if Pi is an unknown
-            if Pi.isUnknown():
-                # find which columns of the A matrix it should be in using the order of unknowns in CNT
-                col = 2 * (Pi.unknownNum(CNT))
-                # calculate partial derivative for (x,y) of Pi
-                A[i][col] = (Pi.x - Pj.x)/pow(pow(Pi.x - Pj.x, 2) + pow(Pi.y - Pj.y, 2), 0.5)  # f/dxi
-                A[i][col + 1] = (Pi.y - Pj.y) / pow(pow(Pi.x - Pj.x, 2) + pow(Pi.y - Pj.y, 2), 0.5)  # f/dyi
-            # if Pj is an unknown
-            if Pj.isUnknown():
-                col = 2 * (Pj.unknownNum(CNT))
-                # calculate partial derivative for (x,y) of Pi
-                A[i][col] = (Pj.x - Pi.x) / pow(pow(Pi.x - Pj.x, 2) + pow(Pi.y - Pj.y, 2), 0.5)  # f/dxj
-                A[i][col + 1] = (Pj.y - Pi.y) / pow(pow(Pi.x - Pj.x, 2) + pow(Pi.y - Pj.y, 2), 0.5)  # f/dyj
-
-            # calculate row of w~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-            estimated = pow(pow(Pi.x - Pj.x, 2) + pow(Pi.y - Pj.y, 2), 0.5)
-            w[i] = estimated - mesValue
-        else:
-            exception_text = "Invalid measurement type for ID = " + mesID
-            raise Exception(exception_text)
 
-    return A, w
+# Function to get the key of the topology of a network (which unknown points are measured together)
+# returns the key as a hex string
+# edges: kx2 numpy int array from ObsIndex.unknownEdges
+# u: number of unknowns
+def topologyKey(edges, u):
+    h = hashlib.sha256(('u' + str(u) + '\n').encode())
+    h.update(np.ascontiguousarray(edges, dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+
+# Function to get the fill-reducing order of the unknowns used to factorize sparse N (see Factor in solver.py)
+# the order is found once per topology and kept in ORDERINGS, so repeated runs of the same network in a process
+# (and all iterations of a run) reuse it. Use cachedOrdering in cache.py to also keep it between processes
+# returns a numpy array with the unknowns in the order they are eliminated
+# obs: ObsIndex of CNT and MES
+# u: number of unknowns
+def unknownOrdering(obs, u):
+    edges = obs.unknownEdges()
+    key = topologyKey(edges, u)
+    if key not in ORDERINGS:
+        if len(ORDERINGS) >= MAX_ORDERINGS:
+            ORDERINGS.pop(next(iter(ORDERINGS)))  # oldest first
+        ORDERINGS[key] = fillReducingOrder(edges, u // 2)
+    return ORDERINGS[key]
+
+
+# Function to find the convergence tolerance of the coordinates
+# a distance sees a position change of its standard deviation, an angle one of its standard deviation (in radians)
+# times its shorter sight (see ObservationType.resolution). The tolerance is CONVERGENCE_FRACTION of the smallest of
+# these, so it is in meters whatever the mix of measurements
+# returns the tolerance in meters
+# MES: MESTable
+# obs: ObsIndex of CNT and MES
+# x: numpy array with the values of the unknowns
+def convergenceTolerance(MES, obs, x):
+    resolution = [np.inf]
+    XY = obs.coordinates(x)
+    for code, rows, pts in obs.groups:
+        resolution.append(np.min(OBSERVATION_TYPES[code].resolution(XY, pts, MES.std[rows])))
+    return CONVERGENCE_FRACTION*min(resolution)
+
+
+# Function to run the damped Gauss-Newton iterations of the adjustment
+# Each Gauss-Newton step is checked with a line search: the step is halved until it lowers the weighted sum of
+# squared misclosures omega = wt @ P @ w. The A and w of the accepted step are those of the next iteration, so an
+# undamped step costs no more than before
+# The iterations stop when:
+#     converged: no coordinate changes by more than threshold (meters), or omega changes by less than
+#                OMEGA_TOLERANCE of itself
+#     diverged: no step lowers omega, or the misclosures are not finite (e.g. points on top of each other)
+#     maxit: the maximum number of iterations is reached
+# returns x, A, w, delta, Nfactor, count, converged as a tuple:
+#     x: adjusted unknowns
+#     A, w: design matrix and misclosure vector of the last iteration
+#     delta: correction of the last iteration (after damping)
+#     Nfactor: Factor of the normal matrix of the last iteration (see solver.py)
+#     count: iteration counter (number of iterations + 1)
+#     converged: False if the iterations diverged or the maximum number of iterations was reached
+# CNT, MES: CNTTable and MESTable
+# x: numpy array with initial values of unknowns
+# P: weight matrix (numpy or scipy.sparse)
+# obs: ObsIndex of CNT and MES
+# sparse: set to True to use sparse matrices
+# threshold: largest change of a coordinate in meters of a converged iteration (see convergenceTolerance)
+# maxit: maximum iterations before breaking the loop
+# suppress_print (optional): Set to False to print the progress to the console
+# inst (optional): Instrument that times the stages of each iteration (see instrument.py)
+# perm (optional): fill-reducing order of the unknowns for sparse N (see unknownOrdering)
+def iterate(CNT, MES, x, P, obs, sparse, threshold, maxit, suppress_print=True, inst=NULL_INSTRUMENT, perm=None):
+    p = P.diagonal()
+    count = 1  # initialize iteration counter
+    converged = False  # set to True when a convergence test passes
+    inst.start('build A/w')
+    A, w = buildAw(CNT, MES, x, obs, sparse)
+    inst.end('build A/w')
+    omega = np.sum(p*w[:, 0]**2)
+    if not np.isfinite(omega):
+        raise Exception("The misclosures at the initial coordinates are not finite. Check for unknown points "
+                        "with the same coordinates as the points they are measured from")
+    while True:
+        if not suppress_print:
+            print("Iteration: " + str(count))  # print iteration number for the user
+        # also break if maximum number of iterations is reached
+        if count >= maxit:
+            print("Maximum number of iterations reached")
+            print("Break")
+            # A and w are already those of x
+            delta = np.zeros([len(x), 1])
+            break
+
+        # calculate solution
+        inst.start('normal equations')
+        At = A.transpose()  # transpose design matrix
+        u = At @ P @ w
+        N = At @ P @ A
+        inst.end('normal equations')
+        # factorize N instead of inverting it (see solver.py)
+        inst.start('solve')
+        Nfactor = Factor(N, perm)
+        delta = Nfactor.solve(-u)
+        inst.end('solve')
+
+        # line search: halve the step until omega does not grow (rounding allowed for)
+        inst.start('line search')
+        step = 1
+        for halving in range(0, MAX_STEP_HALVINGS + 1):
+            x_new = x + step*delta.ravel()
+            A_new, w_new = buildAw(CNT, MES, x_new, obs, sparse)
+            omega_new = np.sum(p*w_new[:, 0]**2)
+            if omega_new <= omega*(1 + 1e-12) + 1e-300:
+                break
+            step = step/2
+        inst.end('line search')
+        correction = step*np.max(np.abs(delta))
+        if not omega_new <= omega*(1 + 1e-12) + 1e-300:
+            # no step lowers omega: converged if the full step was already too small to matter (omega is at its
+            # minimum up to rounding), otherwise the iterations diverged and x is left where it was
+            converged = np.max(np.abs(delta)) <= threshold
+            if converged:
+                x = x + delta.ravel()
+            else:
+                print("The iterations diverged (no step lowers the weighted sum of squared misclosures)")
+                delta = np.zeros([len(x), 1])
+            inst.event('iteration', count=count, max_correction=0.0, step=0.0, omega=float(omega))
+            count = count + 1
+            break
+        delta = step*delta
+        change = abs(omega - omega_new)/max(omega_new, 1e-300)
+        inst.event('iteration', count=count, max_correction=float(correction), step=step, omega=float(omega_new))
+        if not suppress_print:
+            print("largest correction = " + str(correction) + ", step = " + str(step) + ", omega = "
+                  + str(omega_new) + "\n")
+        count = count + 1  # iterate count
+        x = x_new
+        # stop when the coordinates or omega have stopped changing
+        if correction <= threshold or change <= OMEGA_TOLERANCE:
+            converged = True
+            break
+        A, w = A_new, w_new
+        omega = omega_new
+
+    return x, A, w, delta, Nfactor, count, converged
+
 
 # Function to count the number of digits before the decimal place
 # returns counts as an int if only 1 number is given, or as a list for multiple numbers
@@ -274,107 +567,6 @@ def numlen(nums):
         return counts  # return as list
 
 
-# Function to plot all coordinates from CNT
-# returns fig and ax, the matplotlib figure and axis objects
-# CNT: coordinates 2D list
-# x: array with estimated unknown values
-# fignumber: figure number that should be used
-def plotCNT(CNT, x):
-    unknownCol = '#fc4c4c'
-    knownCol = '#03c2fc'
-    ax = plt.axes()
-    ax.axis('square')
-    # save min/max x and y for plot limits
-    # initialize to first point's (x,y)
-    for i in range(0, len(CNT)):
-        P = Point(CNT[i])
-        c = knownCol  # set color to blue
-        # if P is unknown
-        if P.isUnknown():
-            # set color to red if P is an unknown point
-            c = unknownCol
-            # update P(x,y) from unknowns vector x
-            x_index = 2 * P.unknownNum(CNT)
-            P.x = x[x_index]
-            P.y = x[x_index + 1]
-        # plot point
-        plt.scatter(P.x, P.y, c=c)
-        # add text
-        plt.text(P.x+30, P.y+30, P.name)
-    # set title
-    ax.set_title('Adjusted Geodetic Network with Exaggerated Error Ellipses')
-    # get min/max x
-    minx = min([i[2] for i in CNT])
-    maxx = max([i[2] for i in CNT])
-    # get min/max y
-    miny = min([i[3] for i in CNT])
-    maxy = max([i[3] for i in CNT])
-    # set limits with 10% buffer
-    bufx = abs(maxx - minx)*0.1
-    bufy = abs(maxy - miny)*0.1
-    plt.xlim(minx - bufx, maxx + bufx)
-    plt.ylim(miny - bufy, maxy + bufy)
-    #plt.show(block=False)  # block=False allows the rest of the program to run while the plot is open
-    return ax
-
-
-# Function to draw an error ellipse on a figure
-# returns nothing
-# fig: matplotlib.pyplot.figure object
-# x and y: (x,y) center of the ellipse
-# semi_major: size of the semi-major axis
-# semi_minor: size of the semi-minor axis
-# theta: orientation of the semi-major axis in radians (angle counter-clockwise from the x axis to the semi-major axis)
-# scale (optional): scale for the semi_major and semi_minor values to make the ellipse larger or smaller
-# name (optional): set name for unknown point (used for zoomed in plot)
-def drawEE(ax, x, y, semi_major, semi_minor, theta, scale=1, name=''):
-    # convert theta to degrees
-    thetad = theta*180/math.pi
-    # create exaggerated ellipse on main plot:
-        # ellipse is centered on the given (x,y)
-        # width is the 2*semi-major axis
-        # height in 2*semi-minor
-        # angle takes degrees and rotates the ellipse counter-clockwise
-        # theta is the counter-clockwise angle from the x axis, so we pass theta in degrees
-    e = pat.Ellipse(xy=(x, y), width=2*semi_major*scale, height=2*semi_minor*scale,
-                    angle=thetad, facecolor='none', edgecolor='red', label='Error Ellipse (exaggerated)')
-    ax.add_artist(e)
-    # create semi-major axis line
-    l = Line2D([x, x + scale*semi_major*math.cos(theta)], [y, y + scale*semi_major*math.sin(theta)], color='red')
-    ax.add_artist(l)
-
-    # create zoomed in plot of unknown point with error ellipse to scale
-    fig = plt.figure()
-    ax2 = plt.axes()
-    ax2.axis('square')
-    plt.scatter(x, y)
-    fig.suptitle("To-scale Error Ellipse for " + name + " (square plot)")
-    e = pat.Ellipse(xy=(x, y), width=2*semi_major, height=2*semi_minor,
-                    angle=thetad, facecolor='none', edgecolor='red')
-    ax2.add_artist(e)
-    # create semi-major axis line
-    l = Line2D([x, x + semi_major*math.cos(theta)], [y, y + semi_major*math.sin(theta)], color='red')
-    ax2.add_artist(l)
-    # adjust limits to 2.2x the semi-major axis
-    plt.xlim(x-semi_major*1.1, x+semi_major*1.1)
-    plt.ylim(y-semi_major*1.1, y+semi_major*1.1)
-
-    return
-
-
-# Function to save all open figures as PDF
-# I got this function from stack overflow user farenorth: https://stackoverflow.com/questions/26368876/saving-all-open-matplotlib-figures-in-one-file-at-once
-# filename: filename of the pdf to be saved
-# figs (optional): by default the function will grab all open figures. This option lets the user specify figures instead
-def SaveFigs(filename, figs=None):
-    pp = PdfPages(filename)
-    if figs is None:
-        figs = [plt.figure(n) for n in plt.get_fignums()]
-    for fig in figs:
-        fig.savefig(pp, format='pdf')
-    pp.close()
-
-
 # Function to find a single file of a certain filetype
 # If more than 1 file is found, error is given
 # returns a single filename
@@ -395,19 +587,44 @@ main(CNTFile='my/path/filename.cnt', MESFile='my/path/filename.mes')""")
     return found[0]  # return 1st string in found
 
 
+# Function to calculate the error ellipses of points from their 2x2 variance covariance matrices
+# returns semi_major, semi_minor, theta as numpy arrays:
+#     semi_major, semi_minor: semi-major and semi-minor axis lengths
+#     theta: angle counter-clockwise from the x axis to the semi-major axis
+# blocks: kx2x2 numpy array of the variance covariance matrices of k points (see Covariance.pointBlocks)
+def errorEllipses(blocks):
+    # eigen values in ascending order
+    evals = np.linalg.eigvalsh(blocks)
+    semi_minor = np.sqrt(evals[:, 0])
+    semi_major = np.sqrt(evals[:, 1])
+    # orientation of the semi-major axis
+    theta = 0.5 * np.arctan2(-2*blocks[:, 0, 1], blocks[:, 1, 1] - blocks[:, 0, 0])
+    return semi_major, semi_minor, theta
+
+
 #Function to test is the results are acceptable:
+# a residual fails when it is larger than 3 times its standard deviation from Crhat. Crhat is scaled by the a-posteriori
+# variance factor sigma0hat, so the test does not depend on how well sigma0 was chosen. (Data snooping uses the
+# a-priori sigma0 instead, see dataSnooping in snooping.py)
 # rhat: residuals vector
-# Crhat: variance covariance matrix for the residuals
+# Crhat: variance covariance matrix for the residuals, or just its diagonal as a 1D array
 # return results as a boolean list (true/false for each observation)
 def sTest(rhat, Crhat):
     n = len(rhat)
-    # check shape of Crhat
-    if Crhat.shape[0] != n or Crhat.shape[1] != n:
-        raise Exception("rhat must be nx1, and Crhat must be nxn")
+    # only the variances of the residuals are used
+    if Crhat.ndim == 1:
+        var = Crhat
+    else:
+        # check shape of Crhat
+        if Crhat.shape[0] != n or Crhat.shape[1] != n:
+            raise Exception("rhat must be nx1, and Crhat must be nxn")
+        var = Crhat.diagonal()
+    if len(var) != n:
+        raise Exception("rhat and the diagonal of Crhat must be the same size")
     results = []
     # do test on each observation residual
     for i in range(0, n):
-        if rhat[i] > 3*math.sqrt(Crhat[i][i]):
+        if abs(rhat[i]) > 3*math.sqrt(var[i]):
             results.append(False)
         else:
             results.append(True)
@@ -432,7 +649,7 @@ def writeResults(results, MES, file):
             # change flag
             alltrue = False
             # get ID from MES
-            ID = MES[count][0]
+            ID = MES.id[count]
             # output error to file
             file.write("Measurement ID " + str(ID) + " failed\n")
         count = count + 1
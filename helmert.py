@@ -0,0 +1,489 @@
+from functions import *
+from solver import NOT_POSITIVE_DEFINITE, schurComplement
+from covariance import Covariance
+from concurrent.futures import ProcessPoolExecutor
+
+
+# blocks loaded in this process (by loadBlock), keyed by (tag of the HelmertBlocks, block number)
+BLOCKS = {}
+
+
+# Function to split the unknown points into regions by recursive coordinate bisection
+# each split is across the longer side of the points, at the place that gives the 2 halves numbers of points in
+# proportion to their numbers of regions
+# returns a numpy int array with the region of each point
+# xy: kx2 numpy array of the (x,y) of the points
+# regions: number of regions
+def bisectPoints(xy, regions):
+    labels = np.zeros(len(xy), dtype=int)
+    parts = [(np.arange(len(xy)), 0, regions)]  # (points, first region, number of regions)
+    while parts:
+        idx, first, count = parts.pop()
+        if count <= 1 or len(idx) == 0:
+            labels[idx] = first
+            continue
+        axis = int(np.argmax(np.ptp(xy[idx], axis=0)))
+        order = idx[np.argsort(xy[idx, axis], kind='stable')]
+        left = count // 2
+        cut = int(round(len(idx)*left/count))
+        parts.append((order[:cut], first, left))
+        parts.append((order[cut:], first + left, count - left))
+    return labels
+
+
+# Function to split a network into regional blocks for a Helmert blocking adjustment
+# The unknown points are split into regions (see bisectPoints). A measurement between unknown points of more than
+# 1 region makes all of its unknown points junction points, so every measurement belongs to 1 block: the block of
+# the region of its unknown points (the first one for measurements between junction points). The directions of a
+# set are kept in 1 block, like 1 measurement. The other unknown points are the interior points of their block
+# returns junction, blocks as a tuple:
+#     junction: numpy int array with the columns in x of the unknowns of the junction points
+#     blocks: list of dictionaries, one per block with measurements:
+#         CNT: CNTTable of the points of the block (interior points, then junction points as unknowns, then the
+#              other points as control points)
+#         MES: MESTable of the measurements of the block
+#         cols: columns in x of the unknowns of the block (in the order of its CNT)
+#         interior: number of unknowns of the interior points (they come first in cols)
+#         jpos: positions of the junction unknowns of the block in junction
+#         rows: rows in MES of the measurements of the block
+# CNT, MES: CNTTable and MESTable
+# obs: ObsIndex of CNT and MES
+# regions: number of regions
+def partitionNetwork(CNT, MES, obs, regions):
+    points = obs.points
+    region = bisectPoints(points.xy[points.unknown_rows], regions)
+    # unknown point number of every point referenced by every measurement (-1 for control points and unused)
+    pts = MES.pts
+    num = np.where(pts >= 0, points.cols[np.maximum(pts, 0)], -1) // 2
+    used = num >= 0
+    reg = np.where(used, region[np.maximum(num, 0)], -1)
+    lo = np.where(used, reg, regions).min(axis=1)
+    hi = reg.max(axis=1)
+    # the directions of a set share their orientation, so a set is measured from all regions of its points
+    sets = obs.orientation
+    if obs.orientations > 0:
+        rows = np.flatnonzero(sets >= 0)
+        set_lo = np.full(obs.orientations, regions)
+        set_hi = np.full(obs.orientations, -1)
+        np.minimum.at(set_lo, sets[rows], lo[rows])
+        np.maximum.at(set_hi, sets[rows], hi[rows])
+        lo[rows] = set_lo[sets[rows]]
+        hi[rows] = set_hi[sets[rows]]
+    # unknown points that are measured from more than 1 region
+    junction_points = np.zeros(len(region), dtype=bool)
+    junction_points[num[used & (lo != hi)[:, None]]] = True
+    # every unknown point has to be measured, otherwise N is singular
+    measured = np.zeros(len(region), dtype=bool)
+    measured[num[used]] = True
+    if not np.all(measured):
+        raise Exception(NOT_POSITIVE_DEFINITE)
+    owner = np.where(hi >= 0, lo, 0)
+    junction = np.column_stack([2*np.flatnonzero(junction_points), 2*np.flatnonzero(junction_points) + 1]).ravel()
+
+    blocks = []
+    for b in range(0, regions):
+        rows = np.flatnonzero(owner == b)
+        if len(rows) == 0:
+            continue
+        interior = np.flatnonzero((region == b) & ~junction_points)
+        block_points = np.unique(num[rows][used[rows]])
+        shared = block_points[junction_points[block_points]]
+        unknown = np.concatenate([interior, shared])
+        # the control points (and nothing else) are left
+        referenced = np.unique(pts[rows][pts[rows] >= 0])
+        control = referenced[points.cols[referenced] < 0]
+        cnt_rows = np.concatenate([points.unknown_rows[unknown], control])
+        types = np.array(['U']*len(unknown) + ['C']*len(control))
+        block_CNT = CNTTable(CNT.name[cnt_rows], types, CNT.x[cnt_rows], CNT.y[cnt_rows])
+        cols = np.column_stack([2*unknown, 2*unknown + 1]).ravel()
+        blocks.append({'CNT': block_CNT, 'MES': MES.take(rows), 'cols': cols, 'interior': 2*len(interior),
+                       'jpos': np.searchsorted(junction, cols[2*len(interior):]), 'rows': rows})
+    return junction, blocks
+
+
+# Function to load a block into this process (runs in a worker process)
+# returns nothing
+# key: (tag, block number) to keep the block under
+# CNT, MES: CNTTable and MESTable of the block (see partitionNetwork)
+# interior: number of unknowns of the interior points
+# sigma0: a-priori variance factor
+def loadBlock(key, CNT, MES, interior, sigma0):
+    points = PointRegistry(CNT)
+    obs = ObsIndex(CNT, MES, points)
+    BLOCKS[key] = {'CNT': CNT, 'MES': MES, 'obs': obs, 'p': buildp(MES, sigma0), 'interior': interior,
+                   'sparse': useSparse(len(MES), 2*len(points.unknown_rows))}
+
+
+# Function to form the normal equations of a block and reduce them onto its junction unknowns (runs in a worker
+# process). With the unknowns split into interior (I) and junction (J) unknowns:
+#     S = NJJ - NJI @ inv(NII) @ NIJ
+#     s = uJ - NJI @ inv(NII) @ uI
+# the factorization of NII, NIJ and inv(NII) @ uI are kept for the back-substitution (see schurComplement in
+# solver.py)
+# returns S, s, omega as a tuple (omega = weighted sum of squared misclosures of the block)
+# key: key of the block (see loadBlock)
+# x: numpy array with the current values of the unknowns of the block
+def reduceBlock(key, x):
+    B = BLOCKS[key]
+    p = B['p']
+    A, w = buildAw(B['CNT'], B['MES'], x, B['obs'], B['sparse'])
+    At = A.transpose()
+    u = At @ (p[:, None]*w)
+    if B['sparse']:
+        N = sp.csr_matrix(At @ sp.diags(p) @ A)
+    else:
+        N = At @ (p[:, None]*A)
+    c = B['interior']
+    if c > 0:
+        NIIfactor = Factor(N[:c, :c])
+        S = schurComplement(N, N.shape[0] - c, NIIfactor)
+        y = NIIfactor.solve(u[:c])
+    else:
+        NIIfactor = None
+        S = N.toarray() if B['sparse'] else N
+        y = np.zeros((0, 1))
+    NIJ = N[:c, c:]
+    B['x'] = x
+    B['A'] = A
+    B['w'] = w
+    B['NIIfactor'] = NIIfactor
+    B['NIJ'] = NIJ
+    B['y'] = y
+    return S, (u[c:] - NIJ.T @ y).ravel(), np.sum(p*w[:, 0]**2)
+
+
+# Function to find the corrections of the interior unknowns of a block from the corrections of its junction
+# unknowns (runs in a worker process)
+#     dI = -inv(NII) @ (uI + NIJ @ dJ)
+# returns dI, omega as a tuple (omega = weighted sum of squared misclosures of the block after the full step)
+# key: key of the block (see loadBlock)
+# dJ: numpy array with the corrections of the junction unknowns of the block
+def backSubstitute(key, dJ):
+    B = BLOCKS[key]
+    dI = -B['y'].ravel()
+    if len(dI) > 0:
+        dI = dI - B['NIIfactor'].solve(B['NIJ'] @ dJ)
+    B['delta'] = np.concatenate([dI, dJ])
+    return dI, blockOmega(key, 1)
+
+
+# Function to get the weighted sum of squared misclosures of a block after a step of its corrections (runs in a
+# worker process)
+# returns omega
+# key: key of the block (see loadBlock)
+# step: fraction of the corrections
+def blockOmega(key, step):
+    B = BLOCKS[key]
+    A, w = buildAw(B['CNT'], B['MES'], B['x'] + step*B['delta'], B['obs'], B['sparse'])
+    return np.sum(B['p']*w[:, 0]**2)
+
+
+# BlockCofactors class
+# the cofactors (variances divided by sigma0hat) of the unknowns and measurements of a block, from the cofactors QJJ
+# of its junction unknowns (part of inv(S) of the whole network) and the factorization of NII. With
+# G = inv(NII) @ NIJ, the cofactor matrix of the unknowns of the block is
+#     QII = inv(NII) + G @ QJJ @ Gt
+#     QIJ = -G @ QJJ
+# It is a Covariance (see covariance.py) with sigma0hat = 1 whose entries() gives the elements of this matrix, so
+# diagCxhat() and pointBlocks() give the interior unknowns and points and diagClhat() the measurements of the block.
+# Only the elements between unknowns that share a measurement are found, the full QII is never formed
+class BlockCofactors(Covariance):
+    # largest number of elements of G @ QJJ and G that are multiplied at once
+    CHUNK = 4000000
+
+    # constructor
+    # NIIfactor: Factor of NII (None if the block has no interior unknowns)
+    # A: design matrix of the block (interior unknowns first)
+    # p: numpy array with the weights of the measurements of the block
+    # sets: direction set of each measurement of the block (see ObsIndex.orientation)
+    # G: numpy array inv(NII) @ NIJ
+    # QJJ: cofactor matrix of the junction unknowns of the block
+    def __init__(self, NIIfactor, A, p, sets, G, QJJ):
+        Covariance.__init__(self, NIIfactor, A, p, 1, sets)
+        self.c = G.shape[0]
+        self.G = G
+        self.GQ = G @ QJJ
+        self.QJJ = QJJ
+
+    # Function to get elements of the cofactor matrix of the unknowns of the block
+    # returns a numpy array with Q[rows[i], cols[i]] for each i
+    # rows, cols: numpy arrays of row and column numbers (see Covariance.entries)
+    def entries(self, rows, cols):
+        c = self.c
+        # every pair is found once
+        u = c + self.QJJ.shape[0]
+        pairs, inverse = np.unique(np.asarray(rows)*u + np.asarray(cols), return_inverse=True)
+        a = pairs // u
+        b = pairs % u
+        q = np.zeros(len(pairs))
+        II = np.flatnonzero((a < c) & (b < c))
+        if len(II) > 0:
+            q[II] = Covariance.entries(self, a[II], b[II])
+            step = max(self.CHUNK // max(self.G.shape[1], 1), 1)
+            for start in range(0, len(II), step):
+                k = II[start:start + step]
+                q[k] = q[k] + np.sum(self.GQ[a[k]]*self.G[b[k]], axis=1)
+        IJ = (a < c) & (b >= c)
+        q[IJ] = -self.GQ[a[IJ], b[IJ] - c]
+        JI = (a >= c) & (b < c)
+        q[JI] = -self.GQ[b[JI], a[JI] - c]
+        JJ = (a >= c) & (b >= c)
+        q[JJ] = self.QJJ[a[JJ] - c, b[JJ] - c]
+        return q[inverse]
+
+
+# Function to find the residuals of a block and the cofactors of its interior unknowns and its measurements from
+# the cofactors of its junction unknowns (runs in a worker process, see BlockCofactors). The block is linearized at
+# the x of its last reduceBlock
+# returns a dictionary with:
+#     rhat: numpy array with the residuals of the measurements of the block
+#     qx: numpy array with the cofactors of the interior unknowns
+#     blocks: (interior points)x2x2 numpy array with the 2x2 cofactor blocks of the interior points
+#     ql: numpy array with the cofactors of the corrected measurements of the block
+# key: key of the block (see loadBlock)
+# QJJ: cofactor matrix of the junction unknowns of the block
+# delta: numpy array with the corrections of the unknowns of the block
+def blockCovariance(key, QJJ, delta):
+    B = BLOCKS[key]
+    c = B['interior']
+    G = np.zeros((0, QJJ.shape[0]))
+    if c > 0:
+        NIJ = B['NIJ'].toarray() if sp.issparse(B['NIJ']) else B['NIJ']
+        G = B['NIIfactor'].solve(NIJ)
+    cov = BlockCofactors(B['NIIfactor'], B['A'], B['p'], B['obs'].orientation, G, QJJ)
+    qx = np.zeros(0)
+    blocks = np.zeros((0, 2, 2))
+    if c > 0:
+        qx = cov.diagCxhat()
+        blocks = cov.pointBlocks()
+    return {'rhat': B['A'] @ delta + B['w'][:, 0], 'qx': qx, 'blocks': blocks, 'ql': cov.diagClhat()}
+
+
+# HelmertBlocks class
+# the blocks of a partitioned (Helmert blocking) adjustment, loaded into worker processes
+# Every worker process keeps its blocks between the stages of an iteration (block k always goes to worker
+# k % workers), so only x, the reduced normal equations and the corrections are sent between the processes
+# usage:
+#     with HelmertBlocks(CNT, MES, obs, 8, sigma0, workers=4) as blocks:
+#         x, rhat, delta, cofactors, count, converged = partitionedIterate(...)
+class HelmertBlocks:
+    # constructor
+    # CNT, MES: CNTTable and MESTable
+    # obs: ObsIndex of CNT and MES
+    # regions: number of regions to split the network into (see partitionNetwork)
+    # sigma0: a-priori variance factor
+    # workers (optional): number of worker processes. With 1 the blocks are done in this process
+    def __init__(self, CNT, MES, obs, regions, sigma0, workers=1):
+        self.junction, self.blocks = partitionNetwork(CNT, MES, obs, regions)
+        self.n = len(MES)
+        self.u = 2*len(obs.points.unknown_rows)
+        self.tag = id(self)
+        self.pools = []
+        if workers > 1:
+            # 1 process per pool, so that each block stays in the process it was loaded into
+            self.pools = [ProcessPoolExecutor(max_workers=1) for i in range(0, min(workers, len(self.blocks)))]
+        self.run(loadBlock, [(B['CNT'], B['MES'], B['interior'], sigma0) for B in self.blocks])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Function to call a function on every block, in parallel on the worker processes
+    # returns a list of the results, in the order of the blocks
+    # function: loadBlock, reduceBlock, backSubstitute, blockOmega or blockCovariance
+    # args: list of tuples of arguments (after the key of the block), one per block
+    def run(self, function, args):
+        keys = [(self.tag, k) for k in range(0, len(self.blocks))]
+        if not self.pools:
+            return [function(keys[k], *args[k]) for k in range(0, len(keys))]
+        futures = [self.pools[k % len(self.pools)].submit(function, keys[k], *args[k]) for k in range(0, len(keys))]
+        return [future.result() for future in futures]
+
+    # Function to stop the worker processes (or remove the blocks from this process)
+    # returns nothing
+    def close(self):
+        for pool in self.pools:
+            pool.shutdown()
+        self.pools = []
+        for k in range(0, len(self.blocks)):
+            BLOCKS.pop((self.tag, k), None)
+
+
+# Function to form the normal equations of the blocks, reduce them onto their junction unknowns and add them up
+# (the blocks are done in parallel, see reduceBlock)
+# returns S, s, omega as a tuple: the reduced normal equations of the whole network and its weighted sum of squared
+# misclosures
+# blocks: HelmertBlocks of the network
+# x: numpy array with the current values of the unknowns
+def reduceNetwork(blocks, x):
+    junction = blocks.junction
+    reduced = blocks.run(reduceBlock, [(x[B['cols']],) for B in blocks.blocks])
+    S = np.zeros((len(junction), len(junction)))
+    s = np.zeros(len(junction))
+    for B, (Sk, sk, omegak) in zip(blocks.blocks, reduced):
+        S[np.ix_(B['jpos'], B['jpos'])] += Sk
+        s[B['jpos']] += sk
+    return S, s, sum([r[2] for r in reduced])
+
+
+# Function to run the damped Gauss-Newton iterations of a partitioned (Helmert blocking) adjustment
+# Every iteration the blocks form their normal equations and reduce them onto their junction unknowns in parallel,
+# the reduced equations are added up and solved for the corrections of the junction unknowns, and the blocks find
+# the corrections of their interior unknowns by back-substitution in parallel. The line search and the stopping
+# rules are those of iterate() in functions.py, so the result is the same as that of the adjustment of the whole
+# network. The design and normal matrices of the whole network are never formed: the residuals and the cofactors
+# are found block by block from the inverse of the reduced normal matrix S (see blockCovariance)
+# returns x, rhat, delta, cofactors, count, converged as a tuple:
+#     rhat: nx1 numpy array of residuals
+#     cofactors: cofactors of the junction unknowns and of every block, for BlockCovariance
+#     x, delta, count, converged: see iterate
+# x: numpy array with initial values of unknowns
+# threshold: largest change of a coordinate in meters of a converged iteration (see convergenceTolerance)
+# maxit: maximum iterations before breaking the loop
+# blocks: HelmertBlocks of the network
+# suppress_print (optional): Set to False to print the progress to the console
+# inst (optional): Instrument that times the stages of each iteration (see instrument.py)
+def partitionedIterate(x, threshold, maxit, blocks, suppress_print=True, inst=NULL_INSTRUMENT):
+    count = 1  # initialize iteration counter
+    converged = False  # set to True when a convergence test passes
+    junction = blocks.junction
+    x_lin = x  # x of the last linearization
+    S = None  # reduced normal matrix at x_lin
+    while True:
+        if not suppress_print:
+            print("Iteration: " + str(count))  # print iteration number for the user
+        # also break if maximum number of iterations is reached
+        if count >= maxit:
+            print("Maximum number of iterations reached")
+            print("Break")
+            x_lin = x
+            S = None
+            delta = np.zeros([len(x), 1])
+            break
+
+        # normal equations of the blocks, reduced onto the junction unknowns
+        inst.start('normal equations')
+        S, s, omega = reduceNetwork(blocks, x)
+        if count == 1 and not np.isfinite(omega):
+            raise Exception("The misclosures at the initial coordinates are not finite. Check for unknown points "
+                            "with the same coordinates as the points they are measured from")
+        inst.end('normal equations')
+        # solve the junction unknowns, then back-substitute the interior unknowns of every block
+        inst.start('solve')
+        dJ = Factor(S).solve(-s) if len(junction) > 0 else s
+        substituted = blocks.run(backSubstitute, [(dJ[B['jpos']],) for B in blocks.blocks])
+        delta = np.zeros([len(x), 1])
+        delta[junction, 0] = dJ
+        for B, (dI, omegak) in zip(blocks.blocks, substituted):
+            delta[B['cols'][:B['interior']], 0] = dI
+        inst.end('solve')
+
+        # line search: halve the step until omega does not grow (rounding allowed for)
+        inst.start('line search')
+        step = 1
+        omega_new = sum([r[1] for r in substituted])
+        for halving in range(0, MAX_STEP_HALVINGS + 1):
+            if halving > 0:
+                omega_new = sum(blocks.run(blockOmega, [(step,)]*len(blocks.blocks)))
+            if omega_new <= omega*(1 + 1e-12) + 1e-300:
+                break
+            step = step/2
+        inst.end('line search')
+        x_lin = x
+        correction = step*np.max(np.abs(delta))
+        if not omega_new <= omega*(1 + 1e-12) + 1e-300:
+            # see iterate
+            converged = np.max(np.abs(delta)) <= threshold
+            if converged:
+                x = x + delta.ravel()
+            else:
+                print("The iterations diverged (no step lowers the weighted sum of squared misclosures)")
+                delta = np.zeros([len(x), 1])
+            inst.event('iteration', count=count, max_correction=0.0, step=0.0, omega=float(omega))
+            count = count + 1
+            break
+        delta = step*delta
+        change = abs(omega - omega_new)/max(omega_new, 1e-300)
+        inst.event('iteration', count=count, max_correction=float(correction), step=step, omega=float(omega_new))
+        if not suppress_print:
+            print("largest correction = " + str(correction) + ", step = " + str(step) + ", omega = "
+                  + str(omega_new) + "\n")
+        count = count + 1  # iterate count
+        x = x + delta.ravel()
+        # stop when the coordinates or omega have stopped changing
+        if correction <= threshold or change <= OMEGA_TOLERANCE:
+            converged = True
+            break
+
+    # the residuals and cofactors at the last linearization, block by block
+    if S is None:
+        inst.start('normal equations')
+        S = reduceNetwork(blocks, x_lin)[0]
+        inst.end('normal equations')
+    inst.start('covariance')
+    QJJ = Factor(S).inverse() if len(junction) > 0 else S
+    pieces = blocks.run(blockCovariance, [(QJJ[np.ix_(B['jpos'], B['jpos'])], delta[B['cols'], 0])
+                                          for B in blocks.blocks])
+    inst.end('covariance')
+    rhat = np.zeros([blocks.n, 1])
+    for B, piece in zip(blocks.blocks, pieces):
+        rhat[B['rows'], 0] = piece['rhat']
+    return x, rhat, delta, {'QJJ': QJJ, 'blocks': pieces}, count, converged
+
+
+# BlockCovariance class
+# the parts of the variance covariance matrices of a partitioned adjustment that are needed for output.out, put
+# together from the cofactors of the junction unknowns and of the blocks (see partitionedIterate). It has the
+# functions of Covariance (covariance.py) that do not need N of the whole network
+# usage:
+#     cov = BlockCovariance(blocks, cofactors, p, sigma0hat)
+#     Clhat = cov.diagClhat()
+class BlockCovariance:
+    # constructor
+    # blocks: HelmertBlocks of the network
+    # cofactors: cofactors from partitionedIterate
+    # p: numpy array with the n weights (diagonal of P)
+    # sigma0hat: posteriori variance factor
+    def __init__(self, blocks, cofactors, p, sigma0hat):
+        self.blocks = blocks
+        self.cofactors = cofactors
+        self.p = np.ravel(p)
+        self.sigma0hat = sigma0hat
+        self.u = blocks.u
+
+    # Function to get the diagonal of Cxhat (variances of the unknowns)
+    # returns a numpy array of length u
+    def diagCxhat(self):
+        d = np.zeros(self.u)
+        d[self.blocks.junction] = self.cofactors['QJJ'].diagonal()
+        for B, piece in zip(self.blocks.blocks, self.cofactors['blocks']):
+            d[B['cols'][:B['interior']]] = piece['qx']
+        return self.sigma0hat * d
+
+    # Function to get the 2x2 blocks of Cxhat of all unknown points (used for the error ellipses)
+    # returns a (u/2)x2x2 numpy array, block k belongs to unknowns 2k and 2k+1
+    def pointBlocks(self):
+        blocks = np.zeros((self.u // 2, 2, 2))
+        junction = self.blocks.junction
+        QJJ = self.cofactors['QJJ']
+        k = np.arange(0, len(junction), 2)
+        blocks[junction[k] // 2] = np.stack([QJJ[k, k], QJJ[k, k + 1], QJJ[k + 1, k], QJJ[k + 1, k + 1]],
+                                            axis=1).reshape(-1, 2, 2)
+        for B, piece in zip(self.blocks.blocks, self.cofactors['blocks']):
+            blocks[B['cols'][:B['interior']:2] // 2] = piece['blocks']
+        return self.sigma0hat * blocks
+
+    # Function to get the diagonal of Clhat (variances of the corrected measurements)
+    # returns a numpy array of length n
+    def diagClhat(self):
+        d = np.zeros(len(self.p))
+        for B, piece in zip(self.blocks.blocks, self.cofactors['blocks']):
+            d[B['rows']] = piece['ql']
+        return self.sigma0hat * d
+
+    # Function to get the diagonal of Crhat (variances of the residuals)
+    # returns a numpy array of length n
+    def diagCrhat(self):
+        return self.sigma0hat / self.p - self.diagClhat()
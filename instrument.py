@@ -0,0 +1,194 @@
+import json
+import time
+
+
+# Instrument class
+# measures the time of the stages of an adjustment, and keeps counts (iterations, matrix sizes) and events
+# (e.g. the convergence of each iteration)
+# usage:
+#     inst = Instrument()
+#     inst.start('solve')
+#     ...
+#     inst.end('solve')
+#     inst.event('iteration', count=1, max_correction=0.1)
+#     inst.count('unknowns', 4)
+# A stage that is entered more than once (e.g. once per iteration) adds up its time and number of calls
+# hooks are called at the start and end of each stage and for each event, as hook(kind, name, info) with kind
+# 'start', 'end' or 'event', so that an external profiler or metrics sink can follow the run (see ProfilerHook)
+class Instrument:
+    enabled = True
+
+    # constructor
+    # hooks (optional): list of functions called as hook(kind, name, info)
+    def __init__(self, hooks=()):
+        self.hooks = list(hooks)
+        self.time0 = time.perf_counter()
+        self.stages = {}  # stage name -> {'time': total seconds, 'calls': number of calls}, in the order first used
+        self.spans = []  # (stage name, start, duration) of every call, in seconds since the constructor
+        self.events = []  # dictionaries with the name and time of the event and its info
+        self.counts = {}  # count name -> value
+        self.running = {}  # stage name -> start time of the stages that are running
+
+    # Function to start timing a stage
+    # returns nothing
+    # name: name of the stage
+    def start(self, name):
+        for hook in self.hooks:
+            hook('start', name, {})
+        self.running[name] = time.perf_counter()
+
+    # Function to stop timing a stage
+    # returns nothing
+    # name: name of the stage
+    def end(self, name):
+        end = time.perf_counter()
+        start = self.running.pop(name)
+        duration = end - start
+        s = self.stages.setdefault(name, {'time': 0.0, 'calls': 0})
+        s['time'] = s['time'] + duration
+        s['calls'] = s['calls'] + 1
+        self.spans.append((name, start - self.time0, duration))
+        for hook in self.hooks:
+            hook('end', name, {'time': duration})
+
+    # Function to time a stage, use as `with inst.stage(name):` instead of start and end
+    # name: name of the stage
+    def stage(self, name):
+        return StageTimer(self, name)
+
+    # Function to record an event
+    # name: name of the event
+    # info: numbers that describe the event (e.g. count=2, max_correction=0.01)
+    def event(self, name, **info):
+        self.events.append(dict(name=name, time=time.perf_counter() - self.time0, **info))
+        for hook in self.hooks:
+            hook('event', name, info)
+
+    # Function to set a count
+    # name: name of the count (e.g. 'iterations')
+    # value: number
+    def count(self, name, value):
+        self.counts[name] = value
+
+    # Function to get the total time of each stage
+    # returns a dictionary of stage name -> seconds
+    def times(self):
+        return {name: s['time'] for name, s in self.stages.items()}
+
+    # Function to write the timing section of output.out
+    # returns nothing
+    # file: file object to output to
+    def writeSection(self, file):
+        total = time.perf_counter() - self.time0
+        name_len = max([len(name) for name in self.stages] + [5]) + 4
+        fmt = '\n{:' + str(name_len) + '}{:>8}{:>14.6f}{:>10.1f}'
+        file.write(('{:' + str(name_len) + '}{:>8}{:>14}{:>10}').format('Stage', 'Calls', 'Time [s]', 'Share [%]'))
+        for name, s in self.stages.items():
+            file.write(fmt.format(name, s['calls'], s['time'], 100*s['time']/total if total > 0 else 0))
+        file.write('\n' + '-'*50 + '\nTotal Time:\t\t\t' + str(total) + ' seconds\n')
+        for name, value in self.counts.items():
+            file.write('\n' + name + ':\t' + str(value))
+
+    # Function to save all stages, spans, events and counts to a json file
+    # returns nothing
+    # filename: name of the json file
+    def writeTrace(self, filename):
+        f = open(filename, 'w')
+        json.dump({
+            'total': time.perf_counter() - self.time0,
+            'stages': self.stages,
+            'spans': [{'stage': name, 'start': start, 'time': duration} for name, start, duration in self.spans],
+            'events': self.events,
+            'counts': self.counts,
+        }, f, indent=1, default=float)
+        f.close()
+
+
+# StageTimer class
+# context manager made by Instrument.stage
+class StageTimer:
+    def __init__(self, inst, name):
+        self.inst = inst
+        self.name = name
+
+    def __enter__(self):
+        self.inst.start(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.inst.end(self.name)
+
+
+# NullInstrument class
+# used when instrumentation is off: it has the functions of Instrument but does nothing, so the cost of a stage
+# is 2 function calls
+class NullInstrument:
+    enabled = False
+
+    def start(self, name):
+        pass
+
+    def end(self, name):
+        pass
+
+    def stage(self, name):
+        return NULL_STAGE
+
+    def event(self, name, **info):
+        pass
+
+    def count(self, name, value):
+        pass
+
+    def times(self):
+        return {}
+
+
+# NullStage class
+# context manager of NullInstrument.stage that does nothing
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_STAGE = NullStage()
+NULL_INSTRUMENT = NullInstrument()
+
+
+# ProfilerHook class
+# hook for Instrument that runs cProfile during chosen stages
+# usage:
+#     profiler = ProfilerHook(['solve'])
+#     main(hooks=[profiler])
+#     profiler.print()
+class ProfilerHook:
+    # constructor
+    # stages (optional): list of stage names to profile (all stages by default)
+    def __init__(self, stages=None):
+        import cProfile
+        self.stages = stages
+        self.profile = cProfile.Profile()
+        self.depth = 0  # number of profiled stages that are running (stages can be inside each other)
+
+    def __call__(self, kind, name, info):
+        if self.stages is not None and name not in self.stages:
+            return
+        if kind == 'start':
+            if self.depth == 0:
+                self.profile.enable()
+            self.depth = self.depth + 1
+        elif kind == 'end':
+            self.depth = self.depth - 1
+            if self.depth == 0:
+                self.profile.disable()
+
+    # Function to print the functions that took the most time
+    # returns nothing
+    # sort (optional): column to sort by (see pstats)
+    # lines (optional): number of functions to print
+    def print(self, sort='cumulative', lines=20):
+        import pstats
+        pstats.Stats(self.profile).sort_stats(sort).print_stats(lines)
@@ -1,19 +1,79 @@
 from functions import *  # import everything from functions.py
 from datetime import datetime
+from cache import cachedReadfile, cachedOrdering, CACHE_DIR
+from warmstart import WarmStartStore, WARMSTART_DIR
+from covariance import Covariance
+from report import *
+from instrument import Instrument, NULL_INSTRUMENT
+from snooping import dataSnooping, writeSnooping, CRITICAL_VALUE
+from robust import robustIterate, ROBUST_METHODS
+from helmert import HelmertBlocks, BlockCovariance, partitionedIterate
 
 
 # main function
-# CNTFile: Filename of coordinates file
-# MESFile: Filename of measurements file
+# CNTFile: Filename of coordinates file, or a CNTTable that was already read (e.g. kept in memory by server.py)
+# MESFile: Filename of measurements file, or a MESTable that was already read. With tables, cache and warmstart must
+#          be directory names and network must be given
 # CNTheader: number of header lines in coordinates file (default is 1)
 # MESheader: number of header lines in measurements file (default is 1)
 # suppress_print: Set to True to suppress outputs to the console
 # plot: Set to False to suppress plotting
 # sigma0: a-priori variance factor. Chosen as 1 by default
 # maxit: maximum iterations before breaking the loop
-def main(CNTFile='', MESFile='', CNTheader=1, Mesheader=1, suppress_print=False, plot=True, sigma0=1, maxit=100):
+# cache: Set to True to keep the parsed .cnt and .mes files in a binary cache next to them (see cache.py),
+#        or to a directory name to keep the cache there. The fill-reducing order of the unknowns of sparse
+#        networks is kept in the same cache
+# sparse: Set to True/False to force sparse/dense matrices. By default sparse matrices are used
+#         automatically for large networks (see useSparse in functions.py)
+# outdir: directory to write output.out and Figures.pdf to (the working directory by default)
+# show: Set to True/False to show the network figure or not (plt.show() pauses the program). By default it is only
+#       shown when matplotlib can open windows
+# plot_points: list of point names. If given, only these points get error ellipses and names on the figures
+# plot_workers: number of worker processes that save the to-scale error ellipses. With more than 1 they are saved to
+#               Figures-1.pdf, Figures-2.pdf, ... next to Figures.pdf
+# warmstart: Set to True to start from the converged unknowns of the last run of this network (see warmstart.py),
+#            kept in a .lswarm directory next to the .cnt file, or to a directory name to keep them there
+# network: identity of the network in the warm start store (the absolute path of the .cnt file by default)
+# matrix_policy: how to write variance covariance matrices with more than max_matrix elements to output.out:
+#                'truncate' (top left block), 'summary' (diagonal only) or 'full' (see report.py)
+# max_matrix: largest matrix that is written in full to output.out
+# archive: Set to False to not save the numeric results to results.npz (see writeArchive in report.py)
+# full_covariance: Set to True to write the full variance covariance matrices in sections 6-8 instead of only their
+#                  diagonals
+# timing: Set to False to leave out the timing of the stages at the end of output.out (see instrument.py)
+# trace: name of a json file to save the timing of every stage and iteration to
+# hooks: list of functions that are called at the start and end of every stage (see Instrument in instrument.py),
+#        e.g. a ProfilerHook
+# snooping: Set to True to find and remove blunders by iterative data snooping (see snooping.py). The removed
+#           measurements are listed in section 10 of output.out and the rest of the output is without them
+# critical: critical value of the standardized residuals for data snooping
+# robust: name of a robust estimation method ('huber', 'danish' or 'tukey', see robust.py). The measurements are then
+#         re-weighted every iteration from their standardized residuals, and the final weights are written after
+#         the residuals in section 4 of output.out
+# robust_c: tuning constant of the robust method (see ROBUST_METHODS in robust.py for the defaults)
+# partition: number of regional blocks to split the network into for a partitioned (Helmert blocking) adjustment
+#            (see helmert.py). The result is the same as without it. It can not be used with full_covariance
+# partition_workers: number of worker processes that form and reduce the normal equations of the blocks
+# returns a dictionary with a summary of the adjustment (iterations, convergence, variance factors, timing,
+# number of measurements/unknowns, adjusted coordinates, failed measurement IDs and the time of each stage)
+def main(CNTFile='', MESFile='', CNTheader=1, Mesheader=1, suppress_print=False, plot=True, sigma0=1, maxit=100,
+         sparse=None, cache=False, outdir='', show=None, warmstart=False, network='', full_covariance=False,
+         matrix_policy='truncate', max_matrix=MAX_MATRIX, archive=True, plot_points=None,
+         plot_workers=1, timing=True, trace='', hooks=(), snooping=False, critical=CRITICAL_VALUE,
+         robust=None, robust_c=None, partition=None, partition_workers=1):
+    if robust is not None and snooping:
+        raise Exception("Use either robust estimation or data snooping, not both")
+    if partition is not None and (robust is not None or snooping):
+        raise Exception("The partitioned adjustment can not be combined with robust estimation or data snooping")
+    if partition is not None and full_covariance:
+        raise Exception("The partitioned adjustment only gives the diagonals of the variance covariance matrices")
     # start timer
     time0 = datetime.now()
+    # time the stages of the run (see instrument.py), only if the timings are used
+    inst = NULL_INSTRUMENT
+    if timing or trace != '' or hooks:
+        inst = Instrument(hooks)
+    inst.start('discover')
     # if no CNT filename was provided
     if CNTFile == '':
         # automatically find CNT file in directory
@@ -22,101 +82,213 @@ def main(CNTFile='', MESFile='', CNTheader=1, Mesheader=1, suppress_print=False,
     if MESFile == '':
         # automatically find CNT file in directory
         MESFile = FindFiles('mes')
+    inst.end('discover')
 
     # read in data from cnt and mes files
-    CNT = readfile(CNTFile, CNTheader)
-    MES = readfile(MESFile, Mesheader)
+    inst.start('parse')
+    cache_dir = None
+    if isinstance(CNTFile, CNTTable) and isinstance(MESFile, MESTable):
+        # already read. The cache and the warm start store are found from the file names by default, so they need
+        # to be given explicitly with tables
+        if cache is True:
+            raise ValueError("cache=True needs the file names, give the cache directory to use it with tables")
+        if warmstart is True or (warmstart and network == ''):
+            raise ValueError("warmstart with tables needs the warm start directory and the network name")
+        if cache:
+            cache_dir = cache
+        CNT = CNTFile
+        MES = MESFile
+    elif cache:
+        cache_dir = ''  # next to the files
+        if cache is not True:
+            cache_dir = cache
+        CNT = cachedReadfile(CNTFile, CNTheader, cache_dir)
+        MES = cachedReadfile(MESFile, Mesheader, cache_dir)
+    else:
+        CNT = readfile(CNTFile, CNTheader)
+        MES = readfile(MESFile, Mesheader)
+    inst.end('parse')
+    inst.start('setup')
+    # index the points in CNT by name (also checks for duplicate point names)
+    points = PointRegistry(CNT)
 
     # build unknowns vector x
     # x consists of (X,Y) of each unknown point
     x = buildx(CNT)
-    # build weight matrix P
-    P = buildP(MES, sigma0)
+    # seed x with the converged unknowns of the last run
+    if warmstart:
+        warm_dir = warmstart
+        if warmstart is True:
+            warm_dir = os.path.join(os.path.dirname(os.path.abspath(CNTFile)), WARMSTART_DIR)
+        if network == '':
+            network = os.path.abspath(CNTFile)
+        store = WarmStartStore(warm_dir)
+        x, seeded, cold_iterations = store.seed(network, points, x)
+    # choose between dense and sparse matrices
+    if sparse is None:
+        sparse = useSparse(len(MES), len(x))
+    # build weight matrix P (only the diagonal is stored in sparse mode)
+    P = buildP(MES, sigma0, sparse)
+    # parse the point references of all measurements once
+    obs = ObsIndex(CNT, MES, points)
+    # the orientations of direction sets are eliminated with the a-priori weights (see orientationCentring), which
+    # the robust weights would change
+    if robust is not None and obs.orientations > 0:
+        raise Exception("Robust estimation can not be used with direction sets")
+    inst.end('setup')
+    # order the unknowns of sparse N to reduce the fill of its factorization, once for all iterations
+    perm = None
+    if sparse and partition is None:
+        inst.start('ordering')
+        if cache:
+            perm = cachedOrdering(obs, len(x), cache_dir or os.path.join(os.path.dirname(os.path.abspath(CNTFile)),
+                                                                         CACHE_DIR))
+        else:
+            perm = unknownOrdering(obs, len(x))
+        inst.end('ordering')
 
     # Main loop START ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # some settings for the loop. These could be put in a separate settings file
-    deltasum = 100  # initialize deltasum to some large value
-    # threshold for minimum deltasum should be 1/2 of the smallest measurement standard deviation
-    threshold = 0.5*min([i[4] for i in MES])
-    count = 1  # initialize iteration counter
-    # loop until the absolute sum of the elements in delta is less than some small threshold
-    while deltasum > threshold:
+    # the iterations converge when no coordinate changes by more than threshold meters (see convergenceTolerance)
+    threshold = convergenceTolerance(MES, obs, x)
+    partition_text = ''
+    if robust is not None:
+        # the robust weights replace P for the rest of the adjustment
+        p = buildp(MES, sigma0)
+        if robust_c is None:
+            robust_c = ROBUST_METHODS.get(robust)
+        x, A, w, delta, Nfactor, count, converged, factors, robust_v = robustIterate(
+            CNT, MES, x, p, obs, sparse, threshold, maxit, robust, robust_c, sigma0, suppress_print, inst, perm)
+        P = sp.diags(p*factors, format='csr') if sparse else np.diag(p*factors)
+    elif partition is not None:
+        # the blocks are formed and reduced in the worker processes, only the junction points are solved here
+        inst.start('partition')
+        helmert_blocks = HelmertBlocks(CNT, MES, obs, partition, sigma0, partition_workers)
+        inst.end('partition')
+        with helmert_blocks:
+            x, rhat, delta, cofactors, count, converged = partitionedIterate(x, threshold, maxit, helmert_blocks,
+                                                                             suppress_print, inst)
+        partition_text = ("\nPartition:\t\t" + str(len(helmert_blocks.blocks)) + " blocks, "
+                          + str(len(helmert_blocks.junction) // 2) + " junction points")
+    else:
+        x, A, w, delta, Nfactor, count, converged = iterate(CNT, MES, x, P, obs, sparse, threshold, maxit,
+                                                            suppress_print, inst, perm)
+    # remove blunders one at a time from the factorization, then iterate once more without them
+    allMES = MES
+    removed = np.zeros(0, dtype=int)
+    if snooping:
+        inst.start('data snooping')
+        removed, statistics, snoop_delta = dataSnooping(A, A @ delta + w, P.diagonal(), Nfactor, sigma0, critical,
+                                                        sets=obs.orientation)
+        inst.end('data snooping')
+        if len(removed) > 0:
+            keep = np.ones(len(MES), dtype=bool)
+            keep[removed] = False
+            MES = MES.take(keep)
+            P = buildP(MES, sigma0, sparse)
+            obs = ObsIndex(CNT, MES, points)
+            if sparse:
+                perm = unknownOrdering(obs, len(x))
+            x, A, w, delta, Nfactor, recount, converged = iterate(CNT, MES, x + snoop_delta, P, obs, sparse, threshold,
+                                                                  maxit, suppress_print, inst, perm)
+            count = count + recount - 1
         if not suppress_print:
-            print("Iteration: " + str(count))  # print iteration number for the user
-        # also break if maximum number of iterations is reached
-        if count >= maxit:
-            print("Maximum number of iterations reached")
-            print("Break")
-            break
-
-        # build the design matrix A and the misclosure vector w
-        A, w = buildAw(CNT, MES, x)
-
-        # calculate solution
-        At = A.transpose()  # transpose design matrix
-        u = At @ P @ w
-        N = At @ P @ A
-        Cx = np.linalg.inv(N)
-        delta = -Cx @ u
-
-        deltasum = 0
-        # for each element of delta
-        for i in range(0, len(delta)):
-            x[i] = x[i] + delta[i]  # add to x
-            deltasum = deltasum + abs(delta[i])  # sum absolute value to deltasum
-
-        if not suppress_print:
-            print("deltasum = " + str(deltasum[0]) + "\n")
-        count = count + 1  # iterate count
+            print("Data snooping removed " + str(len(removed)) + " measurements")
+    # save the converged unknowns for the next run
+    warm_text = ''
+    warm_results = None
+    if warmstart:
+        saved = 0
+        if seeded == 0:  # started from the .cnt values
+            cold_iterations = count - 1
+        elif cold_iterations > 0:
+            saved = cold_iterations - (count - 1)
+        if converged:
+            inst.start('warm start')
+            store.save(network, points, x, cold_iterations)
+            inst.end('warm start')
+        warm_text = ("\nWarm Start:\t\t" + str(seeded) + " of " + str(len(points.unknown_rows))
+                     + " unknown points seeded, " + str(saved) + " iterations saved")
+        warm_results = {'seeded': seeded, 'saved': saved}
     # Main loop END ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     time1 = datetime.now()
     timetaken = time1 - time0
 
-    # plot points using matplotlib
-    if plot:
-        main_ax = plotCNT(CNT, x)
+    inst.start('covariance')
+    # Calculate residuals (the partitioned adjustment found them block by block)
+    if partition is None:
+        rhat = A @ delta + w
+    # Adjusted observations
+    lhat = MES.value[:, None] + rhat
+    # Calculate posteriori variance factor and unit variance factor
+    # every direction set also has an orientation unknown (eliminated from x, see orientationCentring)
+    dof = len(MES) - len(x) - obs.orientations
+    sigma0hat = (rhat.transpose() @ P @ rhat)/dof
+    sigma0hat = sigma0hat[0][0]  # convert to float from ndarray
+    unitvar = sigma0hat/sigma0
+    # the variance covariance matrices are only formed in full when sections 6-8 are written in full,
+    # otherwise only their diagonals and the 2x2 blocks of the points are calculated (see covariance.py)
+    if partition is None:
+        cov = Covariance(Nfactor, A, P.diagonal(), sigma0hat, obs.orientation)
+    else:
+        cov = BlockCovariance(helmert_blocks, cofactors, P.diagonal(), sigma0hat)
+    if full_covariance:
+        # Calculate the v-c matrix of unknowns Cxhat
+        Cxhat = cov.fullCxhat()
+        # Calculate the v-c matrix of measurements Clhat
+        Clhat = cov.fullClhat(Cxhat)
+        # Calculating the v-c matrix of residuals Crhat (P is diagonal, so its inverse is 1/diagonal)
+        Crhat = cov.fullCrhat(Clhat)
+    else:
+        Cxhat = cov.diagCxhat()
+        Clhat = cov.diagClhat()
+        Crhat = cov.sigma0hat / cov.p - Clhat
+    # Calculate error ellipse of each unknown point from its 2x2 sub-matrix in Cxhat
+    blocks = cov.pointBlocks()
+    semi_major, semi_minor, theta = errorEllipses(blocks)
+    inst.end('covariance')
+
+    inst.start('tests')
+    # Check if the residuals pass the statistical test
+    testresults = sTest(rhat, Crhat)
+    inst.end('tests')
 
+    inst.start('report')
     # Open output file
-    out = open("output.out", "w")
+    if outdir != '':
+        os.makedirs(outdir, exist_ok=True)
+    out = open(os.path.join(outdir, "output.out"), "w")
     divider = '\n\n' + '*'*100 + '\n'
     line = '\n' + '-'*50
     # count number of angle/dist measurements
-    num_angle = sum([i[2] == 'Angle' for i in MES])
-    num_dist = sum([i[2] == 'Dist' for i in MES])
+    num_angle = np.count_nonzero(MES.type == ANGLE)
+    num_dist = np.count_nonzero(MES.type == DIST)
+    # the other measurement types and the eliminated orientations are only listed when the network has them
+    other_text = ''
+    for code in range(0, len(OBSERVATION_TYPES)):
+        count_type = np.count_nonzero(MES.type == code)
+        if code not in (ANGLE, DIST) and count_type > 0:
+            other_text = other_text + "\n" + OBSERVATION_TYPES[code].name + " Measurements:\t\t" + str(count_type)
+    unknowns_text = ''
+    if obs.orientations > 0:
+        unknowns_text = "\nOrientation unknowns:\t\t" + str(obs.orientations) + " (eliminated)"
     out.write(
 """Geodetic Network Least Squares Adjustment
 Wynand Tredoux -- September 2020\n
 Execution Date:\t""" + str(time0) + """
 Execution Time:\t""" + str(timetaken.total_seconds()) + """ seconds
-Itterations:\t""" + str(count-1) + """
+Itterations:\t""" + str(count-1) + warm_text + partition_text + """
 Threshold:\t\t""" + str(threshold) + """
 sigma0:\t\t\t""" + str(sigma0) + divider + """
 Observations/Unknowns Summery\n
 Angle Measurements:\t\t\t""" + str(num_angle) + """
-Distance Measurements:\t\t""" + str(num_dist) + line + """
+Distance Measurements:\t\t""" + str(num_dist) + other_text + line + """
 Total Measurements:\t\t\t""" + str(len(MES)) + """
-Total unknowns:\t\t\t\t""" + str(len(x)) + line + """
-Total Degrees of Freedom:\t""" + str(len(MES) - len(x)) + """
+Total unknowns:\t\t\t\t""" + str(len(x)) + unknowns_text + line + """
+Total Degrees of Freedom:\t""" + str(dof) + """
 \n"""
     )
 
-    # Calculate residuals
-    rhat = A @ delta + w
-    # Adjusted observations
-    lhat = np.zeros([len(MES), 1])
-    for i in range(0, len(MES)):
-        lhat[i] = MES[i][3] + rhat[i]
-    # Calculate posteriori variance factor and unit variance factor
-    sigma0hat = (rhat.transpose() @ P @ rhat)/(len(MES) - len(x))
-    sigma0hat = sigma0hat[0][0]  # convert to float from ndarray
-    unitvar = sigma0hat/sigma0
-    # Calculate the v-c matrix of unknowns Cxhat
-    Cxhat = sigma0hat * Cx
-    # Calculate the v-c matrix of measurements Clhat
-    Clhat = A @ Cxhat @ At
-    # Calculating the v-c matrix of residuals Crhat
-    Crhat = sigma0hat * np.linalg.inv(P) - Clhat
-
     # Write estimates unknowns to output file
     out.write(
 """Posteriori Variance Factor:\t""" + str(sigma0hat) + """
@@ -126,97 +298,67 @@ Point Name\tx\ty\tdiffx\tdiffy"""
     )
     # get old unknown points from CNT
     # compare with estimates coordinates
-    max_name_len = max([len(i[0]) for i in CNT]) + 4  # maximum name length in CNT plus 4 buffer spaces
-    count = 0
-    unknown_points = []
-    for i in range(0,len(CNT)): # for all points in CNT
-        P = Point(CNT[i])
-        if P.isUnknown(): # if point is unknown
-            unknown_points.append(P)
-            # get estimates x and y from x
-            xest = x[count*2]
-            yest = x[count*2 + 1]
-            # calc estimated(x,y) - initial(x,y)
-            diffx = xest - P.x
-            diffy = yest - P.y
-            max_num_len = max(numlen([P.x, P.y, diffx, diffy])) # find maximum length of numbers not including decimals
-            decimals = 4  # number of decimal places to keep
-            # print to output file
-            outstr = '\n{:' + str(max_name_len) + '}'
-            # spacing should be max_num_len + decimals + 2 for decimal point and signs + 2 for buffer
-            tmp = '{:' + str(max_num_len + decimals + 4) + '.' + str(decimals) + 'f}'
-            outstr = outstr + tmp*4
-            outstr = outstr.format(P.name, xest, yest, diffx, diffy)
-            out.write(outstr)
-            count = count + 1
+    max_name_len = np.char.str_len(CNT.name).max() + 4  # maximum name length in CNT plus 4 buffer spaces
+    unknown_rows = points.unknown_rows
+    unknown_names = CNT.name[unknown_rows]
+    # estimated (x,y) of the unknown points
+    xy = np.reshape(x, (-1, 2))
+    # 4 decimal places are kept, the columns are as wide as their longest number
+    writeTable(out, unknown_names, [xy[:, 0], xy[:, 1], xy[:, 0] - CNT.x[unknown_rows], xy[:, 1] - CNT.y[unknown_rows]],
+               ['%.4f']*4, max_name_len)
 
     # write rhat to file
     out.write(divider + "\nVector of Residuals\n")
-    np.savetxt(out, rhat, fmt='%+1.6E')
+    writeArray(out, rhat, '%+1.6E')
+    # the weights of a robust adjustment belong with the residuals they were found from
+    if robust is not None:
+        out.write("\nRobust Weights (" + robust + ", c = " + str(robust_c)
+                  + ")\n\nMeasurement ID\tStandardized Residual\tWeight Factor\tFinal Weight")
+        writeTable(out, MES.id, [robust_v, factors, P.diagonal()], ['%+.4f', '%.6f', '%.6E'],
+                   np.char.str_len(MES.id).max() + 4)
+        out.write("\n")
     # Write lhat to file
     out.write(divider[1:] + "\nVector of Corrected Measurements\n")
-    np.savetxt(out, lhat, fmt='%12.6f')
-    # Write Cxhat to file
-    out.write(divider[1:] + "\nVariance Covariance Matrix of Unknowns\n")
-    np.savetxt(out, Cxhat, fmt='%+1.4E', delimiter='\t')
-    # Write Clhat to file
-    out.write(divider[1:] + "\nVariance Covariance Matrix of Corrected Measurements\n")
-    np.savetxt(out, Clhat, fmt='%+1.4E', delimiter='\t')
-    # Write Crhat to file
-    out.write(divider[1:] + "\nVariance Covariance Matrix of Residuals\n")
-    np.savetxt(out, Crhat, fmt='%+1.4E', delimiter='\t')
-
-    # Calculate error ellipse
+    writeArray(out, lhat, '%12.6f')
+    # only the diagonals are written unless full_covariance is set
+    diag_only = ''
+    if not full_covariance:
+        diag_only = " (diagonal only)"
+    # Write Cxhat, Clhat and Crhat to file (matrices with more than max_matrix elements are handled by matrix_policy)
+    writeMatrix(out, divider[1:] + "\nVariance Covariance Matrix of Unknowns" + diag_only, Cxhat, '%+1.4E',
+                matrix_policy, max_matrix)
+    writeMatrix(out, divider[1:] + "\nVariance Covariance Matrix of Corrected Measurements" + diag_only, Clhat,
+                '%+1.4E', matrix_policy, max_matrix)
+    writeMatrix(out, divider[1:] + "\nVariance Covariance Matrix of Residuals" + diag_only, Crhat, '%+1.4E',
+                matrix_policy, max_matrix)
+
     out.write(divider[1:] + """\nError Ellipse\n
 Name\tSemi-Major axis\tSemi-Minor axis\ttheta"""
               )
-    # for each 2x2 sub-matrix in Cxhat
-    for i in range(0, len(Cxhat), 2):
-        # extract sub matrix
-        subM = np.zeros([2, 2])
-        subM[0][0] = Cxhat[i][i]
-        subM[0][1] = Cxhat[i][i+1]
-        subM[1][1] = Cxhat[i+1][i+1]
-        subM[1][0] = Cxhat[i+1][i]
-        # calc eigen values
-        evals = np.linalg.eigvals(subM)
-        lmax = evals.max()
-        lmin = evals.min()
-        # calc semi-minor/major axis'
-        semi_minor = math.sqrt(lmin)
-        semi_major = math.sqrt(lmax)
-        # calc orientation of semi-major axis
-        theta = 0.5 * math.atan2(-2*subM[0][1], subM[1][1] - subM[0][0])  # theta is the angle counter-clockwise from the x axis to the semi-major axis
-
-        # write to file
-        outstr = '\n{:' + str(max_name_len) + '}'
-        max_num_len = max(numlen([theta, lmax, lmin]))  # find maximum length of numbers not including decimals
-        decimals = 8  # number of decimal places to keep
-        # spacing should be max_num_len + decimals + 2 for decimal point and signs + 3 for buffer
-        tmp = '{:' + str(max_num_len + decimals + 5) + '.' + str(decimals) + 'f}'
-        # spacing for E should be decimals + 1 for E + 1 for sign + 2 for exponent + 2 for number and decimal + 4 for buffer
-        tmp2 = '{:' + str(decimals + 10) + '.' + str(decimals) + 'E}'
-        outstr = outstr + tmp2*2 + tmp*1
-        outstr = outstr.format(unknown_points[int(i/2)].name, semi_major, semi_minor, theta)
-        out.write(outstr)
-
-        # draw error ellipses on figure f1
-        if plot:
-            drawEE(main_ax, unknown_points[int(i/2)].x, unknown_points[int(i/2)].y, semi_major, semi_minor, theta, scale=10000, name=unknown_points[int(i/2)].name)
-    # add legend to f1
-    if plot:
-        plt.figure(main_ax.figure.number)  # make main_ax the active window
-        legend_elements = [Line2D([0], [0], marker='o', color='w', markerfacecolor='#fc4c4c', label='Unknown'),
-                           Line2D([0], [0], marker='o', color='w', markerfacecolor='#03c2fc', label='Known'),
-                           pat.Ellipse(xy=(0, 0), width=0, height=0,
-                                       angle=0, facecolor='none', edgecolor='red', label='Error Ellipse (exagerated)')]
-        plt.legend(handles=legend_elements, bbox_to_anchor=(1.1, 1), loc='upper right')
+    # 8 decimal places are kept
+    writeTable(out, unknown_names, [semi_major, semi_minor, theta], ['%.8E', '%.8E', '%.8f'], max_name_len)
 
-    # Check if the residuals pass the statistical test
-    testresults = sTest(rhat, Crhat)
     # add results to text file
     out.write(divider + "\nObservations test\n\n")
     writeResults(testresults, MES, out)
+    if snooping:
+        out.write("\n\nData Snooping\n\n")
+        writeSnooping(removed, statistics, allMES, critical, sigma0, out)
+
+    # save the numeric results to a binary archive
+    if archive:
+        # the full Clhat and Crhat are left out, they are much larger than Cxhat and can be made from it
+        Cxfull = None
+        if full_covariance:
+            Cxfull = Cxhat
+        writeArchive(os.path.join(outdir, "results.npz"), {
+            'names': unknown_names, 'x': x, 'x0': buildx(CNT), 'ids': MES.id, 'rhat': rhat.ravel(),
+            'lhat': lhat.ravel(), 'point_blocks': blocks, 'Cxhat_diag': blocks.reshape(-1, 4)[:, [0, 3]].ravel(),
+            'Clhat_diag': Clhat.diagonal() if Clhat.ndim == 2 else Clhat,
+            'Crhat_diag': Crhat.diagonal() if Crhat.ndim == 2 else Crhat, 'Cxhat': Cxfull,
+            'passed': np.array(testresults, dtype=bool), 'sigma0': sigma0, 'sigma0hat': sigma0hat, 'unitvar': unitvar,
+            'iterations': count - 1, 'converged': converged, 'removed_ids': allMES.id[removed],
+            'robust_factors': factors if robust is not None else None})
 
     if not suppress_print:
         print('posteriori variance factor: ' + str(sigma0hat)
@@ -224,14 +366,53 @@ Name\tSemi-Major axis\tSemi-Minor axis\ttheta"""
               )
         print('done!')
     out.close()
-    # save figures to pdf
-    if plot:
-        SaveFigs("Figures.pdf")
-    # show the figure (this also pauses the program which is why it is last)
+    inst.end('report')
+
+    # plot the network with exaggerated error ellipses and the to-scale error ellipse of each unknown point
     if plot:
-        plt.show()
-        # close all
-        plt.close('all')
+        inst.start('plot')
+        # matplotlib is only imported when there is something to plot (see plotting.py)
+        from plotting import plotNetwork, showFigures
+        plotNetwork(os.path.join(outdir, "Figures.pdf"), CNT, x, points, semi_major, semi_minor, theta, plot_points,
+                    plot_workers)
+        inst.end('plot')
+        # show the figure (this also pauses the program which is why it is last)
+        showFigures(show)
+
+    # add the timing of the stages to the output file and the trace
+    inst.count('Measurements', len(MES))
+    inst.count('Unknowns', len(x))
+    inst.count('Iterations', count - 1)
+    inst.count('Sparse', bool(sparse))
+    # the partitioned adjustment has no A of the whole network
+    if partition is None:
+        inst.count('Non-zeros in A', int(A.nnz) if sparse else int(np.count_nonzero(A)))
+    else:
+        inst.count('Blocks', len(helmert_blocks.blocks))
+    if timing:
+        out = open(os.path.join(outdir, "output.out"), "a")
+        out.write(divider + "\nTiming\n\n")
+        inst.writeSection(out)
+        out.close()
+    if trace != '':
+        inst.writeTrace(trace)
+
+    # summary of the adjustment
+    return {
+        'iterations': count - 1,
+        'converged': converged,
+        'sigma0hat': sigma0hat,
+        'unitvar': unitvar,
+        'time': timetaken.total_seconds(),
+        'measurements': len(MES),
+        'unknowns': len(x),
+        'x': dict(zip(CNT.name[points.unknown_rows].tolist(), np.reshape(x, (-1, 2)).tolist())),
+        'failed': MES.id[np.logical_not(testresults)].tolist(),
+        'removed': allMES.id[removed].tolist(),
+        'weights': dict(zip(MES.id.tolist(), factors.tolist())) if robust is not None else None,
+        'warmstart': warm_results,
+        'timing': inst.times(),
+    }
 
 
 
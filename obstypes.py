@@ -0,0 +1,165 @@
+import numpy as np
+import math
+
+
+# ObservationType class
+# a type of measurement in the Type column of .mes files. A type gives:
+#     name: name of the type in the Type column
+#     points: number of point names in the Info column (separated by '_')
+#     angular: True if the values are angles in 'D M S' with standard deviations in arc seconds. They are converted
+#              to radians, and the misclosures are taken between -pi and pi
+#     oriented: True if the measurements that share their first point also share an unknown orientation (the zero
+#               direction of a direction set). The orientation is eliminated from the adjustment (see buildAw)
+#     kernel(): the estimated values and the partial derivatives of all measurements of the type at once
+#     resolution(): the smallest position change the measurements can detect (see convergenceTolerance)
+# New types are subclasses that are added with registerType. buildAw calls the kernel of each type once with all of
+# its measurements, so the number of types does not slow down the loop over the measurements
+class ObservationType:
+    name = ''
+    points = 2
+    angular = False
+    oriented = False
+
+    # Function to convert the Value and Std columns of measurements of this type
+    # returns value, std as numpy arrays (in meters or radians)
+    # values: list of the texts in the Value column
+    # std: numpy array of the numbers in the Std column
+    def parse(self, values, std):
+        if not self.angular:
+            return np.array(values, dtype=float), std
+        # 'D M S' with exactly 2 spaces
+        values = [str(value) for value in values]
+        if any(value.count(' ') != 2 for value in values):
+            raise ValueError()
+        D, M, S = np.array(' '.join(values).split(' '), dtype=float).reshape(-1, 3).T
+        # also convert standard deviation from arcseconds to rads
+        return (D + M / 60 + S / 3600) * math.pi/180, std/3600 * math.pi/180
+
+    # Function to get the estimated values of measurements from the current coordinates, and their partial
+    # derivatives
+    # returns estimated, partials as a tuple:
+    #     estimated: numpy array of the k estimated values
+    #     partials: list of (slot, dfdx, dfdy), the derivatives for (x,y) of the point in column slot of pts. A point
+    #               that is in more than 1 slot gets the sum of its derivatives
+    # XY: (number of points)x2 numpy array of the current (x,y) of every point in CNT
+    # pts: kxpoints numpy int array of the rows in CNT of the points of each measurement (in the order of Info)
+    def kernel(self, XY, pts):
+        raise Exception("Observation type '" + self.name + "' has no kernel")
+
+    # Function to get the smallest position change in meters that each measurement can detect
+    # returns a numpy array of length k
+    # XY, pts: see kernel
+    # std: numpy array of the k standard deviations
+    def resolution(self, XY, pts, std):
+        if not self.angular:
+            return std
+        # an angle sees a position change of its standard deviation (in radians) times its sight
+        return std*np.hypot(*(XY[pts[:, 1]] - XY[pts[:, 0]]).T)
+
+
+# Angle type, Info Pj_Pi_Pk: angle at Pi between Pj (to) and Pk (from), the direction of Pk minus the direction of Pj
+# (directions counter-clockwise from the x axis)
+class Angle(ObservationType):
+    name = 'Angle'
+    points = 3
+    angular = True
+
+    def kernel(self, XY, pts):
+        dxj = XY[pts[:, 0], 0] - XY[pts[:, 1], 0]
+        dyj = XY[pts[:, 0], 1] - XY[pts[:, 1], 1]
+        dxk = XY[pts[:, 2], 0] - XY[pts[:, 1], 0]
+        dyk = XY[pts[:, 2], 1] - XY[pts[:, 1], 1]
+        dj2 = dxj**2 + dyj**2  # squared distance Pi -> Pj
+        dk2 = dxk**2 + dyk**2  # squared distance Pi -> Pk
+        estimated = np.mod(np.arctan2(dyk, dxk) - np.arctan2(dyj, dxj), 2*math.pi)
+        return estimated, [(1, dyk/dk2 - dyj/dj2, -dxk/dk2 + dxj/dj2), (0, dyj/dj2, -dxj/dj2), (2, -dyk/dk2, dxk/dk2)]
+
+    def resolution(self, XY, pts, std):
+        sight_j = np.hypot(*(XY[pts[:, 0]] - XY[pts[:, 1]]).T)
+        sight_k = np.hypot(*(XY[pts[:, 2]] - XY[pts[:, 1]]).T)
+        return std*np.minimum(sight_j, sight_k)
+
+
+# Dist type, Info Pi_Pj: horizontal distance between Pi and Pj
+class Dist(ObservationType):
+    name = 'Dist'
+
+    def kernel(self, XY, pts):
+        dx = XY[pts[:, 0], 0] - XY[pts[:, 1], 0]
+        dy = XY[pts[:, 0], 1] - XY[pts[:, 1], 1]
+        estimated = np.sqrt(dx**2 + dy**2)
+        return estimated, [(0, dx/estimated, dy/estimated), (1, -dx/estimated, -dy/estimated)]
+
+
+# Azimuth type, Info P1_P2: grid azimuth from P1 to P2 (clockwise from the y axis)
+class Azimuth(ObservationType):
+    name = 'Azimuth'
+    angular = True
+
+    def kernel(self, XY, pts):
+        dx = XY[pts[:, 1], 0] - XY[pts[:, 0], 0]
+        dy = XY[pts[:, 1], 1] - XY[pts[:, 0], 1]
+        d2 = dx**2 + dy**2
+        estimated = np.mod(np.arctan2(dx, dy), 2*math.pi)
+        return estimated, [(0, -dy/d2, dx/d2), (1, dy/d2, -dx/d2)]
+
+
+# Direction type, Info At_To: direction from At to To in a direction set (an azimuth minus the unknown orientation
+# of the set). All directions measured at the same point are 1 set with 1 orientation
+class Direction(Azimuth):
+    name = 'Direction'
+    oriented = True
+
+
+# DX type, Info P1_P2: x2 - x1. With DY it gives the horizontal components of a GNSS baseline (the 2 components are
+# 2 measurements, so they are taken as uncorrelated)
+class DX(ObservationType):
+    name = 'DX'
+    axis = 0
+
+    def kernel(self, XY, pts):
+        estimated = XY[pts[:, 1], self.axis] - XY[pts[:, 0], self.axis]
+        one = np.ones(len(pts))
+        zero = np.zeros(len(pts))
+        if self.axis == 0:
+            return estimated, [(0, -one, zero), (1, one, zero)]
+        return estimated, [(0, zero, -one), (1, zero, one)]
+
+
+# DY type, Info P1_P2: y2 - y1 (see DX)
+class DY(DX):
+    name = 'DY'
+    axis = 1
+
+
+# registered observation types, indexed by type code (MESTable.type)
+OBSERVATION_TYPES = []
+
+
+# Function to add an observation type
+# returns the type code of the new type
+# obstype: ObservationType (an instance of a subclass)
+def registerType(obstype):
+    if typeCode(obstype.name) >= 0:
+        raise Exception("Observation type '" + obstype.name + "' is already registered")
+    OBSERVATION_TYPES.append(obstype)
+    return len(OBSERVATION_TYPES) - 1
+
+
+# Function to get the type code of an observation type name as used in .mes files
+# returns the type code, or -1 if the name is not a registered type
+# name: name of the type
+def typeCode(name):
+    for code in range(0, len(OBSERVATION_TYPES)):
+        if OBSERVATION_TYPES[code].name == name:
+            return code
+    return -1
+
+
+# type codes of the built-in types (angles and distances keep their codes 0 and 1)
+ANGLE = registerType(Angle())
+DIST = registerType(Dist())
+AZIMUTH = registerType(Azimuth())
+DIRECTION = registerType(Direction())
+COORD_DX = registerType(DX())
+COORD_DY = registerType(DY())
@@ -0,0 +1,215 @@
+# plotting of the adjusted network and its error ellipses
+# matplotlib is only imported by this module, so the numerical modules (functions.py, main.py, ...) start without it.
+# main imports this module when plot=True
+import numpy as np
+import os
+import matplotlib
+import matplotlib.pyplot as plt
+import matplotlib.patches as pat
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.collections import EllipseCollection, LineCollection
+from matplotlib.figure import Figure
+from matplotlib.lines import Line2D
+from concurrent.futures import ProcessPoolExecutor
+from classes import PointRegistry
+
+# networks with more points than this only get the names of the chosen points (plot_points in main) on the plot
+LABEL_LIMIT = 500
+
+
+# Function to plot all coordinates from CNT
+# all points are drawn as 1 scatter collection
+# returns ax, the matplotlib axis object
+# CNT: CNTTable of coordinates
+# x: array with estimated unknown values
+# points (optional): PointRegistry of CNT. It is built from CNT if not given
+# labels (optional): boolean numpy array, True for the rows of CNT whose names are written next to them.
+#                    By default all names are written if CNT has at most LABEL_LIMIT points
+# ax (optional): axis to plot on. A new pyplot axis is made by default
+def plotCNT(CNT, x, points=None, labels=None, ax=None):
+    if points is None:
+        points = PointRegistry(CNT)
+    unknownCol = '#fc4c4c'
+    knownCol = '#03c2fc'
+    if ax is None:
+        ax = plt.axes()
+    ax.axis('square')
+    # (x,y) of every point with the unknowns updated from the unknowns vector x
+    xy = points.coordinates(x)
+    # red for unknown points, blue for control points
+    colors = np.where(CNT.unknown, unknownCol, knownCol)
+    ax.scatter(xy[:, 0], xy[:, 1], c=colors)
+    # add text
+    if labels is None:
+        labels = np.full(len(CNT), len(CNT) <= LABEL_LIMIT)
+    for row in np.flatnonzero(labels):
+        ax.text(xy[row, 0]+30, xy[row, 1]+30, CNT.name[row])
+    # set title
+    ax.set_title('Adjusted Geodetic Network with Exaggerated Error Ellipses')
+    # get min/max x
+    minx = CNT.x.min()
+    maxx = CNT.x.max()
+    # get min/max y
+    miny = CNT.y.min()
+    maxy = CNT.y.max()
+    # set limits with 10% buffer
+    bufx = abs(maxx - minx)*0.1
+    bufy = abs(maxy - miny)*0.1
+    ax.set_xlim(minx - bufx, maxx + bufx)
+    ax.set_ylim(miny - bufy, maxy + bufy)
+    return ax
+
+
+# Function to draw error ellipses and their semi-major axes on a figure, as 1 collection each
+# returns nothing
+# ax: matplotlib axis object
+# x and y: numpy arrays with the (x,y) centers of the ellipses
+# semi_major: numpy array with the sizes of the semi-major axes
+# semi_minor: numpy array with the sizes of the semi-minor axes
+# theta: numpy array with the orientations of the semi-major axes in radians (angle counter-clockwise from the x axis
+#        to the semi-major axis)
+# scale (optional): scale for the semi_major and semi_minor values to make the ellipses larger or smaller
+def drawEllipses(ax, x, y, semi_major, semi_minor, theta, scale=1):
+    # ellipses are centered on the given (x,y), width is 2*semi-major axis, height is 2*semi-minor axis and
+    # angle rotates the ellipse counter-clockwise in degrees
+    e = EllipseCollection(2*semi_major*scale, 2*semi_minor*scale, np.degrees(theta), units='xy',
+                          offsets=np.column_stack([x, y]), transOffset=ax.transData, facecolors='none',
+                          edgecolors='red')
+    ax.add_collection(e)
+    # semi-major axis lines
+    ends = np.column_stack([x + scale*semi_major*np.cos(theta), y + scale*semi_major*np.sin(theta)])
+    l = LineCollection(np.stack([np.column_stack([x, y]), ends], axis=1), colors='red')
+    ax.add_collection(l)
+
+
+# Function to save the to-scale error ellipses of unknown points to a pdf, 1 page per point
+# The pages are made without pyplot so that this also works in worker processes and without a display. 1 figure
+# is made and its point, ellipse, axis line, title and limits are moved for each page
+# returns nothing
+# filename: filename of the pdf to be saved
+# names: numpy array with the names of the points
+# x, y, semi_major, semi_minor, theta: numpy arrays with the error ellipses of the points (see drawEllipses)
+# figs (optional): figures to save before the pages of the points
+def saveZoomPages(filename, names, x, y, semi_major, semi_minor, theta, figs=()):
+    pp = PdfPages(filename)
+    for fig in figs:
+        fig.savefig(pp, format='pdf')
+    fig = Figure()
+    ax = fig.add_subplot()
+    ax.axis('square')
+    title = fig.suptitle('')
+    point = ax.scatter([0], [0])
+    e = pat.Ellipse(xy=(0, 0), width=0, height=0, angle=0, facecolor='none', edgecolor='red')
+    ax.add_patch(e)
+    l = Line2D([0, 0], [0, 0], color='red')
+    ax.add_line(l)
+    for i in range(0, len(names)):
+        title.set_text("To-scale Error Ellipse for " + str(names[i]) + " (square plot)")
+        point.set_offsets([[x[i], y[i]]])
+        # ellipse is centered on the point, width is 2*semi-major axis, height is 2*semi-minor axis and angle
+        # rotates the ellipse counter-clockwise in degrees
+        e.set_center((x[i], y[i]))
+        e.set_width(2*semi_major[i])
+        e.set_height(2*semi_minor[i])
+        e.set_angle(np.degrees(theta[i]))
+        # semi-major axis line
+        l.set_data([x[i], x[i] + semi_major[i]*np.cos(theta[i])], [y[i], y[i] + semi_major[i]*np.sin(theta[i])])
+        # adjust limits to 2.2x the semi-major axis
+        ax.set_xlim(x[i]-semi_major[i]*1.1, x[i]+semi_major[i]*1.1)
+        ax.set_ylim(y[i]-semi_major[i]*1.1, y[i]+semi_major[i]*1.1)
+        fig.savefig(pp, format='pdf')
+    pp.close()
+
+
+# Function to save the to-scale error ellipses of many unknown points, split over worker processes
+# each worker saves its part of the points to its own pdf (filename-1.pdf, filename-2.pdf, ...)
+# returns the list of pdf files that were saved
+# filename: filename of the pdf, used as the base name of the parts
+# names, x, y, semi_major, semi_minor, theta: see saveZoomPages
+# workers: number of worker processes
+def saveZoomPagesParallel(filename, names, x, y, semi_major, semi_minor, theta, workers):
+    base, ext = os.path.splitext(filename)
+    parts = np.array_split(np.arange(len(names)), min(workers, max(len(names), 1)))
+    filenames = [base + '-' + str(k + 1) + ext for k in range(0, len(parts))]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(saveZoomPages, filenames[k], names[p], x[p], y[p], semi_major[p], semi_minor[p],
+                               theta[p]) for k, p in enumerate(parts)]
+        for future in futures:
+            future.result()
+    return filenames
+
+
+# Function to save all open figures as PDF
+# I got this function from stack overflow user farenorth: https://stackoverflow.com/questions/26368876/saving-all-open-matplotlib-figures-in-one-file-at-once
+# filename: filename of the pdf to be saved
+# figs (optional): by default the function will grab all open figures. This option lets the user specify figures instead
+def SaveFigs(filename, figs=None):
+    pp = PdfPages(filename)
+    if figs is None:
+        figs = [plt.figure(n) for n in plt.get_fignums()]
+    for fig in figs:
+        fig.savefig(pp, format='pdf')
+    pp.close()
+
+
+# Function to check if figures can be shown on the screen (plt.show() does nothing on non-interactive backends
+# like the one used without a display)
+# returns True or False
+def canShow():
+    return matplotlib.get_backend().lower() in [b.lower() for b in matplotlib.rcsetup.interactive_bk]
+
+
+# Function to plot the adjusted network with exaggerated error ellipses and save it to a pdf, followed by the
+# to-scale error ellipse of each unknown point (1 page per point)
+# returns nothing
+# filename: filename of the pdf
+# CNT: CNTTable of coordinates
+# x: numpy array with the adjusted unknowns
+# points: PointRegistry of CNT
+# semi_major, semi_minor, theta: numpy arrays with the error ellipses of the unknown points (see errorEllipses)
+# plot_points (optional): list of point names. If given, only these points get error ellipses and names
+# workers (optional): number of worker processes that save the to-scale error ellipses. With more than 1 they are
+#                     saved to separate pdfs (see saveZoomPagesParallel)
+def plotNetwork(filename, CNT, x, points, semi_major, semi_minor, theta, plot_points=None, workers=1):
+    unknown_rows = points.unknown_rows
+    # the ellipses and names are only drawn for the chosen points
+    labels = None
+    chosen = np.arange(len(unknown_rows))
+    if plot_points is not None:
+        labels = np.isin(CNT.name, plot_points)
+        chosen = np.flatnonzero(labels[unknown_rows])
+    plt.figure()
+    main_ax = plotCNT(CNT, x, points, labels)
+    # the ellipses are drawn at the adjusted coordinates of the points
+    xy = np.reshape(x, (-1, 2))[chosen]
+    ex = xy[:, 0]
+    ey = xy[:, 1]
+    drawEllipses(main_ax, ex, ey, semi_major[chosen], semi_minor[chosen], theta[chosen], scale=10000)
+    # add legend
+    legend_elements = [Line2D([0], [0], marker='o', color='w', markerfacecolor='#fc4c4c', label='Unknown'),
+                       Line2D([0], [0], marker='o', color='w', markerfacecolor='#03c2fc', label='Known'),
+                       pat.Ellipse(xy=(0, 0), width=0, height=0,
+                                   angle=0, facecolor='none', edgecolor='red', label='Error Ellipse (exagerated)')]
+    main_ax.legend(handles=legend_elements, bbox_to_anchor=(1.1, 1), loc='upper right')
+    # save figures to pdf
+    ellipses = (CNT.name[unknown_rows[chosen]], ex, ey, semi_major[chosen], semi_minor[chosen], theta[chosen])
+    if workers > 1:
+        # the pages of the to-scale error ellipses are saved to separate pdfs by worker processes
+        SaveFigs(filename, [main_ax.figure])
+        saveZoomPagesParallel(filename, *ellipses, workers)
+    else:
+        saveZoomPages(filename, *ellipses, figs=[main_ax.figure])
+
+
+# Function to show the open figures and close them
+# showing pauses the program until the windows are closed
+# returns nothing
+# show (optional): Set to True/False to show the figures or not. By default they are only shown when matplotlib can
+#                  open windows (see canShow)
+def showFigures(show=None):
+    if show is None:
+        show = canShow()
+    if show:
+        plt.show()
+    # close all
+    plt.close('all')
@@ -0,0 +1,149 @@
+from functions import *
+from covariance import Covariance
+from report import writeTable
+import argparse
+import time
+
+# number of realizations adjusted at once (bounds the memory to about 2 x (measurements x BATCH_SIZE) numbers)
+BATCH_SIZE = 1000
+
+
+# Function to do a Monte Carlo pre-analysis of a planned network
+# The coordinates in the .cnt file are taken as the truth and the planned measurements are simulated from them
+# many times with random errors from their standard deviations. All realizations share the design matrix at the
+# true coordinates, so they are adjusted together: 1 factorization of N and triangular solves for a batch of
+# realizations at once (the linearized adjustment, which is what the formal precision describes)
+# The empirical error ellipses of the realizations are compared with the formal ones from Cxhat, and the
+# failure rate of the observations test (|rhat| > 3 standard deviations of rhat) is counted for each measurement
+# returns a dictionary with the results (see the end of the function), and writes them to preanalysis.out
+# CNTFile: Filename of coordinates file (the planned network)
+# MESFile: Filename of the planned measurements (.mes format, the values are not used and can be 0)
+# realizations (optional): number of simulated networks
+# CNTheader, MESheader (optional): number of header lines in the files
+# sigma0 (optional): a-priori variance factor
+# seed (optional): seed of the random errors, the same seed gives the same results
+# outdir (optional): directory to write preanalysis.out to
+# suppress_print (optional): Set to True to suppress outputs to the console
+def preanalysis(CNTFile='', MESFile='', realizations=10000, CNTheader=1, MESheader=1, sigma0=1, seed=0, outdir='',
+                suppress_print=False):
+    time0 = time.perf_counter()
+    if CNTFile == '':
+        CNTFile = FindFiles('cnt')
+    if MESFile == '':
+        MESFile = FindFiles('mes')
+    CNT = readfile(CNTFile, CNTheader)
+    MES = readfile(MESFile, MESheader)
+    points = PointRegistry(CNT)
+    x = buildx(CNT)
+    obs = ObsIndex(CNT, MES, points)
+    n = len(MES)
+    u = len(x)
+    # degrees of freedom (every direction set also has an orientation unknown, see orientationCentring)
+    dof = n - u - obs.orientations
+    if dof <= 0:
+        raise Exception("The planned network has " + str(n) + " measurements for " + str(n - dof) + " unknowns, "
+                        "it needs more measurements than unknowns")
+    sparse = useSparse(n, u)
+    # only A is needed: the adjustment of each realization starts at the true coordinates
+    A = buildAw(CNT, MES, x, obs, sparse=True)[0]
+    # the errors of directions are also centred in their sets, as the misclosures are in buildAw
+    centring = orientationCentring(obs.orientation, MES.std) if obs.orientations > 0 else None
+    p = buildp(MES, sigma0)
+    Nmat = A.T @ sp.diags(p) @ A
+    if not sparse:
+        Nmat = Nmat.toarray()
+    Nfactor = Factor(Nmat)
+
+    # formal precision
+    cov = Covariance(Nfactor, A, p, sigma0, obs.orientation)
+    formal_blocks = cov.pointBlocks()
+    formal_major, formal_minor, formal_theta = errorEllipses(formal_blocks)
+    Crhat = cov.diagCrhat()
+    # redundancy number of each measurement (its share of the degrees of freedom)
+    redundancy = Crhat * p / sigma0
+
+    # simulate and adjust the realizations in batches
+    rng = np.random.default_rng(seed)
+    sums = np.zeros(u)  # sum of the errors of the unknowns
+    products = np.zeros((u // 2, 3))  # sums of ex*ex, ex*ey and ey*ey of each point
+    failures = np.zeros(n, dtype=int)  # number of realizations in which each measurement failed the test
+    sigma0hats = np.zeros(realizations)
+    limit = 3*np.sqrt(np.maximum(Crhat, 0))
+    AtP = (A.T @ sp.diags(p)).tocsr()
+    for start in range(0, realizations, BATCH_SIZE):
+        k = min(BATCH_SIZE, realizations - start)
+        # errors of the measurements (w = estimated - measured = -errors at the true coordinates)
+        errors = rng.standard_normal((n, k)) * MES.std[:, None]
+        if centring is not None:
+            errors = centring @ errors
+        # errors of the adjusted unknowns and residuals of all realizations at once
+        delta = Nfactor.solve(AtP @ errors)
+        rhat = A @ delta - errors
+        sums = sums + delta.sum(axis=1)
+        ex = delta[0::2]
+        ey = delta[1::2]
+        products = products + np.column_stack([(ex*ex).sum(axis=1), (ex*ey).sum(axis=1), (ey*ey).sum(axis=1)])
+        failures = failures + np.count_nonzero(np.abs(rhat) > limit[:, None], axis=1)
+        sigma0hats[start:start + k] = (p[:, None]*rhat**2).sum(axis=0)/dof
+
+    # empirical precision from the errors of the adjusted unknowns
+    mean = sums/realizations
+    mx = mean[0::2]
+    my = mean[1::2]
+    m = max(realizations - 1, 1)
+    empirical_blocks = np.zeros((u // 2, 2, 2))
+    empirical_blocks[:, 0, 0] = (products[:, 0] - realizations*mx*mx)/m
+    empirical_blocks[:, 0, 1] = (products[:, 1] - realizations*mx*my)/m
+    empirical_blocks[:, 1, 0] = empirical_blocks[:, 0, 1]
+    empirical_blocks[:, 1, 1] = (products[:, 2] - realizations*my*my)/m
+    empirical_major, empirical_minor, empirical_theta = errorEllipses(empirical_blocks)
+    failure_rate = failures/realizations
+    timetaken = time.perf_counter() - time0
+
+    # write results
+    if outdir != '':
+        os.makedirs(outdir, exist_ok=True)
+    out = open(os.path.join(outdir, 'preanalysis.out'), 'w')
+    divider = '\n\n' + '*'*100 + '\n'
+    out.write("Monte Carlo Pre-Analysis\n\nExecution Time:\t" + str(timetaken) + " seconds\nRealizations:\t"
+              + str(realizations) + "\nMeasurements:\t" + str(n) + "\nUnknowns:\t\t" + str(u)
+              + "\nDegrees of Freedom:\t" + str(dof) + "\nsigma0:\t\t\t" + str(sigma0)
+              + "\nMean Posteriori Variance Factor:\t" + str(sigma0hats.mean())
+              + "\nStd of Posteriori Variance Factor:\t" + str(sigma0hats.std()))
+    out.write(divider + "\nError Ellipses (formal from Cxhat, empirical from the realizations)\n\n"
+                        "Name\tFormal Semi-Major\tFormal Semi-Minor\tFormal theta\tEmpirical Semi-Major"
+                        "\tEmpirical Semi-Minor\tEmpirical theta")
+    names = CNT.name[points.unknown_rows]
+    writeTable(out, names, [formal_major, formal_minor, formal_theta, empirical_major, empirical_minor,
+                            empirical_theta], ['%.8E', '%.8E', '%.8f', '%.8E', '%.8E', '%.8f'],
+               np.char.str_len(CNT.name).max() + 4)
+    out.write(divider + "\nObservations Test Failure Rates (expected " + str(round(100*0.0027, 2))
+              + " % for normal errors)\n\nMeasurement ID\tFailure Rate [%]\tRedundancy Number")
+    writeTable(out, MES.id, [100*failure_rate, redundancy], ['%.2f', '%.4f'], np.char.str_len(MES.id).max() + 4)
+    out.write('\n')
+    out.close()
+    if not suppress_print:
+        print(str(realizations) + ' realizations adjusted in ' + str(timetaken) + ' seconds')
+
+    return {
+        'realizations': realizations,
+        'time': timetaken,
+        'names': names,
+        'formal': (formal_major, formal_minor, formal_theta),
+        'empirical': (empirical_major, empirical_minor, empirical_theta),
+        'failure_rate': dict(zip(MES.id.tolist(), failure_rate.tolist())),
+        'redundancy': dict(zip(MES.id.tolist(), redundancy.tolist())),
+        'sigma0hat': sigma0hats,
+    }
+
+
+# run with `python preanalysis.py [coordinates.cnt planned.mes] [-n realizations]`
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Monte Carlo pre-analysis of a planned network')
+    parser.add_argument('files', nargs='*', help='.cnt file and .mes file of planned measurements')
+    parser.add_argument('-n', '--realizations', type=int, default=10000, help='number of simulated networks')
+    parser.add_argument('-o', '--outdir', default='', help='directory for preanalysis.out')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random errors')
+    args = parser.parse_args()
+    files = args.files + ['', '']
+    preanalysis(files[0], files[1], args.realizations, seed=args.seed, outdir=args.outdir)
@@ -0,0 +1,86 @@
+import numpy as np
+
+
+# matrices with more elements than this are not written in full to output.out (see writeMatrix)
+MAX_MATRIX = 1000000
+# number of rows written at once by the report functions
+ROWS_PER_WRITE = 10000
+# ways of writing a matrix that has more than max_elements elements:
+#     'full': write it anyway
+#     'truncate': write the top left block that fits in max_elements, and say so
+#     'summary': write only its diagonal and a line with its size and the range of its elements
+MATRIX_POLICIES = ('full', 'truncate', 'summary')
+
+
+# Function to write an array to a file like np.savetxt, formatting many rows at once
+# (np.savetxt formats and writes every row separately, which is slow for long vectors)
+# returns nothing
+# file: file object to output to
+# M: 1D numpy array (written one element per line) or 2D numpy array
+# fmt: format of one element, e.g. '%+1.4E'
+# delimiter (optional): text between the elements of a row
+def writeArray(file, M, fmt, delimiter=' '):
+    M = np.asarray(M)
+    if M.ndim == 1:
+        M = M[:, None]
+    row = delimiter.join([fmt]*M.shape[1]) + '\n'
+    for start in range(0, M.shape[0], ROWS_PER_WRITE):
+        block = M[start:start + ROWS_PER_WRITE]
+        file.write((row*len(block)) % tuple(block.ravel()))
+
+
+# Function to write a variance covariance matrix section of output.out
+# returns nothing
+# file: file object to output to
+# title: title line of the section (the note of a truncated or summarized matrix is added to it)
+# M: 2D numpy array, or its diagonal as a 1D numpy array (always written in full)
+# fmt: format of one element
+# policy (optional): what to do if M has more than max_elements elements (see MATRIX_POLICIES)
+# max_elements (optional): largest matrix that is written in full
+# delimiter (optional): text between the elements of a row
+def writeMatrix(file, title, M, fmt, policy='truncate', max_elements=MAX_MATRIX, delimiter='\t'):
+    if policy not in MATRIX_POLICIES:
+        raise Exception("Unknown matrix policy '" + str(policy) + "'. Use one of " + ', '.join(MATRIX_POLICIES))
+    if M.ndim == 1 or M.size <= max_elements or policy == 'full':
+        file.write(title + "\n")
+        writeArray(file, M, fmt, delimiter)
+    elif policy == 'truncate':
+        k = int(np.sqrt(max_elements))
+        file.write(title + " (first " + str(k) + " rows and columns of " + str(M.shape[0]) + "x"
+                   + str(M.shape[1]) + ")\n")
+        writeArray(file, M[:k, :k], fmt, delimiter)
+    else:
+        file.write(title + " (diagonal only)\n")
+        file.write(("Summary:\t%dx%d matrix, elements from " + fmt + " to " + fmt + "\n")
+                   % (M.shape[0], M.shape[1], M.min(), M.max()))
+        writeArray(file, M.diagonal(), fmt, delimiter)
+
+
+# Function to write a table with a name column and number columns
+# the width of each column is found once from its longest formatted number, so the columns line up
+# returns nothing
+# file: file object to output to (each row starts with a new line, like the rest of output.out)
+# names: numpy array with the names of the rows
+# columns: list of numpy arrays with the numbers of each column
+# fmts: list of formats of the columns, e.g. '%.4f'
+# name_width: width of the name column
+# pad (optional): spaces between the columns
+def writeTable(file, names, columns, fmts, name_width, pad=4):
+    if len(names) == 0:
+        return
+    texts = [np.char.mod(fmts[i], np.asarray(columns[i], dtype=float)) for i in range(0, len(columns))]
+    widths = [np.char.str_len(t).max() + pad for t in texts]
+    row = '\n%-' + str(name_width) + 's' + ''.join(['%' + str(w) + 's' for w in widths])
+    for start in range(0, len(names), ROWS_PER_WRITE):
+        cells = np.stack([names[start:start + ROWS_PER_WRITE]] + [t[start:start + ROWS_PER_WRITE] for t in texts],
+                         axis=1)
+        file.write((row*len(cells)) % tuple(cells.ravel()))
+
+
+# Function to save the numeric results of an adjustment to a binary archive (numpy .npz file)
+# load it with np.load(filename). Matrices that are not available are left out
+# returns nothing
+# filename: name of the archive
+# results: dictionary of names and numpy arrays (or numbers)
+def writeArchive(filename, results):
+    np.savez(filename, **{key: np.asarray(value) for key, value in results.items() if value is not None})
@@ -0,0 +1,125 @@
+from functions import *
+from covariance import Covariance
+
+
+# robust estimation methods and their default tuning constants (in standardized residuals)
+ROBUST_METHODS = {'huber': 1.5, 'danish': 2.0, 'tukey': 4.685}
+# smallest weight factor. Measurements are never weighted out completely, so N stays positive definite when all
+# measurements of a point are down-weighted
+MIN_WEIGHT = 1e-6
+# the re-weighting has converged when no weight factor changes by more than this
+WEIGHT_TOLERANCE = 1e-3
+# smallest redundancy number used to standardize the residuals (measurements that are not controlled by the others
+# have a redundancy number of 0 and a residual of 0)
+MIN_REDUNDANCY = 1e-6
+
+
+# Function to get the weight factors of the measurements from their standardized residuals
+# returns a numpy array of weight factors between MIN_WEIGHT and 1
+# v: numpy array of standardized residuals
+# method: 'huber' (factor c/|v| above c), 'danish' (factor exp(1 - (v/c)^2) above c) or 'tukey' (biweight,
+#         factor (1 - (v/c)^2)^2 below c and 0 above it)
+# c: tuning constant
+def robustWeights(v, method, c):
+    a = np.abs(v)
+    if method == 'huber':
+        factors = c/np.maximum(a, c)
+    elif method == 'danish':
+        factors = np.exp(1 - np.maximum(a/c, 1)**2)
+    elif method == 'tukey':
+        factors = np.maximum(1 - (a/c)**2, 0)**2
+    else:
+        raise Exception("Unknown robust method '" + str(method) + "'. Use one of " + ', '.join(ROBUST_METHODS))
+    return np.maximum(factors, MIN_WEIGHT)
+
+
+# Function to run the Gauss-Newton iterations of a robust adjustment (iteratively re-weighted least squares)
+# The least squares adjustment is iterated first (see iterate() in functions.py). Then every iteration re-weights
+# the measurements from their standardized residuals and does 1 Gauss-Newton iteration with the weights p
+# multiplied by the weight factors, so a re-weighting step costs 1 Gauss-Newton iteration (the ObsIndex and the
+# weights are reused, only A, w and N are formed again). The residuals are standardized with the redundancy
+# numbers of the least squares adjustment (found once), as the geometry of the network does not change between
+# re-weightings
+# loops until the corrections are below threshold and no weight factor changes by more than WEIGHT_TOLERANCE
+# returns x, A, w, delta, Nfactor, count, converged, factors, v as a tuple:
+#     x, A, w, delta, Nfactor, count, converged: see iterate() in functions.py
+#     factors: weight factors used in the last iteration (the weights of the measurements are p*factors)
+#     v: standardized residuals of the last iteration
+# CNT, MES: CNTTable and MESTable
+# x: numpy array with initial values of unknowns
+# p: numpy array of the weights of the measurements (see buildp)
+# obs: ObsIndex of CNT and MES
+# sparse: set to True to use sparse matrices
+# threshold: largest change of a coordinate in meters of a converged iteration (see convergenceTolerance)
+# maxit: maximum iterations before breaking the loop
+# method (optional): robust method (see robustWeights)
+# c (optional): tuning constant (the default of the method in ROBUST_METHODS by default)
+# sigma0 (optional): a-priori variance factor
+# suppress_print (optional): Set to False to print the progress to the console
+# inst (optional): Instrument that times the stages of each iteration (see instrument.py)
+# perm (optional): fill-reducing order of the unknowns for sparse N (see unknownOrdering)
+def robustIterate(CNT, MES, x, p, obs, sparse, threshold, maxit, method='huber', c=None, sigma0=1,
+                  suppress_print=True, inst=NULL_INSTRUMENT, perm=None):
+    if method not in ROBUST_METHODS:
+        raise Exception("Unknown robust method '" + str(method) + "'. Use one of " + ', '.join(ROBUST_METHODS))
+    if c is None:
+        c = ROBUST_METHODS[method]
+    n = len(p)
+    factors = np.ones(n)
+    # least squares adjustment (with the line search of iterate)
+    P = sp.diags(p, format='csr') if sparse else np.diag(p)
+    x, A, w, delta, Nfactor, count, converged = iterate(CNT, MES, x, P, obs, sparse, threshold, maxit,
+                                                        suppress_print, inst, perm)
+    if not converged:
+        return x, A, w, delta, Nfactor, count, converged, factors, np.zeros(n)
+    # redundancy numbers: diagonal of I - A @ inv(N) @ At @ P
+    redundancy = np.maximum(1 - p*Covariance(Nfactor, A, p, 1).diagClhat(), MIN_REDUNDANCY)
+    correction = 0  # largest correction of a coordinate in the last iteration
+    while True:
+        # re-weight from the residuals of the last iteration
+        inst.start('re-weighting')
+        rhat = (A @ delta + w).ravel()
+        v = rhat/np.sqrt(sigma0*redundancy/p)
+        new_factors = robustWeights(v, method, c)
+        change = np.max(np.abs(new_factors - factors))
+        inst.end('re-weighting')
+        if correction <= threshold and change <= WEIGHT_TOLERANCE:
+            break
+        if not suppress_print:
+            print("Iteration: " + str(count))  # print iteration number for the user
+        # also break if maximum number of iterations is reached
+        if count >= maxit:
+            print("Maximum number of iterations reached")
+            print("Break")
+            converged = False
+            break
+        factors = new_factors
+
+        # build the design matrix A and the misclosure vector w
+        inst.start('build A/w')
+        A, w = buildAw(CNT, MES, x, obs, sparse)
+        inst.end('build A/w')
+
+        # calculate solution with the current weights
+        inst.start('normal equations')
+        weights = p*factors
+        At = A.transpose()
+        u = At @ (weights[:, None]*w)
+        if sparse:
+            N = At @ sp.diags(weights) @ A
+        else:
+            N = At @ (weights[:, None]*A)
+        inst.end('normal equations')
+        inst.start('solve')
+        Nfactor = Factor(N, perm)
+        delta = Nfactor.solve(-u)
+        inst.end('solve')
+
+        x = x + delta.ravel()
+        correction = np.max(np.abs(delta))
+        inst.event('iteration', count=count, max_correction=float(correction), weight_change=float(change))
+        if not suppress_print:
+            print("largest correction = " + str(correction) + "\nlargest weight change = " + str(change) + "\n")
+        count = count + 1  # iterate count
+
+    return x, A, w, delta, Nfactor, count, converged, factors, v
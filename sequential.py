@@ -0,0 +1,137 @@
+from functions import *
+
+
+# SequentialAdjustment class
+# keeps the state of an adjustment (x, the factorized normal equations and the residual statistics) so that
+# new measurements can be added with a sequential least squares update instead of a full re-adjustment
+# usage:
+#     seq = SequentialAdjustment('coordinates.cnt', 'measurements.mes')
+#     ... new lines are appended to measurements.mes ...
+#     seq.refresh()  # folds in the new lines
+class SequentialAdjustment:
+    # constructor: reads the files and does the full adjustment
+    # CNTFile: Filename of coordinates file
+    # MESFile: Filename of measurements file
+    # CNTheader: number of header lines in coordinates file (default is 1)
+    # MESheader: number of header lines in measurements file (default is 1)
+    # sigma0: a-priori variance factor. Chosen as 1 by default
+    # maxit: maximum iterations before breaking the loop
+    # threshold (optional): largest change of a coordinate in meters of a converged iteration (like main). By
+    #                       default from the precision of the measurements (see convergenceTolerance)
+    # relinearize (optional): the adjustment is iterated again when an update moves a coordinate by more than
+    #                         this many meters. By default 1/2 of the smallest distance standard deviation
+    # sparse (optional): Set to True/False to force sparse/dense matrices (see main)
+    def __init__(self, CNTFile, MESFile, CNTheader=1, MESheader=1, sigma0=1, maxit=100, threshold=None,
+                 relinearize=None, sparse=None):
+        self.MESFile = MESFile
+        self.sigma0 = sigma0
+        self.maxit = maxit
+        self.CNT = readfile(CNTFile, CNTheader)
+        self.MES = readfile(MESFile, MESheader)
+        self.points = PointRegistry(self.CNT)
+        # position in the .mes file up to which it has been read
+        self.offset = os.path.getsize(MESFile)
+        self.linenum = countLines(MESFile)
+        x = buildx(self.CNT)
+        if threshold is None:
+            threshold = convergenceTolerance(self.MES, ObsIndex(self.CNT, self.MES, self.points), x)
+        self.threshold = threshold
+        if relinearize is None:
+            relinearize = threshold
+            if np.any(self.MES.type == DIST):
+                relinearize = 0.5*self.MES.std[self.MES.type == DIST].min()
+        self.relinearize = relinearize
+        if sparse is None:
+            sparse = useSparse(len(self.MES), len(x))
+        self.sparse = sparse
+        self.adjust(x)
+
+    # Function to do the full adjustment of all measurements, starting from x
+    # returns nothing
+    # x: numpy array with initial values of unknowns
+    def adjust(self, x):
+        obs = ObsIndex(self.CNT, self.MES, self.points)
+        P = buildP(self.MES, self.sigma0, self.sparse)
+        perm = unknownOrdering(obs, len(x)) if self.sparse else None
+        x, A, w, delta, Nfactor, count, converged = iterate(self.CNT, self.MES, x, P, obs, self.sparse,
+                                                            self.threshold, self.maxit, perm=perm)
+        rhat = A @ delta + w
+        self.x = x
+        self.Nfactor = Nfactor
+        self.iterations = count - 1
+        self.converged = converged
+        # number of eliminated orientations of direction sets
+        self.orientations = obs.orientations
+        # weighted sum of squared residuals
+        self.omega = (rhat.transpose() @ P @ rhat)[0][0]
+
+    # Function to add new measurements with a sequential least squares update
+    # The new measurements are linearized at the current x. If a coordinate moves by more than relinearize (the
+    # linearization point moved too far), the adjustment is iterated again with all measurements
+    # returns the correction of x as a numpy array
+    # MES: MESTable with the new measurements
+    def add(self, MES):
+        if len(MES) == 0:
+            return np.zeros(len(self.x))
+        obs = ObsIndex(self.CNT, MES, self.points)
+        # a new direction changes the orientation of its whole set, which is not in the factorized normal equations
+        if obs.orientations > 0:
+            raise Exception("Directions can not be added sequentially, adjust them again with all measurements")
+        A2, w2 = buildAw(self.CNT, MES, self.x, obs, self.sparse)
+        p2 = buildp(MES, self.sigma0)
+        # gain of the new measurements: Z = inv(N) @ A2t and S = inv(P2) + A2 @ Z
+        Z = self.Nfactor.solve(A2.transpose().toarray() if self.sparse else A2.transpose())
+        S = np.diag(1/p2) + A2 @ Z
+        Sw = np.linalg.solve(S, w2)
+        delta = -(Z @ Sw).ravel()
+        # the predicted residuals of the new measurements add to the weighted sum of squares
+        self.omega = self.omega + (w2.transpose() @ Sw)[0][0]
+        # add the new measurements to the normal equations
+        self.Nfactor.update(A2, p2)
+        self.MES = MESTable.concat([self.MES, MES])
+        self.x = self.x + delta
+        self.iterations = 0
+        # re-iterate if the linearization point moved too far
+        if np.max(np.abs(delta)) > self.relinearize:
+            self.adjust(self.x)
+        return delta
+
+    # Function to add the lines that were appended to the .mes file since it was last read
+    # returns the number of new measurements
+    def refresh(self):
+        f = open(self.MESFile, 'rb')
+        f.seek(self.offset)
+        text = f.read()
+        f.close()
+        # only use complete lines
+        end = text.rfind(b'\n')
+        if end < 0:
+            return 0
+        text = text[:end + 1]
+        MES = parseLines(text.decode(), self.linenum, self.MESFile, 'mes')
+        self.offset = self.offset + len(text)
+        self.linenum = self.linenum + text.count(b'\n')
+        self.add(MES)
+        return len(MES)
+
+    # Function to get the posteriori variance factor
+    def sigma0hat(self):
+        return self.omega/(len(self.MES) - len(self.x) - self.orientations)
+
+    # Function to get the v-c matrix of unknowns Cxhat
+    def Cxhat(self):
+        return self.sigma0hat() * self.Nfactor.inverse()
+
+
+# Function to count the lines of a file
+# returns the number of newline characters in the file
+# Filesname: name of file
+def countLines(filename):
+    count = 0
+    f = open(filename, 'rb')
+    chunk = f.read(CHUNK_SIZE)
+    while chunk:
+        count = count + chunk.count(b'\n')
+        chunk = f.read(CHUNK_SIZE)
+    f.close()
+    return count
@@ -0,0 +1,248 @@
+from main import *
+import argparse
+import asyncio
+import hashlib
+import json
+import signal
+import socket
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+# largest number of parsed tables kept in memory by each worker process
+HOT_TABLES = 32
+# largest number of jobs waiting for a worker. Reading new requests pauses while the queue is full
+QUEUE_SIZE = 100
+# parameters of main that a job can set (plotting is never done by the server)
+JOB_PARAMETERS = ('CNTheader', 'MESheader', 'sigma0', 'maxit', 'sparse', 'outdir', 'full_covariance',
+                  'matrix_policy', 'max_matrix', 'archive', 'timing', 'snooping', 'critical', 'robust', 'robust_c',
+                  'partition', 'cache', 'warmstart', 'network')
+
+# parsed tables of this worker process, least recently used first (see hotTable)
+TABLES = OrderedDict()
+# directory that jobs without an outdir write output.out to (1 per worker process, made when first needed)
+WORKDIR = ''
+
+
+# Job protocol
+# The server reads 1 job per line as a json object and writes 1 result per line as a json object. Results are
+# written when their job is done, so they can come in a different order than the jobs; the id of the job is sent
+# back with its result
+# job:
+#     {"id": 1, "cnt": "coordinates.cnt", "mes": "measurements.mes", "params": {"sigma0": 1, "maxit": 100}}
+#     the files can also be sent as text with "cnt_text" and "mes_text" instead of "cnt" and "mes"
+#     params are passed on to main (see JOB_PARAMETERS), output.out is written to a temporary directory unless
+#     "outdir" is given. "cache": true and "warmstart": true keep the cache and warm start store next to the .cnt
+#     file; jobs with text need their directories (and the "network" name for warmstart)
+# result:
+#     {"id": 1, "status": "ok", "result": {...}, "time": 0.004}  (result is the summary returned by main)
+#     {"id": 1, "status": "failed", "error": "..."}
+
+
+# Function to get a parsed .cnt or .mes table of a job from the tables kept in memory, or read it
+# Files are keyed by their path, modification time and size, and text by its hash, so a changed file is read again
+# returns a CNTTable or MESTable
+# job: dictionary of the job
+# filetype: 'cnt' or 'mes'
+# header_lines: number of header lines
+def hotTable(job, filetype, header_lines):
+    if filetype + '_text' in job:
+        text = job[filetype + '_text']
+        key = ('text', filetype, header_lines, hashlib.sha256(text.encode()).hexdigest())
+    elif filetype in job:
+        filename = os.path.abspath(job[filetype])
+        stat = os.stat(filename)
+        key = ('file', filename, header_lines, stat.st_mtime_ns, stat.st_size)
+    else:
+        raise Exception("The job has no ." + filetype + " file (give '" + filetype + "' or '" + filetype + "_text')")
+    if key in TABLES:
+        TABLES.move_to_end(key)
+        return TABLES[key]
+    if key[0] == 'text':
+        table = readtext(text, header_lines, filetype)
+    else:
+        table = readfile(filename, header_lines)
+    TABLES[key] = table
+    if len(TABLES) > HOT_TABLES:
+        TABLES.popitem(last=False)
+    return table
+
+
+# Function to set up a worker process
+# the adjustment prints some messages (e.g. when the maximum number of iterations is reached), they go to stderr so
+# that they can not mix with the results on stdout
+# returns nothing
+def initWorker():
+    sys.stdout = sys.stderr
+
+
+# Function to run 1 job (runs in a worker process)
+# returns the result as a dictionary (see the job protocol)
+# job: dictionary of the job
+def runJob(job):
+    global WORKDIR
+    time0 = time.perf_counter()
+    row = {'id': job.get('id'), 'status': 'ok'}
+    try:
+        params = dict(job.get('params', {}))
+        unknown = [name for name in params if name not in JOB_PARAMETERS]
+        if unknown:
+            raise Exception("Unknown job parameters: " + ', '.join(unknown))
+        CNT = hotTable(job, 'cnt', params.pop('CNTheader', 1))
+        MES = hotTable(job, 'mes', params.pop('MESheader', 1))
+        if 'cnt' in job:
+            # the cache and the warm start store of a file are kept next to it, as when main reads the file
+            folder = os.path.dirname(os.path.abspath(job['cnt']))
+            if params.get('cache') is True:
+                params['cache'] = os.path.join(folder, CACHE_DIR)
+            if params.get('warmstart') is True:
+                params['warmstart'] = os.path.join(folder, WARMSTART_DIR)
+            if params.get('warmstart') and params.get('network', '') == '':
+                params['network'] = os.path.abspath(job['cnt'])
+        if 'outdir' not in params:
+            if WORKDIR == '':
+                WORKDIR = tempfile.mkdtemp(prefix='lsserver')
+            params['outdir'] = WORKDIR
+        row['result'] = main(CNTFile=CNT, MESFile=MES, suppress_print=True, plot=False, show=False, **params)
+    except Exception as e:
+        row['status'] = 'failed'
+        row['error'] = str(e)
+    row['time'] = time.perf_counter() - time0
+    return row
+
+
+# Function to convert the numpy values in a result to json values (used by json.dumps)
+# returns the json value
+# value: value that json can not convert itself
+def jsonValue(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("Can not convert " + type(value).__name__ + " to json")
+
+
+# Function to read jobs from a stream, queue them and send back their results
+# returns when the stream ends and all of its jobs are done
+# reader: asyncio.StreamReader of the jobs
+# write: function that sends back 1 line of text (the json of a result)
+# queue: asyncio.Queue of (job, future) pairs that the workers take jobs from
+async def serveLines(reader, write, queue):
+    pending = []
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise ValueError("a job must be a json object")
+        except ValueError as e:
+            write(json.dumps({'id': None, 'status': 'failed', 'error': 'Invalid job: ' + str(e)}))
+            continue
+        done = asyncio.get_running_loop().create_future()
+        done.add_done_callback(lambda f: write(json.dumps(f.result(), default=jsonValue)))
+        pending.append(done)
+        await queue.put((job, done))  # waits while the queue is full
+    if pending:
+        await asyncio.wait(pending)
+
+
+# Function to take jobs from the queue and run them on the process pool, until it is cancelled
+# returns nothing
+# queue: asyncio.Queue of (job, future) pairs
+# pool: ProcessPoolExecutor of the workers
+async def worker(queue, pool):
+    loop = asyncio.get_running_loop()
+    while True:
+        job, done = await queue.get()
+        try:
+            row = await loop.run_in_executor(pool, runJob, job)
+        except Exception as e:  # the worker process itself died
+            row = {'id': job.get('id'), 'status': 'failed', 'error': 'worker failed: ' + str(e)}
+        done.set_result(row)
+        queue.task_done()
+
+
+# Function to run the adjustment server
+# Jobs are read from stdin (results are written to stdout), or from the connections to a Unix socket. They are
+# queued and run on a pool of worker processes. Every worker process keeps the parsed tables of the networks it has
+# seen (see hotTable) and the fill-reducing orders of their unknowns (see unknownOrdering), so a repeated network
+# is only adjusted, not read again
+# returns when stdin ends (the Unix socket server runs until it gets SIGINT or SIGTERM)
+# path (optional): path of the Unix socket. stdin/stdout are used by default
+# workers (optional): number of worker processes
+# queue_size (optional): largest number of jobs waiting for a worker
+async def serve(path='', workers=1, queue_size=QUEUE_SIZE):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(queue_size)
+    with ProcessPoolExecutor(max_workers=workers, initializer=initWorker) as pool:
+        # start the worker processes now, so the first job does not wait for them
+        await asyncio.gather(*[loop.run_in_executor(pool, os.getpid) for i in range(0, workers)])
+        tasks = [asyncio.create_task(worker(queue, pool)) for i in range(0, workers)]
+        try:
+            if path == '':
+                reader = asyncio.StreamReader()
+                await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+                def write(text):
+                    sys.stdout.write(text + '\n')
+                    sys.stdout.flush()
+                await serveLines(reader, write, queue)
+            else:
+                async def connection(reader, writer):
+                    await serveLines(reader, lambda text: writer.write((text + '\n').encode()), queue)
+                    await writer.drain()
+                    writer.close()
+                server = await asyncio.start_unix_server(connection, path)
+                # stop on SIGINT/SIGTERM, so that the socket file is removed
+                stop = loop.create_future()
+                for sig in (signal.SIGINT, signal.SIGTERM):
+                    loop.add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+                async with server:
+                    await stop
+        finally:
+            for task in tasks:
+                task.cancel()
+            if path != '' and os.path.exists(path):
+                os.remove(path)
+
+
+# Function to send jobs to a server on a Unix socket and wait for their results
+# returns a list of the results, in the order of the jobs
+# path: path of the Unix socket
+# jobs: list of job dictionaries (see the job protocol). Jobs without an id are numbered
+def request(path, jobs):
+    jobs = [dict(job) for job in jobs]
+    for i in range(0, len(jobs)):
+        jobs[i].setdefault('id', i)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(path)
+    s.sendall(''.join([json.dumps(job) + '\n' for job in jobs]).encode())
+    s.shutdown(socket.SHUT_WR)  # no more jobs
+    f = s.makefile('r')
+    results = {}
+    for line in f:
+        row = json.loads(line)
+        results[row['id']] = row
+    f.close()
+    s.close()
+    return [results.get(job['id']) for job in jobs]
+
+
+# run the server with `python server.py [--socket path] [-j workers]`
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Adjust networks sent as json lines on stdin or a Unix socket')
+    parser.add_argument('--socket', default='', help='path of the Unix socket (stdin/stdout by default)')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--queue', type=int, default=QUEUE_SIZE, help='largest number of waiting jobs')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.socket, args.workers, args.queue))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,117 @@
+import numpy as np
+import scipy.sparse as sp
+from covariance import Covariance
+
+
+# critical value of the standardized residuals (normal distribution, significance level 0.001 as used by Baarda)
+CRITICAL_VALUE = 3.29
+# measurements with a smaller redundancy number are not controlled by the others: they can not be tested, and
+# removing them would make N singular
+MIN_REDUNDANCY = 1e-6
+
+
+# Function to find and remove blunders by iterative data snooping (Baarda's w-test)
+# The standardized residual of each measurement is |rhat| / (its a-priori standard deviation of rhat). The
+# measurement with the largest one is removed if it is above the critical value, and the test is repeated until
+# all measurements pass. Removing a measurement does not re-adjust the network: its row is downdated from the
+# factorization of N (a rank-one downdate of the Cholesky factor for dense N; for sparse N the removed rows are
+# kept as rank-one corrections of the solves, since the sparse factor can not be downdated), and the unknowns,
+# residuals and residual variances are updated with the removed row only, so every removal costs 1 solve and
+# 1 product with A. Direction sets are handled with their orientations as extra unknowns (see below)
+# The standardized residuals use the a-priori variance factor sigma0, not sigma0hat: they are only standard normal
+# (and comparable with CRITICAL_VALUE) for a known variance factor, and sigma0hat is inflated by the blunders
+# themselves, which would hide them. The observation test of main (sTest in functions.py) is done afterwards on the
+# adjustment without the removed measurements and scales the residual variances by its sigma0hat, so a measurement
+# close to the critical values can fail only 1 of the 2 tests when sigma0hat is not close to sigma0
+# The result is linearized at the x of the adjustment, main iterates once more without the removed measurements
+# returns a tuple of 3 items:
+#     removed: numpy array with the rows of the removed measurements, in the order they were removed
+#     statistics: numpy array with the standardized residual of each removed measurement when it was removed
+#     delta: correction of x to the adjustment without the removed measurements
+# A: nxu design matrix of the adjustment (numpy or scipy.sparse)
+# rhat: nx1 numpy array of residuals
+# p: numpy array with the n weights (diagonal of P)
+# Nfactor: Factor of N (see solver.py). Dense factors are downdated in place
+# sigma0 (optional): a-priori variance factor
+# critical (optional): critical value of the standardized residuals
+# max_removals (optional): largest number of measurements to remove (all of the blunders by default)
+# sets (optional): direction set of each measurement (see ObsIndex.orientation), for the variances of the
+#                  eliminated orientations
+def dataSnooping(A, rhat, p, Nfactor, sigma0=1, critical=CRITICAL_VALUE, max_removals=None, sets=None):
+    n, u = A.shape
+    p = np.ravel(p)
+    r = np.array(rhat, dtype=float).ravel()
+    # cofactors of the residuals: diagonal of inv(P) - A @ inv(N) @ At
+    Qr = 1/p - Covariance(Nfactor, A, p, 1, sets).diagClhat()
+    if sp.issparse(A):
+        A = sp.csr_matrix(A)
+    # with the orientations of the direction sets as unknowns o (taken relative to the weighted mean of each set,
+    # so they do not correlate with x) the design matrix is [A, J] and N is diag(N, sum of the weights of each
+    # set). The removed rows are then plain rank-one corrections of that N
+    J = None
+    if sets is not None and np.any(sets >= 0):
+        rows = np.flatnonzero(sets >= 0)
+        _, set_of = np.unique(sets[rows], return_inverse=True)
+        J = sp.csr_matrix((-np.ones(len(rows)), (rows, set_of)), shape=(n, set_of.max() + 1))
+        set_weights = np.bincount(set_of, weights=p[rows])
+    active = np.ones(n, dtype=bool)
+    delta = np.zeros(u)
+    corrections = []  # (q, s) of the rows removed from a sparse factor
+    removed = []
+    statistics = []
+    if max_removals is None:
+        max_removals = n - u
+    while len(removed) < max_removals:
+        testable = active & (Qr*p > MIN_REDUNDANCY)
+        if not np.any(testable):
+            break
+        w = np.zeros(n)
+        w[testable] = np.abs(r[testable])/np.sqrt(sigma0*Qr[testable])
+        k = int(np.argmax(w))
+        if w[k] <= critical:
+            break
+        a = A[k].toarray().ravel() if sp.issparse(A) else np.array(A[k], dtype=float)
+        # q = inv(N) @ a with N without the rows removed so far
+        q = Nfactor.solve(a)
+        if J is not None:
+            b = J[k].toarray().ravel()
+            a = np.concatenate([a, b])
+            q = np.concatenate([q, b/set_weights])
+        for qj, sj in corrections:
+            q = q + qj*(qj @ a)/sj
+        s = Qr[k]
+        Aq = A @ q[:u]
+        if J is not None:
+            Aq = Aq + J @ q[u:]
+        # leave-one-out update of the unknowns, the residuals and their cofactors
+        delta = delta + q[:u]*r[k]/s
+        r = r + Aq*r[k]/s
+        Qr = Qr - Aq*Aq/s
+        if Nfactor.sparse or J is not None:
+            corrections.append((q, s))
+        else:
+            Nfactor.update(a[None, :], [-p[k]])
+        active[k] = False
+        removed.append(k)
+        statistics.append(w[k])
+    return np.array(removed, dtype=int), np.array(statistics), delta
+
+
+# Function to write the data snooping results section of output.out
+# returns nothing
+# removed: numpy array of rows of the removed measurements (from dataSnooping)
+# statistics: numpy array of their standardized residuals
+# MES: MESTable of all measurements (before the removal)
+# critical: critical value used
+# sigma0: a-priori variance factor used
+# file: file object to output to
+def writeSnooping(removed, statistics, MES, critical, sigma0, file):
+    file.write("Critical Value:\t" + str(critical) + "\n")
+    file.write("Variance Factor:\t" + str(sigma0) + " (a-priori)\n")
+    if len(removed) == 0:
+        file.write("No measurements removed")
+        return
+    file.write("Removed " + str(len(removed)) + " measurements (in the order they were removed)\n\n"
+               "Measurement ID\tInfo\tStandardized Residual")
+    for k, stat in zip(removed, statistics):
+        file.write("\n" + str(MES.id[k]) + "\t" + str(MES.info[k]) + "\t" + ('%.4f' % stat))
@@ -0,0 +1,259 @@
+import numpy as np
+import scipy.linalg as la
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+
+
+# text used when the normal matrix can not be factorized
+NOT_POSITIVE_DEFINITE = ("Normal matrix N is not positive definite. Check the network for a datum defect "
+                         "(not enough control points) or unknowns that are not connected by enough measurements")
+# text used when removing measurements from the factorization would make N singular
+DOWNDATE_FAILED = ("Removing the measurements would make the normal matrix N singular (the remaining "
+                   "measurements do not determine all unknowns)")
+
+
+# Factor class
+# Cholesky factorization of the normal matrix N, used instead of inverting N
+# dense N is factorized with LAPACK (N = L @ Lt), sparse N with SuperLU in symmetric mode
+# (diagonal pivots only, so N = L @ D @ Lt and all pivots must be positive)
+# Sparse N is reordered to reduce the fill of L: with the ordering of fillReducingOrder if one is given (found once
+# per network and reused), otherwise SuperLU finds a minimum degree ordering of N for every factorization
+class Factor:
+    # constructor: pass the uxu normal matrix N as a numpy array or a scipy.sparse matrix
+    # perm (optional): order in which to eliminate the unknowns of sparse N (see fillReducingOrder)
+    def __init__(self, N, perm=None):
+        self.u = N.shape[0]
+        self.sparse = sp.issparse(N)
+        self.perm = None
+        if self.sparse:
+            self.N = sp.csc_matrix(N)  # kept for update()
+            try:
+                if perm is not None:
+                    self.perm = np.asarray(perm)
+                    self.lu = spla.splu(sp.csc_matrix(self.N[self.perm][:, self.perm]), permc_spec='NATURAL',
+                                        diag_pivot_thresh=0, options=dict(SymmetricMode=True))
+                else:
+                    self.lu = spla.splu(self.N, permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0,
+                                        options=dict(SymmetricMode=True))
+            except RuntimeError:  # N is exactly singular
+                raise Exception(NOT_POSITIVE_DEFINITE)
+            # N is positive definite if no off-diagonal pivots were needed and all pivots are positive
+            if np.any(self.lu.perm_r != self.lu.perm_c) or np.any(self.lu.U.diagonal() <= 0):
+                raise Exception(NOT_POSITIVE_DEFINITE)
+        else:
+            try:
+                c, lower = la.cho_factor(N, lower=True, check_finite=False)
+            except la.LinAlgError:
+                raise Exception(NOT_POSITIVE_DEFINITE)
+            # Fortran order keeps the columns of L contiguous for update()
+            self.L = (np.asfortranarray(c), lower)
+
+    # Function to solve N @ x = b using the factorization (2 triangular solves)
+    # returns x as a numpy array of the same shape as b
+    # b: numpy array with u rows
+    def solve(self, b):
+        if self.sparse:
+            b = np.asarray(b, dtype=float)
+            if self.perm is None:
+                return self.lu.solve(b)
+            x = np.empty_like(b)
+            x[self.perm] = self.lu.solve(b[self.perm])
+            return x
+        return la.cho_solve(self.L, b, check_finite=False)
+
+    # Function to get the inverse of N from the factorization
+    # returns the inverse as a dense uxu numpy array
+    def inverse(self):
+        if self.sparse:
+            return self.solve(np.eye(self.u))
+        # LAPACK potri computes the inverse directly from the Cholesky factor
+        Ninv, info = la.lapack.dpotri(self.L[0], lower=True)
+        if info != 0:
+            raise Exception(NOT_POSITIVE_DEFINITE)
+        # potri only fills the lower triangle
+        return np.tril(Ninv) + np.tril(Ninv, -1).T
+
+    # Function to get the elements of the inverse of N that lie on the pattern of the factorization
+    # (selected inverse, Takahashi equations). The pattern holds every element N has, so it gives the variances
+    # of all unknowns, the 2x2 blocks of all points and every covariance between unknowns that share a measurement
+    # without forming the dense inverse. Dense factors just give the full inverse
+    # returns a symmetric uxu scipy.sparse csr matrix (numpy array for dense factors)
+    def selectedInverse(self):
+        if not self.sparse:
+            return self.inverse()
+        u = self.u
+        # N[order][:, order] = L @ D @ Lt with L unit lower triangular
+        order = np.argsort(self.lu.perm_c)
+        if self.perm is not None:
+            order = self.perm[order]
+        L = sp.csc_matrix(self.lu.L)
+        L.sort_indices()
+        d = self.lu.U.diagonal()
+        pattern = symbolicPattern(sp.csc_matrix(self.N[order][:, order]))
+        # Z is stored on the pattern below the diagonal, column by column like a csc matrix. Z[i, j] with i > j is
+        # found with a binary search of j*u + i in the sorted keys of the pattern
+        colptr = np.concatenate([[0], np.cumsum([len(S) for S in pattern])])
+        rows = np.concatenate(pattern + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+        cols = np.repeat(np.arange(u, dtype=np.int64), np.diff(colptr))
+        keys = cols*u + rows
+        vals = np.zeros(len(keys))
+        Zdiag = np.zeros(u)
+        # columns are done from the last to the first, each one only needs the columns after it
+        for j in range(u - 1, -1, -1):
+            S = rows[colptr[j]:colptr[j + 1]]
+            # values of L[S, j] (0 where the symbolic pattern has no stored element)
+            Lrows = L.indices[L.indptr[j]:L.indptr[j + 1]]
+            pos = np.minimum(np.searchsorted(Lrows, S), len(Lrows) - 1)
+            l = np.where(Lrows[pos] == S, L.data[L.indptr[j]:L.indptr[j + 1]][pos], 0.0)
+            if len(S) > 0:
+                # Z[S, S] from the columns already done (S is a clique of the pattern)
+                hi = np.maximum(S[:, None], S[None, :]).ravel()
+                lo = np.minimum(S[:, None], S[None, :]).ravel()
+                k = np.minimum(np.searchsorted(keys, lo*u + hi), len(keys) - 1)
+                ZSS = np.where(hi == lo, Zdiag[hi], vals[k]).reshape(len(S), len(S))
+                z = -ZSS @ l
+                vals[colptr[j]:colptr[j + 1]] = z
+                Zdiag[j] = 1/d[j] - l @ z
+            else:
+                Zdiag[j] = 1/d[j]
+        # back to the order of the unknowns
+        diag = np.arange(u)
+        Z = sp.coo_matrix((np.concatenate([vals, vals, Zdiag]),
+                           (order[np.concatenate([rows, cols, diag])], order[np.concatenate([cols, rows, diag])])),
+                          shape=(u, u))
+        return Z.tocsr()
+
+    # Function to change the factorization to the one of N + At @ diag(weights) @ A
+    # dense factors get a rank-one update (or downdate for negative weights) per row of A, so adding or removing
+    # a few measurements costs O(u^2) each instead of a new factorization. Sparse N is factorized again
+    # returns nothing
+    # A: kxu numpy array or scipy.sparse matrix (rows of the design matrix of the measurements)
+    # weights: numpy array of k weights (negative to remove measurements)
+    def update(self, A, weights):
+        weights = np.ravel(weights)
+        if self.sparse:
+            N = self.N + sp.csr_matrix(A).T @ sp.diags(weights) @ sp.csr_matrix(A)
+            try:
+                self.__init__(N, self.perm)
+            except Exception:
+                if np.any(weights < 0):
+                    raise Exception(DOWNDATE_FAILED)
+                raise
+            return
+        if sp.issparse(A):
+            A = A.toarray()
+        A = np.atleast_2d(A)
+        L = self.L[0]
+        if np.any(weights < 0):
+            # work on a copy so that a failed downdate leaves the factorization unchanged
+            L = L.copy(order='F')
+        for i in range(0, len(weights)):
+            if weights[i] != 0:
+                cholUpdate(L, A[i]*np.sqrt(abs(weights[i])), np.sign(weights[i]))
+        self.L = (L, self.L[1])
+
+
+# Function to update a lower Cholesky factor L of N in place to the factor of N + sign*v@vt
+# returns nothing
+# L: uxu numpy array (only the lower triangle is used)
+# v: numpy array of length u
+# sign: 1 for an update, -1 for a downdate
+def cholUpdate(L, v, sign):
+    v = np.array(v, dtype=float)
+    nz = np.flatnonzero(v)
+    if len(nz) == 0:
+        return
+    # columns before the first non-zero element of v do not change
+    for k in range(nz[0], len(v)):
+        vk = v[k]
+        if vk == 0:  # column k does not change
+            continue
+        Lkk = L[k, k]
+        r2 = Lkk*Lkk + sign*vk*vk
+        if r2 <= 0:
+            raise Exception(DOWNDATE_FAILED)
+        r = np.sqrt(r2)
+        c = r/Lkk
+        s = vk/Lkk
+        L[k, k] = r
+        col = L[k+1:, k]  # view, changed in place
+        col += sign*s*v[k+1:]
+        col /= c
+        v[k+1:] = c*v[k+1:] - s*col
+
+
+# Function to find the pattern of the Cholesky factor L of a symmetric matrix (symbolic factorization)
+# the pattern of column j is the pattern of N below the diagonal plus the patterns of the columns whose first
+# element below the diagonal is in row j (their parent in the elimination tree is j)
+# returns a list with the sorted row numbers below the diagonal of each column of L
+# N: uxu scipy.sparse csc matrix (only the pattern is used)
+def symbolicPattern(N):
+    u = N.shape[0]
+    N.sort_indices()
+    children = [[] for j in range(0, u)]
+    pattern = [None]*u
+    for j in range(0, u):
+        S = N.indices[N.indptr[j]:N.indptr[j + 1]]
+        S = [S[S > j]]
+        for c in children[j]:
+            S.append(pattern[c][pattern[c] > j])
+        if len(S) > 1:
+            S = np.unique(np.concatenate(S))
+        else:
+            S = S[0]
+        pattern[j] = S
+        if len(S) > 0:
+            children[S[0]].append(j)
+    return pattern
+
+
+# Function to find a fill-reducing order of the unknowns from the connections between the unknown points
+# The 2 unknowns of a point always share their rows and columns of N, so the minimum degree ordering is found for
+# the graph of the points (a quarter of the size of N) and each point gives its x and y unknowns in turn.
+# The order only depends on which points are measured together, so it is found once per network and reused for
+# every factorization (see Factor)
+# returns a numpy array with the unknowns in the order they are eliminated
+# edges: kx2 numpy int array of pairs of unknown point numbers (0 to m-1) that share a measurement
+# m: number of unknown points
+def fillReducingOrder(edges, m):
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    # symmetric graph of the points with a dominant diagonal, so that SuperLU only needs diagonal pivots
+    G = sp.coo_matrix((np.ones(2*len(edges)), (np.concatenate([edges[:, 0], edges[:, 1]]),
+                                                np.concatenate([edges[:, 1], edges[:, 0]]))), shape=(m, m))
+    G = sp.csc_matrix(G + sp.identity(m)*(2*len(edges) + 1))
+    lu = spla.splu(G, permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0, options=dict(SymmetricMode=True))
+    points = np.argsort(lu.perm_c)
+    return np.stack([2*points, 2*points + 1], axis=1).ravel()
+
+
+# Function to reduce a normal matrix onto its last k unknowns (the Schur complement of the first ones)
+#     S = N22 - N21 @ inv(N11) @ N12
+# Sparse N is factorized once more in the elimination order of N11factor with the last k unknowns at the end, so
+# that N21 @ inv(N11) @ N12 = L21 @ D1 @ L21t comes from the columns of L of the first unknowns. A multiple of the
+# identity is added to N22 for this factorization only (S is not positive definite when the last unknowns are not
+# fixed by the measurements of N alone); it does not change L21 or D1. Dense N uses the solves of N11factor
+# returns S as a dense kxk numpy array
+# N: uxu normal matrix (numpy array or scipy.sparse)
+# k: number of unknowns to reduce onto
+# N11factor: Factor of the first u-k rows and columns of N
+def schurComplement(N, k, N11factor):
+    c = N.shape[0] - k
+    if not sp.issparse(N):
+        return N[c:, c:] - N[c:, :c] @ N11factor.solve(N[:c, c:])
+    N = sp.csc_matrix(N)
+    N22 = N[c:, c:].toarray()
+    if c == 0:
+        return N22
+    if not N11factor.sparse:
+        return N22 - N[c:, :c] @ N11factor.solve(N[:c, c:].toarray())
+    order = np.argsort(N11factor.lu.perm_c)
+    if N11factor.perm is not None:
+        order = N11factor.perm[order]
+    order = np.concatenate([order, np.arange(c, c + k)])
+    shift = sp.diags(np.concatenate([np.zeros(c), np.full(k, max(np.abs(N22).max(), 1.0))]))
+    lu = spla.splu(sp.csc_matrix(N[order][:, order] + shift), permc_spec='NATURAL', diag_pivot_thresh=0,
+                   options=dict(SymmetricMode=True))
+    if np.any(lu.perm_r != lu.perm_c) or np.any(lu.U.diagonal()[:c] <= 0):
+        raise Exception(NOT_POSITIVE_DEFINITE)
+    L21 = sp.csr_matrix(lu.L)[c:, :c]
+    return N22 - (L21 @ sp.diags(lu.U.diagonal()[:c]) @ L21.T).toarray()
@@ -0,0 +1,266 @@
+from functions import *
+from covariance import Covariance
+from report import writeTable
+from obstypes import OBSERVATION_TYPES
+import argparse
+import time
+
+
+# Function to read the measurements of a .mes file in batches (see readbatches)
+# A direction set is never split between 2 batches, because its orientation is eliminated within the batch (see
+# orientationCentring): the rest of a batch from the first direction of its last set on is carried over to the next
+# batch. A set whose directions are spread over the file (with other sets in between) would be split, so it gives
+# an error
+# yields MES, obs for every batch: MESTable and ObsIndex of the measurements of the batch
+# CNT: CNTTable
+# points: PointRegistry of CNT
+# MESFile: Filename of measurements file
+# MESheader: number of header lines in measurements file
+# chunk_size (optional): number of characters read at once
+def measurementBatches(CNT, points, MESFile, MESheader, chunk_size=CHUNK_SIZE):
+    oriented = [code for code in range(0, len(OBSERVATION_TYPES)) if OBSERVATION_TYPES[code].oriented]
+    closed = np.zeros(0, dtype=str)  # sets of the previous batches, as 'type code station'
+    carry = None
+    for batch in readbatches(MESFile, MESheader, chunk_size):
+        if carry is not None:
+            batch = MESTable.concat([carry, batch])
+        carry = None
+        in_set = np.flatnonzero(np.isin(batch.type, oriented))
+        if len(in_set) > 0:
+            keys = np.array([str(batch.type[i]) + ' ' + batch.info[i].split('_')[0] for i in in_set.tolist()])
+            reopened = np.isin(keys, closed)
+            if np.any(reopened):
+                raise Exception("The directions of a set must be together in " + MESFile + " to be streamed (the "
+                                "directions at " + keys[reopened][0].split(' ', 1)[1] + ")")
+            # carry the last set, and everything after its first direction, to the next batch
+            start = in_set[np.argmax(keys == keys[-1])]
+            carry = batch.take(np.arange(start, len(batch)))
+            batch = batch.take(np.arange(0, start))
+            closed = np.union1d(closed, keys[in_set < start])
+        if len(batch) > 0:
+            yield batch, ObsIndex(CNT, batch, points)
+    if carry is not None and len(carry) > 0:
+        yield carry, ObsIndex(CNT, carry, points)
+
+
+# Function to add entries to a sparse matrix
+# returns the sum as a scipy.sparse csr matrix
+# N: scipy.sparse csr matrix
+# entries: list of (rows, cols, values) numpy arrays, entries with the same row and column are added up
+def addEntries(N, entries):
+    rows, cols, values = [np.concatenate(e) for e in zip(*entries)]
+    return N + sp.csr_matrix((values, (rows, cols)), shape=N.shape)
+
+
+# Function to form the normal equations of a streamed .mes file at x, 1 batch at a time
+# A of each batch is dropped after its rows are added to N, so the memory needed depends on the number of unknowns
+# (N) and the batch size, not on the number of measurements
+# returns N, u, omega, info as a tuple:
+#     N: uxu normal matrix At @ P @ A (scipy.sparse csr, or numpy for dense)
+#     u: numpy array At @ P @ w
+#     omega: weighted sum of squared misclosures wt @ P @ w
+#     info: dictionary with the number of measurements ('n'), of direction sets ('orientations') and the convergence
+#           tolerance of the measurements ('threshold', see convergenceTolerance)
+# CNT: CNTTable
+# points: PointRegistry of CNT
+# MESFile, MESheader: measurements file and its number of header lines
+# x: numpy array with the values of the unknowns
+# sigma0: a-priori variance factor
+# sparse: set to True to keep N as a sparse matrix
+# chunk_size: number of characters of the .mes file read at once
+def streamNormals(CNT, points, MESFile, MESheader, x, sigma0, sparse, chunk_size):
+    k = len(x)
+    N = sp.csr_matrix((k, k)) if sparse else np.zeros((k, k))
+    # entries of the batches that are not in sparse N yet. They are added to N when there are as many of them as N
+    # has elements, so every entry is merged into N a bounded number of times and the buffer is never larger than N
+    entries = []
+    buffered = 0
+    u = np.zeros(k)
+    omega = 0
+    info = {'n': 0, 'orientations': 0, 'threshold': np.inf}
+    for MES, obs in measurementBatches(CNT, points, MESFile, MESheader, chunk_size):
+        A, w = buildAw(CNT, MES, x, obs, sparse=True)
+        p = buildp(MES, sigma0)
+        AtP = A.transpose() @ sp.diags(p)
+        Nb = (AtP @ A).tocoo()
+        if sparse:
+            entries.append((Nb.row, Nb.col, Nb.data))
+            buffered = buffered + Nb.nnz
+            if buffered >= max(N.nnz, k):
+                N = addEntries(N, entries)
+                entries = []
+                buffered = 0
+        else:
+            np.add.at(N, (Nb.row, Nb.col), Nb.data)
+        u = u + AtP @ w[:, 0]
+        omega = omega + np.sum(p*w[:, 0]**2)
+        info['n'] = info['n'] + len(MES)
+        info['orientations'] = info['orientations'] + obs.orientations
+        info['threshold'] = min(info['threshold'], convergenceTolerance(MES, obs, x))
+    if entries:
+        N = addEntries(N, entries)
+    if not np.isfinite(omega):
+        raise Exception("The misclosures are not finite. Check for unknown points with the same coordinates as the "
+                        "points they are measured from")
+    return N, u, omega, info
+
+
+# Function to adjust a network whose .mes file is too large to keep in memory
+# The .mes file is read again in every iteration, 1 batch at a time (see streamNormals), so only the normal
+# equations are kept: the memory depends on the number of unknowns, not on the number of measurements. The line
+# search and stopping rules are those of iterate(), and each trial step costs 1 pass over the file. A last pass
+# finds the residuals and their observations test and writes them straight to residuals.out, batch by batch
+# The results are the same as those of main, but only the unknowns, their variances and error ellipses are kept in
+# memory and written to output.out
+# returns a dictionary with the results (see the end of the function)
+# CNTFile: Filename of coordinates file
+# MESFile: Filename of measurements file
+# CNTheader, MESheader (optional): number of header lines in the files
+# sigma0 (optional): a-priori variance factor
+# maxit (optional): maximum iterations before breaking the loop
+# outdir (optional): directory to write output.out and residuals.out to
+# chunk_size (optional): number of characters of the .mes file read at once
+# suppress_print (optional): Set to False to print the progress to the console
+def streamingAdjust(CNTFile, MESFile, CNTheader=1, MESheader=1, sigma0=1, maxit=100, outdir='',
+                    chunk_size=CHUNK_SIZE, suppress_print=True):
+    time0 = time.perf_counter()
+    CNT = readfile(CNTFile, CNTheader)
+    points = PointRegistry(CNT)
+    x = buildx(CNT)
+    # dense N up to SPARSE_THRESHOLD elements
+    sparse = len(x)**2 > SPARSE_THRESHOLD
+
+    def normals(x):
+        return streamNormals(CNT, points, MESFile, MESheader, x, sigma0, sparse, chunk_size)
+
+    N, u, omega, info = normals(x)
+    n = info['n']
+    orientations = info['orientations']
+    threshold = info['threshold']
+    # fill-reducing order from the points that share an element of N (see fillReducingOrder)
+    perm = None
+    if sparse:
+        pattern = N.tocoo()
+        edges = np.unique(np.column_stack([pattern.row // 2, pattern.col // 2]), axis=0)
+        perm = fillReducingOrder(edges[edges[:, 0] < edges[:, 1]], len(x) // 2)
+
+    # damped Gauss-Newton iterations, as in iterate()
+    count = 1
+    converged = False
+    while True:
+        if not suppress_print:
+            print("Iteration: " + str(count))
+        if count >= maxit:
+            print("Maximum number of iterations reached")
+            print("Break")
+            Nfactor = Factor(N, perm)
+            delta = np.zeros(len(x))
+            x_lin = x
+            break
+        Nfactor = Factor(N, perm)
+        delta = Nfactor.solve(-u).ravel()
+        step = 1
+        for halving in range(0, MAX_STEP_HALVINGS + 1):
+            x_new = x + step*delta
+            N_new, u_new, omega_new, info = normals(x_new)
+            if omega_new <= omega*(1 + 1e-12) + 1e-300:
+                break
+            step = step/2
+        correction = step*np.max(np.abs(delta))
+        x_lin = x  # the residuals are those of the linearization at x_lin (rhat = A @ delta + w, as in main)
+        if not omega_new <= omega*(1 + 1e-12) + 1e-300:
+            converged = np.max(np.abs(delta)) <= threshold
+            if converged:
+                x = x + delta
+            else:
+                print("The iterations diverged (no step lowers the weighted sum of squared misclosures)")
+                delta = np.zeros(len(x))
+            count = count + 1
+            break
+        delta = step*delta
+        change = abs(omega - omega_new)/max(omega_new, 1e-300)
+        if not suppress_print:
+            print("largest correction = " + str(correction) + ", step = " + str(step) + ", omega = "
+                  + str(omega_new) + "\n")
+        count = count + 1
+        x = x_new
+        if correction <= threshold or change <= OMEGA_TOLERANCE:
+            converged = True
+            break
+        N, u, omega = N_new, u_new, omega_new
+
+    # rhat = A @ delta + w at x_lin, so rhatt @ P @ rhat follows from the normal equations at x_lin
+    dof = n - len(x) - orientations
+    sigma0hat = (omega + 2*delta @ u + delta @ (N @ delta))/dof
+    unitvar = sigma0hat/sigma0
+    cov = Covariance(Nfactor, sp.csr_matrix((0, len(x))), np.zeros(0), sigma0hat)
+    semi_major, semi_minor, theta = errorEllipses(cov.pointBlocks())
+    timetaken = time.perf_counter() - time0
+
+    # residuals and the observations test, written batch by batch
+    if outdir != '':
+        os.makedirs(outdir, exist_ok=True)
+    out = open(os.path.join(outdir, "residuals.out"), "w")
+    out.write("Measurement ID\tTest\tResidual\tStd of Residual\tStandardized Residual")
+    failed = 0
+    for MES, obs in measurementBatches(CNT, points, MESFile, MESheader, chunk_size):
+        A, w = buildAw(CNT, MES, x_lin, obs, sparse=True)
+        rhat = A @ delta + w[:, 0]
+        p = buildp(MES, sigma0)
+        Crhat = cov.measurements(A, p, obs.orientation).diagCrhat()
+        std = np.sqrt(np.maximum(Crhat, 0))
+        passed = np.array(sTest(rhat, Crhat), dtype=bool)
+        failed = failed + np.count_nonzero(~passed)
+        standardized = np.abs(rhat)/np.where(std > 0, std, np.inf)
+        writeTable(out, np.char.add(np.char.add(MES.id, '\t'), np.where(passed, 'passed', 'failed')),
+                   [rhat, std, standardized], ['%+1.6E', '%1.6E', '%.4f'], 0)
+    out.write('\n')
+    out.close()
+
+    # output.out: the summary, the unknowns and their error ellipses
+    out = open(os.path.join(outdir, "output.out"), "w")
+    divider = '\n\n' + '*'*100 + '\n'
+    unknown_names = CNT.name[points.unknown_rows]
+    max_name_len = np.char.str_len(CNT.name).max() + 4
+    xy = np.reshape(x, (-1, 2))
+    out.write("Geodetic Network Least Squares Adjustment (streamed)\n\nExecution Time:\t" + str(timetaken)
+              + " seconds\nItterations:\t" + str(count - 1) + "\nThreshold:\t\t" + str(threshold)
+              + "\nsigma0:\t\t\t" + str(sigma0) + divider + "\nTotal Measurements:\t\t\t" + str(n)
+              + "\nTotal unknowns:\t\t\t\t" + str(len(x)) + "\nTotal Degrees of Freedom:\t" + str(dof)
+              + "\nFailed Measurements:\t\t" + str(failed) + " (see residuals.out)"
+              + "\n\nPosteriori Variance Factor:\t" + str(sigma0hat) + "\nUnit Variance Factor:\t\t" + str(unitvar)
+              + divider + "\nEstimated Unknowns\n\nPoint Name\tx\ty\tdiffx\tdiffy")
+    writeTable(out, unknown_names, [xy[:, 0], xy[:, 1], xy[:, 0] - CNT.x[points.unknown_rows],
+                                    xy[:, 1] - CNT.y[points.unknown_rows]], ['%.4f']*4, max_name_len)
+    out.write(divider + "\nError Ellipse\n\nName\tSemi-Major axis\tSemi-Minor axis\ttheta")
+    writeTable(out, unknown_names, [semi_major, semi_minor, theta], ['%.8E', '%.8E', '%.8f'], max_name_len)
+    out.write('\n')
+    out.close()
+    if not suppress_print:
+        print('posteriori variance factor: ' + str(sigma0hat) + '\nunit variance factor: ' + str(unitvar))
+
+    # summary of the adjustment (the residuals are only in residuals.out)
+    return {
+        'iterations': count - 1,
+        'converged': converged,
+        'sigma0hat': sigma0hat,
+        'unitvar': unitvar,
+        'time': timetaken,
+        'measurements': n,
+        'unknowns': len(x),
+        'x': dict(zip(unknown_names.tolist(), xy.tolist())),
+        'failed': failed,
+    }
+
+
+# run with `python streaming.py coordinates.cnt measurements.mes [-o outdir]`
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Adjust a network, reading the .mes file in batches')
+    parser.add_argument('cnt', help='.cnt file')
+    parser.add_argument('mes', help='.mes file')
+    parser.add_argument('-o', '--outdir', default='', help='directory for output.out and residuals.out')
+    parser.add_argument('--maxit', type=int, default=100, help='maximum number of iterations')
+    parser.add_argument('--chunk', type=int, default=CHUNK_SIZE, help='number of characters read at once')
+    args = parser.parse_args()
+    streamingAdjust(args.cnt, args.mes, maxit=args.maxit, outdir=args.outdir, chunk_size=args.chunk,
+                    suppress_print=False)
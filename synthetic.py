@@ -0,0 +1,122 @@
+import numpy as np
+import math
+import os
+from scipy.spatial import Delaunay
+
+
+# network geometries that can be generated (see generateNetwork)
+GEOMETRIES = ('grid', 'random')
+
+
+# Function to generate a synthetic geodetic network and write it to a .cnt and a .mes file
+# The points are triangulated: distances are measured along the sides of the triangles and angles at the corners
+# of the triangles. The true (noise-free) coordinates and measurements are saved to a _truth.npz file, so the
+# adjusted coordinates can be checked against them
+# returns the names of the 3 files (CNTFile, MESFile, truth file) as a tuple
+# filename: name of the files without extension (e.g. 'networks/grid1000' gives grid1000.cnt and grid1000.mes)
+# unknowns (optional): number of unknowns (2 per unknown point)
+# geometry (optional): 'grid' for points on a square grid (moved by up to 10% of the spacing), or 'random' for
+#                      points spread randomly over a square
+# control (optional): fraction of the points that are control points (at least 2 control points are used)
+# angles (optional): fraction of the measurements that are angles (0 for distances only, 1 for angles only)
+# spacing (optional): average distance between neighbouring points in meters
+# dist_std (optional): standard deviation of the distances in meters
+# angle_std (optional): standard deviation of the angles in arc seconds
+# offset (optional): the initial coordinates of the unknown points in the .cnt file are off by up to this many
+#                    meters
+# noise (optional): Set to False to write the true measurements without noise
+# seed (optional): seed of the random numbers, the same seed gives the same network
+def generateNetwork(filename, unknowns=100, geometry='grid', control=0.1, angles=0.5, spacing=1000, dist_std=0.01,
+                    angle_std=1, offset=0.5, noise=True, seed=0):
+    if geometry not in GEOMETRIES:
+        raise Exception("Unknown geometry '" + str(geometry) + "'. Use one of " + ', '.join(GEOMETRIES))
+    if control < 0 or control >= 1 or angles < 0 or angles > 1:
+        raise Exception("control must be in [0, 1) and angles must be in [0, 1]")
+    rng = np.random.default_rng(seed)
+    num_unknown = max(int(unknowns) // 2, 1)
+    num_control = max(2, int(round(num_unknown*control/(1 - control))))
+    m = num_unknown + num_control
+    side = math.ceil(math.sqrt(m))
+
+    # true coordinates
+    if geometry == 'grid':
+        cells = np.arange(m)
+        xy = np.column_stack([cells // side, cells % side]).astype(float)*spacing
+        xy = xy + rng.uniform(-0.1, 0.1, (m, 2))*spacing
+    else:
+        xy = rng.uniform(0, side*spacing, (m, 2))
+    names = np.array(['P' + str(i) for i in range(0, m)])
+    # control points are spread over the network at random
+    is_control = np.zeros(m, dtype=bool)
+    is_control[rng.choice(m, num_control, replace=False)] = True
+
+    # triangulate the points
+    triangles = Delaunay(xy).simplices
+    edges = np.sort(np.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [0, 2]]]), axis=1)
+    edges = np.unique(edges, axis=0)
+    # angles at the corners of the triangles: at point i from j to k, counter-clockwise (always less than 180 degrees)
+    corners = np.concatenate([triangles[:, [1, 0, 2]], triangles[:, [2, 1, 0]], triangles[:, [0, 2, 1]]])
+    j, i, k = corners.T
+    true_angles = np.mod(np.arctan2(xy[k, 1] - xy[i, 1], xy[k, 0] - xy[i, 0])
+                         - np.arctan2(xy[j, 1] - xy[i, 1], xy[j, 0] - xy[i, 0]), 2*math.pi)
+    swap = true_angles > math.pi
+    corners[swap] = corners[swap][:, [2, 1, 0]]
+    true_angles[swap] = 2*math.pi - true_angles[swap]
+
+    # choose the measurements to get the fraction of angles
+    num_dist = len(edges)
+    num_angle = len(corners)
+    if angles >= 1:
+        num_dist = 0
+    elif angles/(1 - angles)*num_dist <= num_angle:
+        num_angle = int(round(angles/(1 - angles)*num_dist))
+    else:
+        num_dist = int(round(num_angle*(1 - angles)/angles))
+    edges = edges[np.sort(rng.choice(len(edges), num_dist, replace=False))]
+    keep = np.sort(rng.choice(len(corners), num_angle, replace=False))
+    corners = corners[keep]
+    true_angles = true_angles[keep]
+    true_dists = np.hypot(*(xy[edges[:, 0]] - xy[edges[:, 1]]).T)
+
+    # measurements with noise
+    angle_std_rad = angle_std/3600*math.pi/180
+    dists = true_dists
+    meas_angles = true_angles
+    if noise:
+        dists = true_dists + rng.normal(0, dist_std, num_dist)
+        meas_angles = true_angles + rng.normal(0, angle_std_rad, num_angle)
+
+    # write .cnt file
+    approx = xy + np.where(is_control, 0, 1)[:, None]*rng.uniform(-offset, offset, (m, 2))
+    CNTFile = filename + '.cnt'
+    MESFile = filename + '.mes'
+    if os.path.dirname(filename) != '':
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    f = open(CNTFile, 'w')
+    f.write('Point\tType\tX\tY\n')
+    types = np.where(is_control, 'C', 'U')
+    f.write(''.join(['%s\t%s\t%.4f\t%.4f\n' % row for row in zip(names, types, approx[:, 0], approx[:, 1])]))
+    f.close()
+
+    # write .mes file (distances first, then angles)
+    ids = np.arange(1, num_dist + num_angle + 1)
+    f = open(MESFile, 'w')
+    f.write('ID\tInfo\tType\tValue\tStd\n')
+    info = np.char.add(np.char.add(names[edges[:, 0]], '_'), names[edges[:, 1]])
+    f.write(''.join(['%d\t%s\tDist\t%.6f\t%g\n' % (ids[r], info[r], dists[r], dist_std) for r in range(0, num_dist)]))
+    # angles in degrees, minutes and seconds
+    deg = np.degrees(meas_angles)
+    D = np.floor(deg)
+    M = np.floor((deg - D)*60)
+    S = (deg - D - M/60)*3600
+    info = np.char.add(np.char.add(np.char.add(np.char.add(names[corners[:, 0]], '_'), names[corners[:, 1]]), '_'),
+                       names[corners[:, 2]])
+    f.write(''.join(['%d\t%s\tAngle\t%d %d %.6f\t%g\n' % (ids[num_dist + r], info[r], D[r], M[r], S[r], angle_std)
+                     for r in range(0, num_angle)]))
+    f.close()
+
+    # write the true coordinates and measurements
+    truthFile = filename + '_truth.npz'
+    np.savez(truthFile, names=names, x=xy[:, 0], y=xy[:, 1], control=is_control, ids=ids,
+             values=np.concatenate([true_dists, true_angles]))
+    return CNTFile, MESFile, truthFile
@@ -0,0 +1,6 @@
+# the modules of the repository are imported by name, as when the scripts are run from its directory
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
@@ -0,0 +1,30 @@
+# partitioned (Helmert blocking) adjustment of helmert.py against the adjustment of the whole network
+import os
+import numpy as np
+import pytest
+from main import main
+from synthetic import generateNetwork
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_partitioned_covariances_match_the_whole_network(tmp_path, sparse):
+    CNTFile, MESFile, _ = generateNetwork(str(tmp_path / 'net'), unknowns=200, seed=5)
+    whole = main(CNTFile, MESFile, suppress_print=True, plot=False, show=False, outdir=str(tmp_path / 'whole'),
+                 sparse=sparse)
+    parts = main(CNTFile, MESFile, suppress_print=True, plot=False, show=False, outdir=str(tmp_path / 'parts'),
+                 sparse=sparse, partition=4)
+    assert parts['sigma0hat'] == pytest.approx(whole['sigma0hat'], rel=1e-9)
+    assert parts['failed'] == whole['failed']
+    a = np.load(os.path.join(str(tmp_path / 'whole'), 'results.npz'), allow_pickle=True)
+    b = np.load(os.path.join(str(tmp_path / 'parts'), 'results.npz'), allow_pickle=True)
+    np.testing.assert_allclose(b['x'], a['x'], rtol=0, atol=1e-8)
+    np.testing.assert_allclose(b['rhat'], a['rhat'], rtol=0, atol=1e-8)
+    for key in ('point_blocks', 'Cxhat_diag', 'Clhat_diag', 'Crhat_diag'):
+        np.testing.assert_allclose(b[key], a[key], rtol=1e-8, atol=1e-20)
+
+
+def test_partitioned_adjustment_has_no_full_covariance(tmp_path):
+    CNTFile, MESFile, _ = generateNetwork(str(tmp_path / 'net'), unknowns=20, seed=5)
+    with pytest.raises(Exception, match='diagonals'):
+        main(CNTFile, MESFile, suppress_print=True, plot=False, show=False, outdir=str(tmp_path), partition=2,
+             full_covariance=True)
@@ -0,0 +1,66 @@
+# jobs submitted to the adjustment server (server.py) with the cache and the warm start store
+import os
+import shutil
+import numpy as np
+import pytest
+from conftest import ROOT
+from cache import ORDERINGS
+from server import runJob
+
+
+# the example network of the repository, copied so that the cache and the warm start store are made in tmp_path
+@pytest.fixture
+def network(tmp_path):
+    for name in ('coordinates.cnt', 'measurements.mes'):
+        shutil.copy(os.path.join(ROOT, name), tmp_path)
+    return tmp_path
+
+
+# Function to read the example network as text jobs send it
+def texts():
+    with open(os.path.join(ROOT, 'coordinates.cnt')) as f:
+        cnt_text = f.read()
+    with open(os.path.join(ROOT, 'measurements.mes')) as f:
+        mes_text = f.read()
+    return cnt_text, mes_text
+
+
+def test_file_job_keeps_cache_and_warm_start_next_to_the_files(network):
+    ORDERINGS.clear()
+    job = {'id': 1, 'cnt': str(network / 'coordinates.cnt'), 'mes': str(network / 'measurements.mes'),
+           'params': {'sparse': True, 'cache': True, 'warmstart': True, 'outdir': str(network / 'out')}}
+    first = runJob(job)
+    assert first['status'] == 'ok', first.get('error')
+    assert first['result']['warmstart']['seeded'] == 0
+    second = runJob(dict(job, id=2))
+    assert second['status'] == 'ok', second.get('error')
+    assert second['result']['warmstart']['seeded'] > 0
+    assert os.listdir(network / '.lscache')
+    assert os.listdir(network / '.lswarm')
+
+
+def test_text_job_needs_explicit_cache_and_warm_start(tmp_path):
+    cnt_text, mes_text = texts()
+    job = {'id': 1, 'cnt_text': cnt_text, 'mes_text': mes_text, 'params': {'sparse': True, 'cache': True}}
+    result = runJob(job)
+    assert result['status'] == 'failed'
+    assert 'cache' in result['error']
+    job['params'] = {'warmstart': str(tmp_path / 'warm')}
+    result = runJob(job)
+    assert result['status'] == 'failed'
+    assert 'network' in result['error']
+
+
+def test_text_job_with_cache_and_warm_start_directories(tmp_path):
+    ORDERINGS.clear()  # orderings found by earlier tests are kept in memory and not saved again
+    cnt_text, mes_text = texts()
+    params = {'sparse': True, 'cache': str(tmp_path / 'cache'), 'warmstart': str(tmp_path / 'warm'),
+              'network': 'example', 'outdir': str(tmp_path / 'out')}
+    job = {'id': 1, 'cnt_text': cnt_text, 'mes_text': mes_text, 'params': params}
+    first = runJob(job)
+    assert first['status'] == 'ok', first.get('error')
+    second = runJob(dict(job, id=2))
+    assert second['status'] == 'ok', second.get('error')
+    assert second['result']['warmstart']['seeded'] > 0
+    np.testing.assert_allclose(list(second['result']['x'].values()), list(first['result']['x'].values()), atol=1e-6)
+    assert os.listdir(tmp_path / 'cache')
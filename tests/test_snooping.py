@@ -0,0 +1,57 @@
+# data snooping (snooping.py) followed by the observation test (sTest in functions.py) on a network with 1 blunder
+import os
+import re
+import numpy as np
+import pytest
+from main import main
+from snooping import CRITICAL_VALUE
+from synthetic import generateNetwork
+
+# row of the blunder in the .mes file and its size in meters (15 times the standard deviation of the distances)
+BLUNDER_ROW = 20
+BLUNDER = 0.15
+
+
+# synthetic network with 1 distance that is off by BLUNDER, returns the names of its .cnt and .mes files
+@pytest.fixture
+def blunder_network(tmp_path):
+    CNTFile, MESFile, _ = generateNetwork(str(tmp_path / 'net'), unknowns=60, seed=3)
+    with open(MESFile) as f:
+        lines = f.read().split('\n')
+    fields = lines[BLUNDER_ROW].split('\t')
+    assert fields[2] == 'Dist'
+    fields[3] = '%.6f' % (float(fields[3]) + BLUNDER)
+    lines[BLUNDER_ROW] = '\t'.join(fields)
+    with open(MESFile, 'w') as f:
+        f.write('\n'.join(lines))
+    return CNTFile, MESFile, fields[0]
+
+
+def test_snooping_then_observation_test(blunder_network, tmp_path):
+    CNTFile, MESFile, blunder_id = blunder_network
+    plain = main(CNTFile, MESFile, suppress_print=True, plot=False, show=False, outdir=str(tmp_path / 'plain'))
+    snooped = main(CNTFile, MESFile, suppress_print=True, plot=False, show=False, outdir=str(tmp_path / 'snooped'),
+                   snooping=True)
+    # the observation test finds the blunder, the data snooping removes only it and then every measurement passes
+    assert plain['failed'] == [blunder_id]
+    assert snooped['removed'] == [blunder_id]
+    assert snooped['failed'] == []
+    assert snooped['sigma0hat'] < plain['sigma0hat']
+
+
+def test_snooping_uses_the_a_priori_variance_factor(blunder_network, tmp_path):
+    CNTFile, MESFile, blunder_id = blunder_network
+    outdir = str(tmp_path / 'plain')
+    plain = main(CNTFile, MESFile, suppress_print=True, plot=False, show=False, outdir=outdir)
+    results = np.load(os.path.join(outdir, 'results.npz'), allow_pickle=True)
+    row = list(results['ids']).index(blunder_id)
+    # Crhat is scaled by sigma0hat, the standardized residual of the data snooping by sigma0 = 1
+    expected = abs(results['rhat'][row])/np.sqrt(results['Crhat_diag'][row]/plain['sigma0hat'])
+    outdir = str(tmp_path / 'snooped')
+    main(CNTFile, MESFile, suppress_print=True, plot=False, show=False, outdir=outdir, snooping=True)
+    with open(os.path.join(outdir, 'output.out')) as f:
+        text = f.read()
+    assert "Variance Factor:\t1 (a-priori)" in text
+    statistic = float(re.search('\n' + blunder_id + '\t\\S+\t(\\S+)', text.split('Data Snooping')[1]).group(1))
+    assert statistic == pytest.approx(expected, rel=1e-3)
+    assert statistic > CRITICAL_VALUE
@@ -0,0 +1,65 @@
+import numpy as np
+import hashlib
+import os
+import tempfile
+
+# name of the warm start directory that is made next to the .cnt file when no directory is given
+WARMSTART_DIR = '.lswarm'
+
+
+# WarmStartStore class
+# stores the converged unknowns of adjusted networks, keyed by network identity and point name, so that the next
+# adjustment of the same network can start from them instead of the approximate coordinates in the .cnt file
+# each network is kept in its own .npz file
+class WarmStartStore:
+    # constructor: pass the directory to keep the store in (made when the first network is saved)
+    def __init__(self, directory):
+        self.directory = directory
+
+    # Function to get the file a network is stored in
+    # network: network identity (e.g. the absolute path of the .cnt file)
+    def filename(self, network):
+        return os.path.join(self.directory, hashlib.sha1(network.encode()).hexdigest() + '.npz')
+
+    # Function to seed the unknowns vector x with the stored coordinates of a network
+    # unknowns that are not in the store keep their values from x (the .cnt values)
+    # returns x, seeded, cold_iterations as a tuple:
+    #     x: new numpy array with the seeded unknowns
+    #     seeded: number of unknown points that were seeded
+    #     cold_iterations: number of iterations the network needed when started from the .cnt values (0 if unknown)
+    # network: network identity
+    # points: PointRegistry of CNT
+    # x: numpy array with initial values of unknowns
+    def seed(self, network, points, x):
+        x = np.array(x, dtype=float)
+        try:
+            stored = np.load(self.filename(network))
+            names = stored['names'].tolist()
+            xy = stored['xy']
+            cold_iterations = int(stored['cold_iterations'])
+        except (OSError, KeyError, ValueError):  # network not stored yet (or damaged file)
+            return x, 0, 0
+        seeded = 0
+        for i in range(0, len(names)):
+            row = points.rows.get(names[i])
+            # only unknowns are seeded, points that became control points keep their .cnt values
+            if row is not None and points.cols[row] >= 0:
+                col = points.cols[row]
+                x[col:col + 2] = xy[i]
+                seeded = seeded + 1
+        return x, seeded, cold_iterations
+
+    # Function to save the converged unknowns of a network
+    # returns nothing
+    # network: network identity
+    # points: PointRegistry of CNT
+    # x: numpy array with the converged unknowns
+    # cold_iterations: number of iterations the network needs when started from the .cnt values
+    def save(self, network, points, x, cold_iterations):
+        os.makedirs(self.directory, exist_ok=True)
+        names = points.CNT.name[points.unknown_rows]
+        # write to a temporary file first so that a damaged file is never loaded
+        f, tmp = tempfile.mkstemp(dir=self.directory, suffix='.npz')
+        os.close(f)
+        np.savez(tmp, names=names, xy=np.reshape(x, (-1, 2)), cold_iterations=cold_iterations)
+        os.replace(tmp, self.filename(network))